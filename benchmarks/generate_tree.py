@@ -0,0 +1,76 @@
+# Generates a synthetic source tree of Python, Kotlin and TypeScript files for the benchmarks.
+#
+# File sizes follow a long-tailed distribution (many small files, few large ones), so that
+# packing, chunking and the scheduler are exercised like on a real repository.
+
+import os
+import random
+import argparse
+
+FILES_PER_DIRECTORY = 100
+
+
+def _python_file(name, functions, rng):
+    body = "".join(
+        f"\n\ndef {name}_function_{index}(value, factor={rng.randint(1, 9)}):\n"
+        f"    result = value * factor + {rng.randint(0, 999)}\n"
+        f"    if result > {rng.randint(100, 999)}:\n"
+        f"        return result - factor\n"
+        f"    return result\n"
+        for index in range(functions)
+    )
+    return f"import os\nimport math\n{body}\n\nclass {name.title()}Service:\n    def run(self):\n        return os.getcwd()\n"
+
+
+def _kotlin_file(name, functions, rng):
+    body = "".join(
+        f"\n    fun {name}Function{index}(value: Int, factor: Int = {rng.randint(1, 9)}): Int {{\n"
+        f"        val result = value * factor + {rng.randint(0, 999)}\n"
+        f"        return if (result > {rng.randint(100, 999)}) result - factor else result\n"
+        f"    }}\n"
+        for index in range(functions)
+    )
+    return f"package com.example.{name}\n\nimport kotlin.math.max\n\nclass {name.title()}Service {{{body}}}\n"
+
+
+def _typescript_file(name, functions, rng):
+    body = "".join(
+        f"\nexport function {name}Function{index}(value: number, factor = {rng.randint(1, 9)}): number {{\n"
+        f"  const result = value * factor + {rng.randint(0, 999)};\n"
+        f"  return result > {rng.randint(100, 999)} ? result - factor : result;\n"
+        f"}}\n"
+        for index in range(functions)
+    )
+    return f"import {{ max }} from './math';\n{body}"
+
+
+GENERATORS = {".py": _python_file, ".kt": _kotlin_file, ".ts": _typescript_file}
+
+
+def generate_tree(base_dir, file_count, seed=42):
+    """Write `file_count` source files below `base_dir` and return their paths."""
+    rng = random.Random(seed)
+    extensions = list(GENERATORS)
+    paths = []
+    for index in range(file_count):
+        directory = os.path.join(base_dir, "src", f"module{index // FILES_PER_DIRECTORY}")
+        os.makedirs(directory, exist_ok=True)
+        ext = extensions[index % len(extensions)]
+        name = f"file{index}"
+        # Long tail: mostly 1-10 functions, a few files with hundreds
+        functions = min(400, max(1, int(rng.paretovariate(1.2) * 2)))
+        path = os.path.join(directory, name + ext)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(GENERATORS[ext](name, functions, rng))
+        paths.append(path)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic source tree for benchmarks.")
+    parser.add_argument("base_dir")
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    arguments = parser.parse_args()
+    generate_tree(arguments.base_dir, arguments.files, arguments.seed)
+    print(f"Generated {arguments.files} files in {arguments.base_dir}")
@@ -0,0 +1,322 @@
+# Local stand-in for the Azure OpenAI chat completions endpoint, for benchmarks without real quota.
+#
+# Point the annotator at it with AZURE_OPENAI_ENDPOINT=http://127.0.0.1:<port>. The server answers every
+# request with the file content plus one added comment, simulating:
+# - a latency distribution (constant, uniform or lognormal) and an output speed in tokens per second
+# - tokens-per-minute and requests-per-minute limits over a sliding window, answered with 429 + Retry-After
+# - failure injection (500 responses and dropped connections)
+# GET /stats returns the counters as JSON.
+
+import os
+import re
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+WINDOW_SECONDS = 60
+CHARS_PER_TOKEN = 4
+STREAM_CHUNK_TOKENS = 20
+# Like the service, only system prompts of at least 1024 tokens are cached, in steps of 128 tokens
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_STEP_TOKENS = 128
+PROMPT_CACHE_TTL_SECONDS = 300
+# Files of packed requests with these extensions get a `#` comment, all others a `//` comment
+HASH_COMMENT_EXTENSIONS = {".py", ".rb", ".sh", ".yaml", ".yml"}
+
+
+class MockSettings:
+    """Behaviour of the mock server."""
+
+    def __init__(self, latency_distribution="lognormal", latency_median=0.5, latency_sigma=0.5,
+                 tokens_per_second=200.0, tokens_per_minute=5_000_000, requests_per_minute=30_000,
+                 failure_rate=0.0, disconnect_rate=0.0, seed=None):
+        self.latency_distribution = latency_distribution
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.tokens_per_second = tokens_per_second
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.failure_rate = failure_rate
+        self.disconnect_rate = disconnect_rate
+        self.random = random.Random(seed)
+
+
+class QuotaWindow:
+    """Sliding one-minute window of the tokens and requests admitted so far."""
+
+    def __init__(self, tokens_per_minute, requests_per_minute):
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self._admitted = deque()
+        self._tokens = 0
+        self._lock = threading.Lock()
+
+    def try_admit(self, tokens):
+        """Admit a request or return the number of seconds until it would fit into the window."""
+        with self._lock:
+            now = time.monotonic()
+            while self._admitted and self._admitted[0][0] <= now - WINDOW_SECONDS:
+                self._tokens -= self._admitted.popleft()[1]
+            if self._tokens + tokens <= self.tokens_per_minute and len(self._admitted) < self.requests_per_minute:
+                self._admitted.append((now, tokens))
+                self._tokens += tokens
+                return 0
+            if not self._admitted:
+                return 1.0
+            # Wait until enough of the oldest requests have left the window
+            freed_tokens = 0
+            for admitted_at, admitted_tokens in self._admitted:
+                freed_tokens += admitted_tokens
+                if self._tokens - freed_tokens + tokens <= self.tokens_per_minute:
+                    return max(0.001, admitted_at + WINDOW_SECONDS - now)
+            return WINDOW_SECONDS
+
+    def remaining(self):
+        with self._lock:
+            return max(0, self.tokens_per_minute - self._tokens), max(0, self.requests_per_minute - len(self._admitted))
+
+
+class PromptCache:
+    """
+    The system prompts in the simulated prompt cache. A prompt is cached once the first request with it
+    has been prefilled, so requests sent at the same time as the first one all miss the cache. Like
+    the service, a request hits the longest cached prefix of its system prompt.
+    """
+
+    def __init__(self):
+        self._prefilled_at = {}
+        self._lock = threading.Lock()
+
+    def cached_tokens(self, system_prompt):
+        now = time.time()
+        with self._lock:
+            prefixes = [os.path.commonprefix([system_prompt, prompt]) for prompt, prefilled_at in self._prefilled_at.items()
+                        if now - prefilled_at <= PROMPT_CACHE_TTL_SECONDS]
+        prefix_tokens = estimate_tokens(max(prefixes, key=len, default=""))
+        if prefix_tokens < PROMPT_CACHE_MIN_TOKENS:
+            return 0
+        return prefix_tokens // PROMPT_CACHE_STEP_TOKENS * PROMPT_CACHE_STEP_TOKENS
+
+    def prefilled(self, system_prompt):
+        with self._lock:
+            self._prefilled_at[system_prompt] = time.time()
+
+
+class MockStats:
+    """Counters of the requests answered by the server."""
+
+    def __init__(self):
+        self.requests = 0
+        self.completed = 0
+        self.throttled = 0
+        self.failed = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, **counters):
+        with self._lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def to_dict(self):
+        with self._lock:
+            return {name: value for name, value in vars(self).items() if not name.startswith("_")}
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def build_completion(system_prompt, user_input):
+    """The simulated answer: the input with one comment added, in the format the request asks for."""
+    if "Comment Insertions" in system_prompt:
+        return json.dumps({"insertions": [{"line": 1, "position": "before", "anchor": "", "comment": _comment_for(user_input)}]})
+    if "<<<PART START>>>" in user_input:
+        user_input = user_input.split("<<<PART START>>>\n", 1)[1].split("<<<PART END>>>", 1)[0]
+    if "<<<FILE " in user_input:
+        # Packed files are named in their header, the first line alone does not tell Kotlin from Python
+        return re.sub(r"^(<<<FILE \d+ START:? ?([^\n]*)>>>\n)",
+                      lambda match: match.group(1) + _comment_for("", match.group(2)) + "\n",
+                      user_input, flags=re.MULTILINE)
+    return _comment_for(user_input) + "\n" + user_input
+
+
+def _comment_for(text, file_name=None):
+    """A line comment in the syntax of the file, guessed from the text if its name is not known."""
+    if file_name:
+        hash_comment = os.path.splitext(file_name)[-1] in HASH_COMMENT_EXTENSIONS
+    else:
+        hash_comment = not re.search(r"[;{}]", text)
+    return "# Documented by the mock server." if hash_comment else "// Documented by the mock server."
+
+
+class MockAzureHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            self._send_json(200, self.server.stats.to_dict())
+        else:
+            self._send_json(404, {"error": {"code": "404", "message": "Not found"}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("content-length", 0))))
+        settings = self.server.settings
+        stats = self.server.stats
+        stats.add(requests=1)
+        if not self.path.split("?")[0].endswith("/chat/completions"):
+            self._send_json(404, {"error": {"code": "404", "message": "Not found"}})
+            return
+
+        messages = body.get("messages", [])
+        system_prompt = messages[0]["content"] if messages else ""
+        user_input = messages[-1]["content"] if messages else ""
+        completion = build_completion(system_prompt, user_input)
+        prompt_tokens = estimate_tokens(system_prompt) + estimate_tokens(user_input)
+        completion_tokens = estimate_tokens(completion)
+        cached_tokens = self.server.prompt_cache.cached_tokens(system_prompt)
+
+        retry_after = self.server.quota.try_admit(prompt_tokens + completion_tokens)
+        if retry_after:
+            stats.add(throttled=1)
+            self._send_json(429, {"error": {"code": "429", "message": "Rate limit is exceeded."}},
+                            {"retry-after": str(max(1, round(retry_after))), "retry-after-ms": str(int(retry_after * 1000))})
+            return
+
+        time.sleep(self._latency())
+        self.server.prompt_cache.prefilled(system_prompt)
+        failure = settings.random.random()
+        if failure < settings.disconnect_rate:
+            stats.add(failed=1)
+            self.close_connection = True
+            self.connection.close()
+            return
+        if failure < settings.disconnect_rate + settings.failure_rate:
+            stats.add(failed=1)
+            self._send_json(500, {"error": {"code": "500", "message": "Injected failure."}})
+            return
+
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens, "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+        if body.get("stream"):
+            self._stream(completion, usage)
+        else:
+            time.sleep(completion_tokens / settings.tokens_per_second)
+            self._send_json(200, {
+                "id": "mock", "object": "chat.completion", "created": int(time.time()), "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": completion}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+        stats.add(completed=1, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, cached_tokens=cached_tokens)
+
+    def _latency(self):
+        settings = self.server.settings
+        if settings.latency_distribution == "constant":
+            return settings.latency_median
+        if settings.latency_distribution == "uniform":
+            return settings.random.uniform(0, 2 * settings.latency_median)
+        return settings.random.lognormvariate(0, settings.latency_sigma) * settings.latency_median
+
+    def _stream(self, completion, usage):
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("connection", "close")
+        self._send_rate_limit_headers()
+        self.end_headers()
+        self.close_connection = True
+        chunk_size = STREAM_CHUNK_TOKENS * CHARS_PER_TOKEN
+        for start in range(0, len(completion), chunk_size):
+            time.sleep(STREAM_CHUNK_TOKENS / self.server.settings.tokens_per_second)
+            self._send_event({"choices": [{"index": 0, "delta": {"content": completion[start:start + chunk_size]}, "finish_reason": None}]})
+        self._send_event({"choices": [], "usage": usage})
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def _send_event(self, data):
+        data = {"id": "mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": "mock", **data}
+        self.wfile.write(f"data: {json.dumps(data)}\n\n".encode())
+        self.wfile.flush()
+
+    def _send_rate_limit_headers(self):
+        remaining_tokens, remaining_requests = self.server.quota.remaining()
+        self.send_header("x-ratelimit-remaining-tokens", str(remaining_tokens))
+        self.send_header("x-ratelimit-remaining-requests", str(remaining_requests))
+
+    def _send_json(self, status, data, headers=None):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(payload)))
+        self._send_rate_limit_headers()
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class MockAzureServer(ThreadingHTTPServer):
+    """The mock server, started in a background thread with `start()`."""
+
+    daemon_threads = True
+    # A real endpoint accepts a burst of connections, the default backlog of 5 drops some of MAX_CONCURRENT_REQUESTS
+    request_queue_size = 128
+
+    def __init__(self, port=0, settings=None):
+        super().__init__(("127.0.0.1", port), MockAzureHandler)
+        self.settings = settings or MockSettings()
+        self.quota = QuotaWindow(self.settings.tokens_per_minute, self.settings.requests_per_minute)
+        self.stats = MockStats()
+        self.prompt_cache = PromptCache()
+
+    @property
+    def endpoint(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def add_settings_arguments(parser):
+    parser.add_argument("--latency-distribution", choices=["constant", "uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--latency-median", type=float, default=0.5, help="Median latency in seconds before the output starts")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Sigma of the lognormal latency distribution")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="Output speed per request")
+    parser.add_argument("--tpm", type=int, default=5_000_000, help="Tokens-per-minute limit")
+    parser.add_argument("--rpm", type=int, default=30_000, help="Requests-per-minute limit")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of requests answered with 500")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="Share of requests with a dropped connection")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def settings_from_arguments(args):
+    return MockSettings(args.latency_distribution, args.latency_median, args.latency_sigma, args.tokens_per_second,
+                        args.tpm, args.rpm, args.failure_rate, args.disconnect_rate, args.seed)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Local stand-in for the Azure OpenAI chat completions endpoint.")
+    parser.add_argument("--port", type=int, default=8765)
+    add_settings_arguments(parser)
+    arguments = parser.parse_args()
+    server = MockAzureServer(arguments.port, settings_from_arguments(arguments))
+    logging.info(f"Mock Azure OpenAI server listening on {server.endpoint}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
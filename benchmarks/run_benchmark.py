@@ -0,0 +1,165 @@
+# Offline throughput benchmark: runs the annotation pipeline and the double checker against the
+# local mock Azure OpenAI server on synthetic source trees and reports files/s, tokens/s,
+# quota utilization and peak RSS.
+#
+# Usage: python benchmarks/run_benchmark.py --sizes 1000,10000,100000
+
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+
+from generate_tree import generate_tree
+from mock_azure_server import MockAzureServer, add_settings_arguments, settings_from_arguments
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class BenchmarkResult:
+    """Measurements of one program run on one tree."""
+
+    def __init__(self, name, file_count, elapsed, exit_code, peak_rss_mb, stats_before, stats_after, tokens_per_minute):
+        self.name = name
+        self.file_count = file_count
+        self.elapsed = elapsed
+        self.exit_code = exit_code
+        self.peak_rss_mb = peak_rss_mb
+        self.requests = stats_after["completed"] - stats_before["completed"]
+        self.throttled = stats_after["throttled"] - stats_before["throttled"]
+        self.tokens = (stats_after["prompt_tokens"] + stats_after["completion_tokens"]
+                       - stats_before["prompt_tokens"] - stats_before["completion_tokens"])
+        prompt_tokens = stats_after["prompt_tokens"] - stats_before["prompt_tokens"]
+        self.cached_share = (stats_after["cached_tokens"] - stats_before["cached_tokens"]) / max(1, prompt_tokens)
+        # A one-minute window grants a full minute of quota at once, so shorter runs are measured against one minute
+        self.quota_utilization = self.tokens / (tokens_per_minute * max(elapsed, 60) / 60)
+
+    def describe(self):
+        return (f"{self.name:<14} {self.file_count:>8} files | {self.elapsed:>8.1f}s | "
+                f"{self.file_count / self.elapsed:>8.1f} files/s | {self.tokens / self.elapsed:>9.0f} tokens/s | "
+                f"{self.requests:>7} requests | {self.throttled:>6} x 429 | quota {self.quota_utilization * 100:>5.1f}% | "
+                f"cached {self.cached_share * 100:>4.1f}% | "
+                f"peak RSS {self.peak_rss_mb:>7.1f} MB" + ("" if self.exit_code == 0 else f" | EXIT CODE {self.exit_code}"))
+
+
+def run_measured(name, command, cwd, env, log_file, server, file_count, tokens_per_minute):
+    """Run a program to completion and measure its wall time and peak RSS (via wait4)."""
+    stats_before = server.stats.to_dict()
+    start = time.time()
+    with open(log_file, "w") as log:
+        process = subprocess.Popen(command, cwd=cwd, env=env, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    peak_rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return BenchmarkResult(name, file_count, elapsed, os.waitstatus_to_exitcode(status), peak_rss_mb,
+                           stats_before, server.stats.to_dict(), tokens_per_minute)
+
+
+def prepare_tree(base_dir, file_count):
+    """Generate the tree and commit it, so that the double checker sees the annotations as changes."""
+    generate_tree(base_dir, file_count)
+    git = ["git", "-c", "user.name=benchmark", "-c", "user.email=benchmark@localhost", "-c", "commit.gpgsign=false"]
+    subprocess.run(["git", "init", "-q"], cwd=base_dir, check=True)
+    subprocess.run(["git", "add", "-A"], cwd=base_dir, check=True)
+    subprocess.run(git + ["commit", "-q", "-m", "Synthetic tree"], cwd=base_dir, check=True)
+
+
+def benchmark_environment(base_dir, server, arguments):
+    env = dict(os.environ)
+    env.update({
+        "BASE_DIR": base_dir,
+        "TASKS": "documentation",
+        "AZURE_OPENAI_ENDPOINT": server.endpoint,
+        "AZURE_OPENAI_API_KEY": "mock",
+        "AZURE_OPENAI_DEPLOYMENT_NAME": "mock",
+        "AZURE_OPENAI_MODEL_NAME": "gpt-4o",
+        "AZURE_OPENAI_MODEL": "gpt-4o",
+        "AZURE_API_VERSION": "2024-10-21",
+        "AUTO_CONFIRM": "true",
+        "RESPONSE_CACHE_MAX_MB": "0",
+        "TOKEN_RATE_LIMIT": str(arguments.tpm),
+        "REQUEST_RATE_LIMIT": str(arguments.rpm),
+    })
+    if arguments.concurrency:
+        env["MAX_CONCURRENT_REQUESTS"] = str(arguments.concurrency)
+    if arguments.tokenizer_encoding:
+        env["TOKENIZER_ENCODING"] = arguments.tokenizer_encoding
+    return env
+
+
+def check_tokenizer(env):
+    """
+    Load the tokenizer of the pipeline once before generating any tree. Without network access, the
+    encoding must already be in the tiktoken cache (TIKTOKEN_CACHE_DIR, bundled with the Docker image).
+    """
+    result = subprocess.run([sys.executable, "-c", "from tokenizer import get_tokenizer; get_tokenizer().encode('')"],
+                            cwd=REPOSITORY_DIR, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        error = (result.stderr.strip().splitlines() or ["unknown error"])[-1]
+        raise SystemExit(f"The tokenizer of the pipeline cannot be loaded: {error}\n"
+                         f"Run the benchmark once with network access, set TIKTOKEN_CACHE_DIR to a cache that "
+                         f"contains the encoding, or choose a cached one with --tokenizer-encoding.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark against a local mock Azure OpenAI server.")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Comma-separated numbers of files")
+    parser.add_argument("--work-dir", default=None, help="Directory for the generated trees (default: temporary)")
+    parser.add_argument("--concurrency", type=int, default=None, help="MAX_CONCURRENT_REQUESTS of the pipeline")
+    parser.add_argument("--skip-double-check", action="store_true", help="Only benchmark the annotation pipeline")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated trees and logs")
+    parser.add_argument("--tokenizer-encoding", default=None,
+                        help="TOKENIZER_ENCODING of the pipeline (default: the one of gpt-4o, o200k_base)")
+    add_settings_arguments(parser)
+    arguments = parser.parse_args()
+
+    server = MockAzureServer(0, settings_from_arguments(arguments)).start()
+    try:
+        check_tokenizer(benchmark_environment("", server, arguments))
+    except SystemExit:
+        server.stop()
+        raise
+    work_dir = arguments.work_dir or tempfile.mkdtemp(prefix="annotator-benchmark-")
+    logging.info(f"Mock server on {server.endpoint}, quota {arguments.tpm} tokens/min, {arguments.rpm} requests/min")
+    results = []
+    try:
+        for file_count in (int(size) for size in arguments.sizes.split(",")):
+            size_dir = os.path.join(work_dir, f"tree-{file_count}")
+            base_dir = os.path.join(size_dir, "project") + "/"
+            logging.info(f"Generating {file_count} files in {base_dir}")
+            prepare_tree(base_dir, file_count)
+            env = benchmark_environment(base_dir, server, arguments)
+
+            logging.info(f"Running the pipeline on {file_count} files...")
+            result = run_measured("pipeline", [sys.executable, "main.py"], REPOSITORY_DIR, env,
+                                  os.path.join(size_dir, "pipeline.log"), server, file_count, arguments.tpm)
+            logging.info(result.describe())
+            results.append(result)
+
+            if not arguments.skip_double_check:
+                logging.info(f"Running the double checker on {file_count} files...")
+                result = run_measured("double-check", [sys.executable, os.path.join(REPOSITORY_DIR, "double-check-documentation-changes.py")],
+                                      size_dir, env, os.path.join(size_dir, "double-check.log"), server, file_count, arguments.tpm)
+                logging.info(result.describe())
+                results.append(result)
+    finally:
+        server.stop()
+        if not arguments.keep and not arguments.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    logging.info("\n===============================")
+    logging.info("     BENCHMARK RESULTS")
+    logging.info("===============================")
+    for result in results:
+        logging.info(result.describe())
+    if arguments.keep or arguments.work_dir:
+        logging.info(f"Trees and logs: {work_dir}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    main()
@@ -0,0 +1,374 @@
+import os
+import ast
+import asyncio
+import difflib
+import logging
+import re
+
+from code_tokens import C_LIKE_EXTENSIONS, has_same_code
+
+CHUNKABLE_EXTENSIONS = {".py"} | C_LIKE_EXTENSIONS
+# Declarations are split at the top level and, for oversized classes, at the level of their members
+MAX_SPLIT_LEVEL = 1
+MAX_CONTEXT_LINES = 60
+# Chunks of one file that are sent at the same time, the file only takes one slot of the scheduler
+MAX_CONCURRENT_CHUNKS = int(os.getenv("MAX_CONCURRENT_CHUNKS", "4"))
+
+PART_START = "<<<PART START>>>"
+PART_END = "<<<PART END>>>"
+CHUNK_INSTRUCTIONS = f"""
+
+### **Partial File Input**:
+The user message contains one part of a larger file between the markers `{PART_START}` and `{PART_END}`.
+Anything before `{PART_START}` is context from the same file (imports, enclosing declarations). Use it only to understand the part, never output it.
+Apply the instructions above to the part only and output exactly the modified part, without the markers and without the context.
+"""
+
+_C_LIKE_DECLARATION = re.compile(
+    r"^(public|private|protected|internal|open|abstract|final|static|override|suspend|inline|data|sealed|enum|"
+    r"export|default|async|const|let|var|val|fun|function|class|interface|object|type|record|companion|@)\b"
+)
+_CONTINUATION_START = tuple("})].?:,+-*/&|=")
+_HEADER_START = ("package ", "import ")
+_COMMENT_START = ("//", "/*", "*", "*/", "@")
+
+
+class Chunk:
+    """A consecutive part of a file that is annotated in its own request, optionally with its line range."""
+
+    def __init__(self, text, context, start=None, end=None):
+        self.text = text
+        self.context = context
+        self.start = start
+        self.end = end
+
+
+def can_chunk(ext):
+    """Whether oversized files with this extension can be split at declaration boundaries."""
+    return ext in CHUNKABLE_EXTENSIONS
+
+
+def split_into_chunks(text, ext, max_chunk_tokens, token_count):
+    """
+    Split a file at declaration boundaries into chunks of at most `max_chunk_tokens` tokens.
+
+    The file is split at top-level declarations first; declarations that are still too large
+    (typically classes) are split between their members. Every chunk except the first gets the
+    file header (package, imports) and the enclosing declaration as context.
+    Returns `None` if the file cannot be split into small enough chunks.
+    """
+    lines = text.splitlines(keepends=True)
+    boundaries = _declaration_boundaries(text, lines, ext)
+    if boundaries is None or not boundaries[0]:
+        return None
+
+    tokens_per_char = token_count / max(1, len(text))
+
+    def count_tokens(start, end):
+        return int(sum(len(line) for line in lines[start:end]) * tokens_per_char) + 1
+
+    segments = _split_segments(0, len(lines), 0, None, boundaries, lines, count_tokens, max_chunk_tokens)
+    header_end = min(boundaries[0])
+    header = "".join(lines[:header_end][:MAX_CONTEXT_LINES])
+
+    chunks = []
+    chunk_start, chunk_end, chunk_enclosing = None, None, None
+    for start, end, enclosing in segments:
+        if count_tokens(start, end) > max_chunk_tokens:
+            return None
+        if chunk_start is not None and count_tokens(chunk_start, end) <= max_chunk_tokens:
+            chunk_end = end
+            continue
+        if chunk_start is not None:
+            chunks.append(_build_chunk(lines, chunk_start, chunk_end, chunk_enclosing, header))
+        chunk_start, chunk_end, chunk_enclosing = start, end, enclosing
+    chunks.append(_build_chunk(lines, chunk_start, chunk_end, chunk_enclosing, header))
+    return chunks
+
+
+def split_changed_regions(base_text, text, ext, max_chunk_tokens, token_count):
+    """
+    Split out the declarations of a file that differ from an earlier version, for re-annotating only those.
+
+    Declarations are taken at the top level and, for classes, at the level of their members. Adjacent
+    changed declarations are merged into chunks of at most `max_chunk_tokens` tokens, with the same
+    context as `split_into_chunks`. Returns `None` if the file cannot be split at declaration boundaries.
+    """
+    lines = text.splitlines(keepends=True)
+    boundaries = _declaration_boundaries(text, lines, ext)
+    if boundaries is None or not boundaries[0]:
+        return None
+
+    changed_lines = set()
+    matcher = difflib.SequenceMatcher(None, base_text.splitlines(keepends=True), lines, autojunk=False)
+    for operation, _, _, start, end in matcher.get_opcodes():
+        if operation in ("replace", "insert"):
+            changed_lines.update(range(start, end))
+        elif operation == "delete":
+            # Removed lines change the declarations around the removal
+            changed_lines.update(line for line in (start - 1, start) if 0 <= line < len(lines))
+
+    tokens_per_char = token_count / max(1, len(text))
+
+    def count_tokens(start, end):
+        return int(sum(len(line) for line in lines[start:end]) * tokens_per_char) + 1
+
+    # Split every class into its members, other declarations stay whole
+    def count_members(start, end):
+        return 1 if any(start < boundary < end for boundary in boundaries[1]) else 0
+
+    segments = _split_segments(0, len(lines), 0, None, boundaries, lines, count_members, 0)
+    header = "".join(lines[:min(boundaries[0])][:MAX_CONTEXT_LINES])
+
+    regions = []
+    region = None
+    for start, end, enclosing in segments:
+        if not changed_lines.intersection(range(start, end)):
+            region = None
+            continue
+        if count_tokens(start, end) > max_chunk_tokens:
+            return None
+        if region and region[2] == enclosing and count_tokens(region[0], end) <= max_chunk_tokens:
+            region[1] = end
+            continue
+        region = [start, end, enclosing]
+        regions.append(region)
+    chunks = []
+    for start, end, enclosing in regions:
+        chunk = _build_chunk(lines, start, end, enclosing, header)
+        chunks.append(Chunk(chunk.text, chunk.context, start, end))
+    return chunks
+
+
+def _declaration_boundaries(text, lines, ext):
+    if ext == ".py":
+        return _python_boundaries(text)
+    return _c_like_boundaries(lines, nested_comments=ext == ".kt")
+
+
+def _split_segments(start, end, level, enclosing, boundaries, lines, count_tokens, max_chunk_tokens):
+    cuts = [start] + sorted(b for b in boundaries[level] if start < b < end) + [end]
+    segments = []
+    for segment_start, segment_end in zip(cuts, cuts[1:]):
+        if count_tokens(segment_start, segment_end) > max_chunk_tokens and level < MAX_SPLIT_LEVEL:
+            segment_enclosing = _declaration_line(lines, segment_start, segment_end)
+            segments.extend(_split_segments(segment_start, segment_end, level + 1, segment_enclosing,
+                                            boundaries, lines, count_tokens, max_chunk_tokens))
+        else:
+            segments.append((segment_start, segment_end, enclosing))
+    return segments
+
+
+def _declaration_line(lines, start, end):
+    for line in lines[start:end]:
+        stripped = line.strip()
+        if stripped and not stripped.startswith(_COMMENT_START + ("#",)):
+            return line
+    return None
+
+
+def _build_chunk(lines, start, end, enclosing, header):
+    if start == 0:
+        return Chunk("".join(lines[start:end]), None)
+    context = header
+    if enclosing:
+        context += "...\n" + enclosing + "...\n"
+    return Chunk("".join(lines[start:end]), context)
+
+
+def _python_boundaries(text):
+    """Start lines (0-based, including decorators and comments above) of top-level and class-level declarations."""
+    try:
+        module = ast.parse(text)
+    except SyntaxError as e:
+        logging.warning(f"Cannot split Python file at declarations: {e}")
+        return None
+    lines = text.splitlines()
+    declaration_types = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+
+    def start_line(node):
+        line = min([node.lineno] + [decorator.lineno for decorator in node.decorator_list]) - 1
+        while line > 0 and lines[line - 1].strip().startswith("#"):
+            line -= 1
+        return line
+
+    top_level = [node for node in module.body if isinstance(node, declaration_types)]
+    members = [member for node in top_level if isinstance(node, ast.ClassDef)
+               for member in node.body if isinstance(member, declaration_types)]
+    return [{start_line(node) for node in top_level}, {start_line(node) for node in members}]
+
+
+def _c_like_boundaries(lines, nested_comments):
+    """Start lines (0-based, including comments/annotations above) of declarations at brace depth 0 and 1."""
+    line_states = _scan_c_like_lines(lines, nested_comments)
+    boundaries = [set() for _ in range(MAX_SPLIT_LEVEL + 1)]
+    previous_code_line = ""
+    for index, (line, (depth, in_comment)) in enumerate(zip(lines, line_states)):
+        stripped = line.strip()
+        if not stripped or in_comment or stripped.startswith(_COMMENT_START):
+            continue
+        if depth <= MAX_SPLIT_LEVEL and not stripped.startswith(_CONTINUATION_START + _HEADER_START):
+            previous_end = previous_code_line[-1:]
+            if _C_LIKE_DECLARATION.match(stripped) or previous_end in ("}", ";", "{", ""):
+                boundaries[depth].add(_include_leading_comments(lines, line_states, index))
+        previous_code_line = _strip_trailing_comment(stripped)
+    return boundaries
+
+
+def _include_leading_comments(lines, line_states, index):
+    while index > 0:
+        previous = lines[index - 1].strip()
+        if not previous or not (line_states[index - 1][1] or previous.startswith(_COMMENT_START)):
+            break
+        index -= 1
+    return index
+
+
+def _strip_trailing_comment(stripped):
+    position = stripped.find("//")
+    return stripped[:position].rstrip() if position > 0 else stripped
+
+
+def _scan_c_like_lines(lines, nested_comments):
+    """Return `(brace depth, inside block comment or multi-line string)` at the start of every line."""
+    states = []
+    depth = 0
+    comment_depth = 0
+    string_delimiter = None
+    for line in lines:
+        states.append((depth, comment_depth > 0 or string_delimiter is not None))
+        position = 0
+        while position < len(line):
+            if comment_depth:
+                if line.startswith("*/", position):
+                    comment_depth -= 1
+                    position += 2
+                elif nested_comments and line.startswith("/*", position):
+                    comment_depth += 1
+                    position += 2
+                else:
+                    position += 1
+            elif string_delimiter:
+                if line[position] == "\\" and string_delimiter != '"""':
+                    position += 2
+                elif line.startswith(string_delimiter, position):
+                    position += len(string_delimiter)
+                    string_delimiter = None
+                else:
+                    position += 1
+            elif line.startswith("//", position):
+                break
+            elif line.startswith("/*", position):
+                comment_depth = 1
+                position += 2
+            elif line.startswith('"""', position):
+                string_delimiter = '"""'
+                position += 3
+            elif line[position] in "\"'`":
+                string_delimiter = line[position]
+                position += 1
+            else:
+                if line[position] == "{":
+                    depth += 1
+                elif line[position] == "}":
+                    depth = max(0, depth - 1)
+                position += 1
+        # Only template literals and text blocks span lines, an unterminated quote ends with its line
+        if string_delimiter in ('"', "'"):
+            string_delimiter = None
+    return states
+
+
+async def annotate_in_chunks(record, ext, client, system_prompt, max_chunk_tokens):
+    """
+    Annotate an oversized file by sending its chunks concurrently and stitching the results in order.
+
+    A chunk whose output does not reproduce its code exactly is kept unchanged. Raises `ValueError`
+    if the file cannot be split or the stitched result does not match the original code.
+    """
+    chunks = split_into_chunks(record.text, ext, max_chunk_tokens, record.token_count)
+    if not chunks:
+        raise ValueError("File cannot be split into chunks at declaration boundaries")
+    logging.info(f'"{record.path}": Split {record.token_count} tokens into {len(chunks)} chunks')
+
+    annotated_chunks, total_tokens = await _annotate_chunks(record, chunks, ext, client, system_prompt)
+    new_code = "".join(annotated_chunks)
+    if not has_same_code(record.text, new_code, ext):
+        raise ValueError("Stitched chunks do not reproduce the original code")
+    return new_code, total_tokens
+
+
+async def annotate_regions(record, ext, client, system_prompt, regions):
+    """
+    Annotate only the given regions of a file (see `split_changed_regions`) and merge them back.
+
+    The rest of the file is kept as it is. Raises `ValueError` if the merged result does not match
+    the original code.
+    """
+    annotated_regions, total_tokens = await _annotate_chunks(record, regions, ext, client, system_prompt)
+    lines = record.text.splitlines(keepends=True)
+    for region, annotated in sorted(zip(regions, annotated_regions), key=lambda item: item[0].start, reverse=True):
+        lines[region.start:region.end] = [annotated]
+    new_code = "".join(lines)
+    if not has_same_code(record.text, new_code, ext):
+        raise ValueError("Merged regions do not reproduce the original code")
+    return new_code, total_tokens
+
+
+async def _annotate_chunks(record, chunks, ext, client, system_prompt):
+    """
+    Send the chunks concurrently, at most `MAX_CONCURRENT_CHUNKS` at a time. A chunk whose output does
+    not reproduce its code exactly is kept unchanged. If a request fails, the other requests are cancelled.
+    """
+    chunk_prompt = system_prompt + CHUNK_INSTRUCTIONS
+    semaphore = asyncio.Semaphore(max(1, MAX_CONCURRENT_CHUNKS))
+
+    async def annotate_chunk(chunk):
+        async with semaphore:
+            return await client.generate_code_response(chunk_prompt, _build_chunk_input(chunk), cache=False)
+
+    tasks = [asyncio.create_task(annotate_chunk(chunk)) for chunk in chunks]
+    try:
+        results = await asyncio.gather(*tasks)
+    finally:
+        # The file fails as a whole if one chunk fails, so the requests of the other chunks are not needed
+        for task in tasks:
+            task.cancel()
+
+    annotated_chunks = []
+    total_tokens = 0
+    for index, (chunk, (response, tokens)) in enumerate(zip(chunks, results)):
+        total_tokens += tokens
+        output = restore_surrounding_whitespace(chunk.text, _strip_part_markers(response))
+        if has_same_code(chunk.text, output, ext):
+            await client.cache_response(chunk_prompt, _build_chunk_input(chunk), response, tokens)
+            annotated_chunks.append(output)
+        else:
+            logging.warning(f'"{record.path}": Chunk {index + 1}/{len(chunks)} changed code, keeping it unchanged')
+            annotated_chunks.append(chunk.text)
+    return annotated_chunks, total_tokens
+
+
+def _build_chunk_input(chunk):
+    context = f"{chunk.context}\n" if chunk.context else ""
+    return f"{context}{PART_START}\n{chunk.text}{PART_END}\n"
+
+
+def _strip_part_markers(output):
+    if PART_START in output:
+        output = output.split(PART_START, 1)[1]
+    if PART_END in output:
+        output = output.split(PART_END, 1)[0]
+    return output
+
+
+def restore_surrounding_whitespace(original, output):
+    """Give the output the blank lines around and the indentation of the first line of the original chunk."""
+    body = output.strip("\n").rstrip()
+    first_line = original.lstrip("\n").split("\n", 1)[0]
+    indentation = first_line[:len(first_line) - len(first_line.lstrip())]
+    if indentation and not body[:1].isspace():
+        body = indentation + body
+    leading = original[:len(original) - len(original.lstrip("\n"))]
+    trailing = original[len(original.rstrip()):]
+    return leading + body + trailing
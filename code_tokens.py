@@ -0,0 +1,164 @@
+import io
+import ast
+import re
+import token
+import tokenize
+import logging
+
+C_LIKE_EXTENSIONS = {".kt", ".java", ".ts", ".tsx", ".js", ".jsx"}
+NESTED_COMMENT_EXTENSIONS = {".kt"}
+# Languages with regex literals, whose `//` is no comment within a regex
+REGEX_LITERAL_EXTENSIONS = {".ts", ".tsx", ".js", ".jsx"}
+JSX_EXTENSIONS = {".tsx", ".jsx"}
+# Languages that end statements at line breaks (automatic semicolon insertion in JS/TS)
+NEWLINE_SENSITIVE_EXTENSIONS = {".kt", ".ts", ".tsx", ".js", ".jsx"}
+# A line break after these tokens ends the statement: `return\n  x` does not return x
+_LINE_ENDING_KEYWORDS = {"return", "throw", "break", "continue", "yield", "async"}
+# A line break before these tokens decides whether they continue the previous line
+_LINE_CONTINUING_SYMBOLS = {"(", "[", "+", "-", "/", "<"}
+# After these keywords a `/` starts a regex literal
+_REGEX_KEYWORDS = _LINE_ENDING_KEYWORDS | {"typeof", "instanceof", "in", "of", "new", "delete", "void", "case", "do",
+                                          "else", "await"}
+
+_C_LIKE_TOKEN = re.compile(r"""
+    (?P<whitespace>\s+)
+  | (?P<line_comment>//[^\n]*)
+  | (?P<triple_string>\"\"\"(?:.|\n)*?\"\"\")
+  | (?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|`(?:\\.|[^`\\])*`)
+  | (?P<word>[A-Za-z0-9_$]+)
+  | (?P<symbol>.)
+""", re.VERBOSE | re.DOTALL)
+
+
+class LexerError(Exception):
+    """Raised when a text cannot be split into tokens, e.g. because of an unterminated string or comment."""
+
+
+def supports_extension(ext):
+    """Whether code tokens can be extracted for files with the given extension."""
+    return ext == ".py" or ext in C_LIKE_EXTENSIONS
+
+
+def code_tokens(text, ext):
+    """
+    Return the tokens of a source text without comments, docstrings and formatting.
+
+    Two texts with the same code tokens only differ in comments and whitespace.
+    Raises `LexerError` if the text cannot be tokenized and `ValueError` for unsupported extensions.
+    """
+    if ext == ".py":
+        return _python_code_tokens(text)
+    if ext in C_LIKE_EXTENSIONS:
+        return _c_like_code_tokens(text, ext)
+    raise ValueError(f"Unsupported file extension '{ext}'")
+
+
+def has_same_code(old_text, new_text, ext):
+    """Compare two versions of a file, `None` if they cannot be compared locally."""
+    try:
+        same_code = code_tokens(old_text, ext) == code_tokens(new_text, ext)
+    except (LexerError, ValueError) as e:
+        logging.debug(f"Cannot compare code tokens: {e}")
+        return None
+    if same_code and ext == ".py" and not _parses(new_text):
+        # A string inserted as a docstring where no statement may stand (e.g. before `else:`) breaks the file
+        return None if not _parses(old_text) else False
+    return same_code
+
+
+def _parses(text):
+    try:
+        ast.parse(text)
+    except (SyntaxError, ValueError):
+        return False
+    return True
+
+
+def _python_code_tokens(text):
+    skipped_types = {token.COMMENT, token.NL, tokenize.ENCODING, token.ENDMARKER}
+    try:
+        tokens = [t for t in tokenize.generate_tokens(io.StringIO(text).readline) if t.type not in skipped_types]
+    except (tokenize.TokenError, IndentationError, SyntaxError) as e:
+        raise LexerError(str(e))
+
+    result = []
+    logical_line = []
+    for t in tokens:
+        logical_line.append(t)
+        if t.type == token.NEWLINE:
+            result.extend(_python_logical_line(logical_line))
+            logical_line = []
+    result.extend(_python_logical_line(logical_line))
+    return result
+
+
+def _python_logical_line(logical_line):
+    # A statement that consists of string literals only has no effect on the code: it is a docstring
+    statement = [t for t in logical_line if t.type not in (token.INDENT, token.DEDENT, token.NEWLINE)]
+    if statement and all(t.type == token.STRING for t in statement):
+        logical_line = [t for t in logical_line if t.type in (token.INDENT, token.DEDENT)]
+    return [token.tok_name[t.type] if t.type in (token.INDENT, token.DEDENT, token.NEWLINE) else t.string
+            for t in logical_line]
+
+
+def _c_like_code_tokens(text, ext):
+    """
+    The code tokens of a C-like text. Line breaks are kept as "\\n" tokens where they can change the
+    meaning of the code, and a `/` that may start a regex literal raises `LexerError`: its content
+    (e.g. `/\\/\\//g`) cannot be told apart from comments without parsing.
+    """
+    newline_sensitive = ext in NEWLINE_SENSITIVE_EXTENSIONS
+    continuing_symbols = _LINE_CONTINUING_SYMBOLS | {"{"} if ext == ".kt" else _LINE_CONTINUING_SYMBOLS
+    result = []
+    position = 0
+    line_break = False
+    while position < len(text):
+        if text.startswith("/*", position):
+            end = _skip_block_comment(text, position, ext in NESTED_COMMENT_EXTENSIONS)
+            line_break = line_break or "\n" in text[position:end]
+            position = end
+            continue
+        match = _C_LIKE_TOKEN.match(text, position)
+        position = match.end()
+        if match.lastgroup in ("whitespace", "line_comment"):
+            line_break = line_break or "\n" in match.group()
+            continue
+        value = match.group()
+        previous = result[-1] if result else None
+        if value == "/" and ext in REGEX_LITERAL_EXTENSIONS and _may_start_regex(previous) and \
+                not (ext in JSX_EXTENSIONS and (previous == "<" or text.startswith(">", position))):
+            raise LexerError("Possible regex literal")
+        if newline_sensitive and line_break and previous is not None and \
+                (previous in _LINE_ENDING_KEYWORDS or value in continuing_symbols or value.startswith("`")):
+            result.append("\n")
+        # An unterminated quote (e.g. an apostrophe in JSX text) is kept as a plain symbol
+        result.append(value)
+        line_break = False
+    return result
+
+
+def _may_start_regex(previous):
+    """Whether a `/` after the given token may start a regex literal instead of being a division."""
+    if previous is None:
+        return True
+    if previous[0].isalnum() or previous[0] in "_$":
+        # After an identifier or a number it divides, after a keyword like `return` a regex follows
+        return previous in _REGEX_KEYWORDS
+    # After `}` it depends on whether a block or an object literal ends
+    return previous not in (")", "]") and previous[0] not in "\"'`"
+
+
+def _skip_block_comment(text, position, nested_comments):
+    depth = 0
+    while position < len(text):
+        if text.startswith("/*", position):
+            depth = depth + 1 if nested_comments else 1
+            position += 2
+        elif text.startswith("*/", position):
+            depth -= 1
+            position += 2
+            if depth == 0:
+                return position
+        else:
+            position += 1
+    raise LexerError("Unterminated block comment")
@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import logging
+
+# Rate-limit headers older than this no longer describe the deployment's window
+HEADER_MAX_AGE_SECONDS = 60
+# Assumed capacity of a deployment without configured quota and without fresh headers
+UNKNOWN_CAPACITY = 10 ** 9
+THROTTLE_COOLDOWN_SECONDS = 10
+MAX_FAILURE_COOLDOWN_SECONDS = 60
+# Timeout of a single request attempt, independent of the number of retries
+REQUEST_TIMEOUT_SECONDS = float(os.getenv("REQUEST_TIMEOUT_SECONDS", "600"))
+
+
+class Deployment:
+    """One Azure OpenAI deployment with its own client (and connection pool) and its live quota state."""
+
+    def __init__(self, name, endpoint, deployment, api_key, api_version, tokens_per_minute=None, requests_per_minute=None):
+        self.name = name
+        self.endpoint = endpoint
+        self.deployment = deployment
+        self.api_version = api_version
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        # openai takes long to import, so it is only imported once a client is needed
+        from openai import AsyncAzureOpenAI
+        # Retries are done by the client across deployments, so that every retry and 429 shows up in the telemetry
+        self.client = AsyncAzureOpenAI(
+            azure_endpoint=endpoint,
+            azure_deployment=deployment,
+            api_key=api_key,
+            api_version=api_version,
+            max_retries=0,
+            timeout=REQUEST_TIMEOUT_SECONDS
+        )
+        self.remaining_tokens = None
+        self.remaining_requests = None
+        self.headers_at = 0.0
+        self.cooldown_until = 0.0
+        self.consecutive_failures = 0
+        self.in_flight = 0
+
+    def capacity(self, now):
+        """Tokens the deployment can still take in its current window, shared by the requests in flight."""
+        if self.remaining_requests == 0 and now - self.headers_at < HEADER_MAX_AGE_SECONDS:
+            return 0
+        if self.remaining_tokens is not None and now - self.headers_at < HEADER_MAX_AGE_SECONDS:
+            remaining = self.remaining_tokens
+        else:
+            remaining = self.tokens_per_minute or UNKNOWN_CAPACITY
+        return remaining / (1 + self.in_flight)
+
+
+class DeploymentPool:
+    """
+    Routes every request to the available deployment with the most remaining capacity.
+
+    The capacity comes from the `x-ratelimit-remaining-tokens/requests` headers of the last response
+    of each deployment. Throttled deployments are taken out of rotation for the time the server asks
+    for, failing deployments with an exponential cooldown.
+    """
+
+    def __init__(self, deployments):
+        if not deployments:
+            raise ValueError("***ERROR*** No Azure OpenAI deployment configured.")
+        self.deployments = deployments
+
+    def select(self):
+        """Return the deployment for the next request and the seconds to wait before it is available."""
+        now = time.monotonic()
+        available = [deployment for deployment in self.deployments if deployment.cooldown_until <= now]
+        if not available:
+            deployment = min(self.deployments, key=lambda d: d.cooldown_until)
+            return deployment, deployment.cooldown_until - now
+        return max(available, key=lambda d: (d.capacity(now), -d.in_flight)), 0
+
+    def report_success(self, deployment, remaining_tokens, remaining_requests):
+        deployment.consecutive_failures = 0
+        if remaining_tokens is not None or remaining_requests is not None:
+            deployment.remaining_tokens = remaining_tokens
+            deployment.remaining_requests = remaining_requests
+            deployment.headers_at = time.monotonic()
+
+    def report_throttled(self, deployment, retry_after):
+        cooldown = retry_after if retry_after is not None else THROTTLE_COOLDOWN_SECONDS
+        deployment.cooldown_until = max(deployment.cooldown_until, time.monotonic() + cooldown)
+        logging.info(f"Deployment '{deployment.name}' throttled, out of rotation for {cooldown:.1f}s")
+
+    def report_failure(self, deployment):
+        deployment.consecutive_failures += 1
+        cooldown = min(MAX_FAILURE_COOLDOWN_SECONDS, 0.5 * 2 ** (deployment.consecutive_failures - 1))
+        deployment.cooldown_until = max(deployment.cooldown_until, time.monotonic() + cooldown)
+        if deployment.consecutive_failures > 1:
+            logging.warning(f"Deployment '{deployment.name}' failed {deployment.consecutive_failures} times in a row, "
+                            f"out of rotation for {cooldown:.1f}s")
+
+
+def load_deployment_configs():
+    """
+    The deployments from `AZURE_OPENAI_DEPLOYMENTS` (a JSON list of objects with `endpoint`, `deployment`,
+    `api_key` and optionally `name`, `api_version`, `tokens_per_minute`, `requests_per_minute`), or the
+    single deployment of the `AZURE_OPENAI_*` variables.
+    """
+    api_version = os.getenv("AZURE_API_VERSION")
+    deployments_json = os.getenv("AZURE_OPENAI_DEPLOYMENTS")
+    if not deployments_json:
+        api_key = os.getenv("AZURE_OPENAI_API_KEY")
+        if not api_key:
+            raise ValueError("***ERROR*** Missing environment variable: AZURE_OPENAI_API_KEY. Check your .env file or environment settings.")
+        deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
+        return [{"name": deployment, "endpoint": os.getenv("AZURE_OPENAI_ENDPOINT"), "deployment": deployment,
+                 "api_key": api_key, "api_version": api_version}]
+
+    try:
+        configs = json.loads(deployments_json)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"***ERROR*** AZURE_OPENAI_DEPLOYMENTS is not valid JSON: {e}")
+    for index, config in enumerate(configs):
+        missing = [key for key in ("endpoint", "deployment", "api_key") if not config.get(key)]
+        if missing:
+            raise ValueError(f"***ERROR*** Deployment {index + 1} in AZURE_OPENAI_DEPLOYMENTS lacks {', '.join(missing)}.")
+        config.setdefault("api_version", api_version)
+        config.setdefault("name", f"{config['deployment']}@{config['endpoint']}")
+    return configs
+
+
+def configured_tokens_per_minute():
+    """The sum of the configured quotas of all deployments, `None` unless every deployment has one."""
+    try:
+        configs = load_deployment_configs()
+    except ValueError:
+        return None
+    quotas = [config.get("tokens_per_minute") for config in configs]
+    return sum(quotas) if quotas and all(quotas) else None
+
+
+def create_deployment_pool():
+    return DeploymentPool([
+        Deployment(config["name"], config["endpoint"], config["deployment"], config["api_key"], config["api_version"],
+                   config.get("tokens_per_minute"), config.get("requests_per_minute"))
+        for config in load_deployment_configs()
+    ])
@@ -1,16 +1,17 @@
 import os
 import subprocess
 import logging
-from openai import AzureOpenAI
 import re
 import asyncio
 from dotenv import load_dotenv
 
-from processing_index import ProcessingIndex, filter_files_already_processed
-
-# Load environment variables from .env
+# Load environment variables from .env (before the modules that read their settings on import)
 load_dotenv()
 
+from code_tokens import has_same_code, supports_extension
+from file_utils import decode_content
+from processing_index import ProcessingIndex, filter_files_already_processed
+
 # Azure OpenAI configuration
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
 AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
@@ -20,34 +21,117 @@ AZURE_API_VERSION = os.getenv("AZURE_API_VERSION")
 
 DRY_RUN = True
 USE_LLM_ANALYSIS = True
+# Maximum number of concurrent LLM requests
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "20"))
+# Maximum number of paths passed to a single git command
+GIT_BATCH_SIZE = 500
 
 BASE_DIR = os.getenv("BASE_DIR", ".")
 
-azure_openai_client = AzureOpenAI(
-    azure_endpoint=AZURE_OPENAI_ENDPOINT,
-    azure_deployment=AZURE_OPENAI_DEPLOYMENT_NAME,
-    api_key=AZURE_OPENAI_API_KEY,
-    api_version=AZURE_API_VERSION,
-    max_retries=5
-)
+_azure_openai_client = None
+
+
+def get_azure_openai_client():
+    """The LLM client, created on the first request: most files are decided locally and openai takes long to import."""
+    global _azure_openai_client
+    if _azure_openai_client is None:
+        from openai import AsyncAzureOpenAI
+        _azure_openai_client = AsyncAzureOpenAI(
+            azure_endpoint=AZURE_OPENAI_ENDPOINT,
+            azure_deployment=AZURE_OPENAI_DEPLOYMENT_NAME,
+            api_key=AZURE_OPENAI_API_KEY,
+            api_version=AZURE_API_VERSION,
+            max_retries=5
+        )
+    return _azure_openai_client
 
 
 def get_modified_files():
     """Retrieves all files in the Git repository that have changes."""
     try:
-        files = subprocess.check_output(["git", "diff", "--name-only"], cwd=BASE_DIR).decode().splitlines()
+        files = subprocess.check_output(["git", "-c", "core.quotePath=false", "diff", "--name-only"],
+                                        cwd=BASE_DIR).decode(errors="replace").splitlines()
         return files
     except subprocess.CalledProcessError:
         return []
 
 
-def get_git_diff(filename):
-    """Fetches the Git diff for a file with minimal context."""
+def get_git_diffs():
+    """Fetches the Git diff of all modified files with minimal context in one call, split per file."""
     try:
-        diff_output = subprocess.check_output(["git", "diff", "--unified=0", filename], cwd=BASE_DIR).decode()
-        return diff_output
+        diff_output = subprocess.check_output(["git", "-c", "core.quotePath=false", "diff", "--unified=0"],
+                                              cwd=BASE_DIR).decode(errors="replace")
     except subprocess.CalledProcessError:
-        return ""
+        return {}
+    return split_diff_by_file(diff_output)
+
+
+def split_diff_by_file(diff_output):
+    """Splits the output of `git diff` into the diffs of the individual files."""
+    diffs = {}
+    filename = None
+    file_lines = []
+    for line in diff_output.split("\n"):
+        if line.startswith("diff --git "):
+            if filename:
+                diffs[filename] = "\n".join(file_lines) + "\n"
+            match = re.match(r"^diff --git a/(?P<name>.+) b/(?P=name)$", line)
+            filename = match.group("name") if match else None
+            file_lines = []
+        elif filename is None and line.startswith("+++ b/"):
+            filename = line[len("+++ b/"):]
+        file_lines.append(line)
+    if filename:
+        diffs[filename] = "\n".join(file_lines) + "\n"
+    return diffs
+
+
+def get_staged_versions(filenames):
+    """
+    Reads the staged version of all given files (the git index) with a single `git cat-file` call. The
+    diff and the revert (`git checkout --`) also work against the staged version.
+    """
+    if not filenames:
+        return {}
+    request = "".join(f":{filename}\n" for filename in filenames).encode()
+    try:
+        output = subprocess.run(["git", "cat-file", "--batch"], input=request, stdout=subprocess.PIPE,
+                                cwd=BASE_DIR, check=True).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.error(f"***ERROR*** Error reading staged file versions: {e}")
+        return {}
+
+    versions = {}
+    position = 0
+    for filename in filenames:
+        header_end = output.index(b"\n", position)
+        header = output[position:header_end].split()
+        position = header_end + 1
+        if header[-1] in (b"missing", b"ambiguous"):
+            continue  # New file, nothing to compare with
+        size = int(header[2])
+        if header[1] == b"blob":
+            versions[filename] = output[position:position + size]
+        position += size + 1
+    return versions
+
+
+def compare_code_locally(filename, staged_content):
+    """
+    Compares the staged and the modified version of a file without comments, docstrings and whitespace.
+    Returns True (only comments/formatting changed), False (code changed) or None (cannot be decided locally).
+    """
+    ext = os.path.splitext(filename)[1]
+    if staged_content is None or not supports_extension(ext):
+        return None
+    try:
+        with open(os.path.join(BASE_DIR, filename), "rb") as f:
+            modified_content = f.read()
+    except FileNotFoundError:
+        return False  # The file was deleted
+    except OSError:
+        return None
+    return has_same_code(decode_content(staged_content)[0], decode_content(modified_content)[0], ext)
 
 
 def is_whitespace_or_formatting_change(line):
@@ -92,7 +176,7 @@ def pre_analyze_diff(diff_output):
     return only_comments_or_formatting, needs_llm_analysis
 
 
-def analyze_diff_with_llm(diff_output):
+async def analyze_diff_with_llm(diff_output):
     """
     Uses Azure OpenAI LLM to determine if the diff only involves comments/formatting or changes code.
     Responds exclusively with "YES" or "NO".
@@ -110,37 +194,50 @@ def analyze_diff_with_llm(diff_output):
     {diff_output}
     ```
     """
-    return generate_llm_response(system_prompt, user_prompt)
+    return await generate_llm_response(system_prompt, user_prompt)
 
 
-def generate_llm_response(system_prompt, user_prompt):
+async def generate_llm_response(system_prompt, user_prompt):
     messages = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": user_prompt},
     ]
-    response = azure_openai_client.chat.completions.create(
+    response = await get_azure_openai_client().chat.completions.create(
         model=AZURE_OPENAI_MODEL,
         messages=messages
     )
     return response.choices[0].message.content.strip()
 
 
-def revert_code_changes(filename):
-    """Reverts the entire file to the last Git state."""
+def revert_code_changes(filenames):
+    """Reverts the given files to the last Git state, with as few git calls as possible."""
     if DRY_RUN:
-        logging.info(f"Dry run: Would revert {filename}.")
-    else:
-        logging.info(f"Reverting {filename}...")
-        subprocess.run(["git", "checkout", "--", filename], cwd=BASE_DIR)
+        logging.info(f"Dry run: Would revert {len(filenames)} files.")
+        return
+    logging.info(f"Reverting {len(filenames)} files...")
+    for i in range(0, len(filenames), GIT_BATCH_SIZE):
+        subprocess.run(["git", "checkout", "--", *filenames[i:i + GIT_BATCH_SIZE]], cwd=BASE_DIR)
+
+
+async def check_with_llm(filename, diff_output, semaphore):
+    """Asks the LLM about one file, limited by the semaphore. Returns None if the request fails."""
+    async with semaphore:
+        logging.info(f"Checking {filename} with LLM...")
+        try:
+            return await analyze_diff_with_llm(diff_output)
+        except Exception as e:
+            logging.error(f"***ERROR*** LLM check of {filename} failed: {e}")
+            return None
+
 
 async def process_repository(processing_index):
     """
     Executes the entire workflow:
     1. Identify files in the repository
-    2. Fetch Git diff and check with preliminary analysis
-    3. If unclear, use LLM
+    2. Fetch the Git diff of all files at once and compare the code of each file locally
+    3. If unclear, use LLM (concurrently)
     4. If only comments/formatting were changed → mark file in index
-    5. If actual code was changed → revert file
+    5. If actual code was changed → revert files (in one batch at the end)
     """
     files = get_modified_files()
     logging.info(f"Checking {len(files)} files in the repository:")
@@ -149,35 +246,55 @@ async def process_repository(processing_index):
     for file in files:
         logging.info(f" - {file}")
 
+    diffs = get_git_diffs()
+    staged_versions = get_staged_versions([filename for filename in files if diffs.get(filename)])
     code_changed_files = []  # List for files with code changes
+    llm_candidates = []  # Files that need further analysis by the LLM
+    undecided_files = []  # Files the LLM could not check, neither reverted nor marked
+    decided_locally = 0
     for filename in files:
-        diff_output = get_git_diff(filename)
+        diff_output = diffs.get(filename)
 
         if not diff_output:
             continue  # No changes in this file
 
-        # Local preliminary analysis
-        only_comments_or_formatting, needs_llm_analysis = pre_analyze_diff(diff_output)
+        # Compare the code tokens of both versions, fall back to the line-based preliminary analysis
+        same_code = compare_code_locally(filename, staged_versions.get(filename))
+        if same_code is None:
+            only_comments_or_formatting, needs_llm_analysis = pre_analyze_diff(diff_output)
+        else:
+            only_comments_or_formatting, needs_llm_analysis = same_code, False
+        if not (needs_llm_analysis and USE_LLM_ANALYSIS):
+            decided_locally += 1
 
         if only_comments_or_formatting:
             logging.info(f"Only comments/formatting changed in {filename} – keeping changes.")
             await processing_index.mark_file_processed(filename)  # ✅ Mark file in index
-            continue
-
-        if needs_llm_analysis and USE_LLM_ANALYSIS:
-            logging.info(f"Checking {filename} with LLM...")
-            llm_response = analyze_diff_with_llm(diff_output)
+        elif needs_llm_analysis and USE_LLM_ANALYSIS:
+            llm_candidates.append((filename, diff_output))
         else:
-            llm_response = "NO"
+            logging.info(f"Code changes detected in {filename}.")
+            code_changed_files.append(filename)
 
-        if llm_response == "NO":
+    logging.info(f"Decided {decided_locally} files locally, {len(llm_candidates)} files need LLM analysis.")
+    semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+    llm_responses = await asyncio.gather(
+        *(check_with_llm(filename, diff_output, semaphore) for filename, diff_output in llm_candidates)
+    )
+    for (filename, _), llm_response in zip(llm_candidates, llm_responses):
+        if llm_response is None:
+            logging.warning(f"Could not check {filename} – leaving it unchanged for the next run.")
+            undecided_files.append(filename)
+        elif llm_response == "NO":
             logging.info(f"Code changes detected in {filename}.")
             code_changed_files.append(filename)
-            revert_code_changes(filename)
         else:
             logging.info(f"Only comments/formatting changed in {filename} – keeping changes.")
             await processing_index.mark_file_processed(filename)  # ✅ Mark file in index
 
+    if code_changed_files:
+        revert_code_changes(code_changed_files)
+
     # Output the list of affected files at the end
     if code_changed_files:
         if DRY_RUN:
@@ -186,6 +303,10 @@ async def process_repository(processing_index):
             logging.info(f"{'=' * 100}\nThe following {len(code_changed_files)} files were reverted:\n{chr(10).join(code_changed_files)}\n")
     else:
         logging.info("\nNo files with code changes found.\n")
+    if undecided_files:
+        logging.info(f"The following {len(undecided_files)} files could not be checked and were left unchanged:\n{chr(10).join(undecided_files)}\n")
+
+    await processing_index.close()
 
 
 if __name__ == "__main__":
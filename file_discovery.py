@@ -0,0 +1,138 @@
+import os
+import re
+import logging
+
+
+class FileEntry:
+    """A file found during discovery, with the stat data needed to detect changes."""
+
+    def __init__(self, path, size, mtime_ns):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+
+
+class GitignoreRules:
+    """The compiled patterns of a single `.gitignore` file, relative to its directory."""
+
+    def __init__(self, directory, patterns):
+        self.directory = directory
+        self.patterns = patterns
+
+    @classmethod
+    def load(cls, directory):
+        gitignore_file = os.path.join(directory, ".gitignore")
+        try:
+            with open(gitignore_file, "r", encoding="utf-8", errors="ignore") as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return None
+        patterns = [pattern for pattern in (_compile_gitignore_pattern(line) for line in lines) if pattern]
+        return cls(directory, patterns) if patterns else None
+
+    def match(self, path, is_dir):
+        """Return True (ignored), False (re-included by a negation) or None (no pattern matches)."""
+        relative_path = os.path.relpath(path, self.directory).replace(os.sep, "/")
+        result = None
+        for regex, negated, dir_only in self.patterns:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relative_path):
+                result = not negated
+        return result
+
+
+def _compile_gitignore_pattern(line):
+    line = line.rstrip()
+    if not line or line.startswith("#"):
+        return None
+    negated = line.startswith("!")
+    if negated:
+        line = line[1:]
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    # Patterns with a slash in the middle or at the start are relative to the .gitignore directory
+    anchored = "/" in line
+    line = line.lstrip("/")
+    if not line:
+        return None
+
+    regex = ""
+    position = 0
+    while position < len(line):
+        if line.startswith("**/", position):
+            regex += "(?:.*/)?"
+            position += 3
+        elif line.startswith("/**", position) and position + 3 == len(line):
+            regex += "/.*"
+            position += 3
+        elif line[position] == "*":
+            regex += "[^/]*"
+            position += 1
+        elif line[position] == "?":
+            regex += "[^/]"
+            position += 1
+        elif line[position] == "[" and "]" in line[position + 1:]:
+            end = line.index("]", position + 1)
+            character_class = line[position + 1:end]
+            if character_class.startswith("!"):
+                character_class = "^" + character_class[1:]
+            regex += "[" + character_class + "]"
+            position = end + 1
+        else:
+            regex += re.escape(line[position])
+            position += 1
+    prefix = "" if anchored else "(?:.*/)?"
+    return re.compile(f"^{prefix}{regex}$"), negated, dir_only
+
+
+def _is_gitignored(path, is_dir, gitignore_rules):
+    # Rules of deeper directories take precedence over those of their parents
+    for rules in reversed(gitignore_rules):
+        result = rules.match(path, is_dir)
+        if result is not None:
+            return result
+    return False
+
+
+def iter_files(base_dir, ignored_dirs, respect_gitignore=False, max_size=3 * 1024 * 1024):
+    """
+    Walk the directory tree once with `os.scandir` and yield a `FileEntry` for every file up to `max_size`,
+    as soon as it is found.
+
+    Directories in `ignored_dirs` are never entered. With `respect_gitignore`, files and directories
+    ignored by any `.gitignore` on the way down are skipped as well.
+    """
+    ignored_dirs = set(ignored_dirs)
+    stack = [(base_dir, [])]
+    while stack:
+        directory, gitignore_rules = stack.pop()
+        if respect_gitignore:
+            rules = GitignoreRules.load(directory)
+            if rules:
+                gitignore_rules = gitignore_rules + [rules]
+        try:
+            with os.scandir(directory) as iterator:
+                for entry in iterator:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name in ignored_dirs:
+                            continue
+                        if respect_gitignore and _is_gitignored(entry.path, True, gitignore_rules):
+                            continue
+                        stack.append((entry.path, gitignore_rules))
+                    elif entry.is_file():
+                        if respect_gitignore and _is_gitignored(entry.path, False, gitignore_rules):
+                            continue
+                        stat = entry.stat()
+                        if stat.st_size <= max_size:
+                            yield FileEntry(entry.path, stat.st_size, stat.st_mtime_ns)
+        except OSError as e:
+            logging.error(f'***ERROR*** Error scanning directory "{directory}": {e}')
+
+
+def select_files(entries, extensions, file_pattern):
+    """Select the entries matching the extensions and the file name pattern of a task."""
+    extensions = tuple(extensions)
+    file_name_regex = re.compile(file_pattern)
+    return [entry for entry in entries
+            if entry.path.endswith(extensions) and file_name_regex.match(os.path.basename(entry.path))]
@@ -0,0 +1,106 @@
+import os
+import re
+import mmap
+import codecs
+import chardet
+import logging
+
+# Bytes sampled from the start, the middle and the end of a file instead of reading it as a whole
+SNIFF_SAMPLE_BYTES = 16 * 1024
+# Samples with a higher share of control characters are binary
+BINARY_CONTROL_SHARE = 0.1
+# Samples with a longer average line are minified
+MINIFIED_LINE_LENGTH = 500
+# Generator markers only count in the header of a file
+GENERATED_HEADER_BYTES = 2048
+GENERATED_MARKERS = re.compile(
+    rb"@generated|do not edit|auto-?generated|code generated by|generated by the protocol buffer compiler",
+    re.IGNORECASE,
+)
+# Kinds of content that are not sent to the model (binary;minified;generated, empty keeps all)
+SKIPPED_CONTENT = [kind for kind in os.getenv("SKIPPED_CONTENT", "binary;minified;generated").split(";") if kind]
+
+# Control characters that do not occur in text files
+_BINARY_BYTES = bytes(byte for byte in range(32) if byte not in b"\t\n\r\f\b\x1b") + b"\x7f"
+_CONTINUATION_BYTES = bytes(range(0x80, 0xC0))
+_UTF16_BOMS = (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)
+
+
+class SniffResult:
+    """The encoding detected for a file, or the kind of content it is skipped for."""
+
+    def __init__(self, path, size, mtime_ns, encoding=None, rejection=None):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.encoding = encoding
+        self.rejection = rejection
+
+
+def sniff_file(file_path):
+    """
+    Classify a file by samples of its start, middle and end, mapped with mmap instead of read as a whole.
+
+    Returns a `SniffResult` with the detected encoding, or with the rejection 'binary', 'minified' or
+    'generated' if that kind of content is in `SKIPPED_CONTENT`. Files that cannot be read are logged
+    and `None` is returned.
+    """
+    try:
+        with open(file_path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            if stat.st_size == 0:
+                samples = [b""]
+            else:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    samples = _samples(data, stat.st_size)
+    except (OSError, ValueError) as e:
+        logging.error(f'***ERROR*** Error reading file "{file_path}": {e}')
+        return None
+    encoding, rejection = classify_samples(samples)
+    if rejection not in SKIPPED_CONTENT:
+        rejection = None
+    return SniffResult(file_path, stat.st_size, stat.st_mtime_ns, encoding, rejection)
+
+
+def classify_samples(samples):
+    """`(encoding, rejection)` of a file from its samples, the first one being the start of the file."""
+    head = samples[0]
+    if head.startswith(_UTF16_BOMS):
+        return "utf-16", None
+    if any(b"\x00" in sample or _control_share(sample) > BINARY_CONTROL_SHARE for sample in samples):
+        return None, "binary"
+    encoding = detect_encoding(samples)
+    if GENERATED_MARKERS.search(head[:GENERATED_HEADER_BYTES]):
+        return encoding, "generated"
+    sampled_bytes = sum(len(sample) for sample in samples)
+    if sampled_bytes > 2 * MINIFIED_LINE_LENGTH and \
+            sampled_bytes / (sum(sample.count(b"\n") for sample in samples) + 1) > MINIFIED_LINE_LENGTH:
+        return encoding, "minified"
+    return encoding, None
+
+
+def detect_encoding(samples):
+    """UTF-8 if every sample decodes as UTF-8, otherwise the encoding chardet detects on the samples."""
+    for index, sample in enumerate(samples):
+        if index > 0:
+            # A sample from the middle may start within a multi-byte character
+            sample = sample[3 - len(sample[:3].lstrip(_CONTINUATION_BYTES)):]
+        try:
+            # Not final, a sample may end within a multi-byte character
+            codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        except UnicodeDecodeError:
+            return chardet.detect(b"\n".join(samples)).get("encoding") or "utf-8"
+    return "utf-8"
+
+
+def _samples(data, size):
+    if size <= 3 * SNIFF_SAMPLE_BYTES:
+        return [data[:]]
+    middle = (size - SNIFF_SAMPLE_BYTES) // 2
+    return [data[:SNIFF_SAMPLE_BYTES], data[middle:middle + SNIFF_SAMPLE_BYTES], data[-SNIFF_SAMPLE_BYTES:]]
+
+
+def _control_share(sample):
+    if not sample:
+        return 0.0
+    return (len(sample) - len(sample.translate(None, _BINARY_BYTES))) / len(sample)
@@ -1,59 +1,150 @@
 import os
-import re
-import aiofiles
+import shutil
 import chardet
+import hashlib
 import logging
+import tempfile
+import aiofiles
 
-async def read_file_safely(file_path):
-    """Read file content safely, detecting encoding if needed."""
-    try:
-        async with aiofiles.open(file_path, "r", encoding="utf-8") as file:
-            return await file.read()
-    except UnicodeDecodeError:
-        async with aiofiles.open(file_path, "rb") as file:
-            raw_data = await file.read()
-            detected = chardet.detect(raw_data)
-            encoding = detected.get("encoding", "utf-8") or "utf-8"
-            return raw_data.decode(encoding, errors="ignore")
-
-def get_file_list(base_dir, extensions, ignored_dirs, file_pattern, max_size=3 * 1024 * 1024):
-    """Recursively fetch files matching the given criteria."""
-    file_paths = []
-    for root, dirs, files in os.walk(base_dir):
-        dirs[:] = [d for d in dirs if d not in ignored_dirs]  # Ignore specified directories
-        for file in files:
-            filepath = os.path.join(root, file)
-            if any(file.endswith(ext) for ext in extensions) and re.match(file_pattern, file):
-                if os.path.getsize(filepath) <= max_size:
-                    file_paths.append(filepath)
-    return file_paths
-
-def filter_files_exceeding_token_limit(file_paths, tokenizer, max_tokens, token_rate_limit):
-    """Filter files exceeding the token limit and calculate total token count."""
-    filtered_files = []
-    files_over_limit = 0
-    total_tokens = 0
+from chunking import can_chunk
+from file_sniffing import sniff_file
 
-    for filepath in file_paths:
-        with open(filepath, "r", encoding="utf-8") as file:
-            file_content = file.read()
+# chardet only looks at this many bytes around the first byte that is not UTF-8
+DETECTION_SAMPLE_BYTES = 64 * 1024
+
+class FileRecord:
+    """A candidate file that has been read, decoded and tokenized exactly once."""
+
+    def __init__(self, path, text, encoding, size, mtime_ns, content_hash, token_count):
+        self.path = path
+        self.text = text
+        self.encoding = encoding
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.content_hash = content_hash
+        self.token_count = token_count
+
+
+class AtomicFileWriter:
+    """
+    Async context manager that writes to a temporary file next to the target.
+
+    On success the temporary file is renamed over the target in one atomic step, so readers never
+    see a half-written file. On error the temporary file is removed and the target stays untouched.
+    """
+
+    def __init__(self, target_path):
+        self.target_path = target_path
+        self.temp_path = None
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._file = None
 
-        input_tokens = len(tokenizer.encode(file_content))
+    async def __aenter__(self):
+        directory, filename = os.path.split(self.target_path)
+        file_descriptor, self.temp_path = tempfile.mkstemp(prefix=f".{filename}.", suffix=".tmp", dir=directory or ".")
+        os.close(file_descriptor)
+        self._file = await aiofiles.open(self.temp_path, "wb")
+        return self
 
-        if input_tokens <= max_tokens:
-            filtered_files.append(filepath)
-            total_tokens += input_tokens
+    async def write(self, text):
+        data = text.encode("utf-8")
+        self._hash.update(data)
+        self.size += len(data)
+        await self._file.write(data)
+
+    async def read_written(self):
+        """Read back everything written so far."""
+        await self._file.flush()
+        async with aiofiles.open(self.temp_path, "r", encoding="utf-8") as file:
+            return await file.read()
+
+    @property
+    def content_hash(self):
+        return self._hash.hexdigest()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._file.close()
+        if exc_type is not None:
+            os.remove(self.temp_path)
+            return False
+        if os.path.exists(self.target_path):
+            shutil.copymode(self.target_path, self.temp_path)
         else:
-            files_over_limit += 1
+            # mkstemp creates files readable by the owner only, use the default permissions instead
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(self.temp_path, 0o666 & ~umask)
+        os.replace(self.temp_path, self.target_path)
+        return False
+
 
-    logging.info(f"Number of files exceeding the token limit: {files_over_limit}")
-    logging.info(f"Total number of tokens to be processed upfront: {total_tokens}")
+def decode_content(raw_data, encoding=None):
+    """
+    Decode file content as UTF-8, falling back to the given encoding (sniffed or known from an earlier run)
+    and then to the encoding chardet detects on a sample around the first byte that is not UTF-8.
+    """
+    try:
+        return raw_data.decode("utf-8"), "utf-8"
+    except UnicodeDecodeError as e:
+        if encoding and encoding != "utf-8":
+            try:
+                return raw_data.decode(encoding), encoding
+            except (UnicodeDecodeError, LookupError):
+                pass
+        sample = raw_data[max(0, e.start - DETECTION_SAMPLE_BYTES // 2):e.start + DETECTION_SAMPLE_BYTES // 2]
+        detected = chardet.detect(sample).get("encoding") or "utf-8"
+        return raw_data.decode(detected, errors="ignore"), detected
 
-    estimated_time_minutes = total_tokens / token_rate_limit
-    estimated_time_seconds = estimated_time_minutes * 60
-    logging.info(
-        f"Estimated time based on a quota of {token_rate_limit} tokens/minute: "
-        f"{estimated_time_minutes:.2f} minutes ({estimated_time_seconds:.2f} seconds)"
-    )
+def load_file_record(filepath, tokenizer, encoding=None):
+    """
+    Read, decode and tokenize a single file, e.g. to reload it after it changed during the run.
+    Returns None if the file cannot be read.
+    """
+    return _load_file_record(filepath, tokenizer, encoding)
+
+def load_file_record_batch(file_paths, tokenizer, known_encodings=None):
+    """
+    Read, decode and tokenize a batch of files in the calling thread, e.g. a loader thread of the pipeline.
+
+    Files are sniffed first, so binary, minified and generated files are rejected from samples without
+    being read as a whole. Files with an encoding known from an earlier run (`known_encodings`, path to
+    encoding) are not sniffed again. tiktoken releases the GIL while encoding, so several loader threads
+    tokenize in parallel. Returns the records and the `SniffResult`s of the rejected files.
+    """
+    records = []
+    rejected = []
+    for filepath in file_paths:
+        encoding = (known_encodings or {}).get(filepath)
+        if encoding is None:
+            sniffed = sniff_file(filepath)
+            if sniffed is None:
+                continue
+            if sniffed.rejection:
+                rejected.append(sniffed)
+                continue
+            encoding = sniffed.encoding
+        record = _load_file_record(filepath, tokenizer, encoding)
+        if record is not None:
+            records.append(record)
+    return records, rejected
+
+def _load_file_record(filepath, tokenizer, encoding=None):
+    try:
+        with open(filepath, "rb") as file:
+            stat = os.fstat(file.fileno())
+            raw_data = file.read()
+    except OSError as e:
+        logging.error(f'***ERROR*** Error reading file "{filepath}": {e}')
+        return None
+    text, encoding = decode_content(raw_data, encoding)
+    token_count = len(tokenizer.encode(text, disallowed_special=()))
+    content_hash = hashlib.sha256(raw_data).hexdigest()
+    return FileRecord(filepath, text, encoding, stat.st_size, stat.st_mtime_ns, content_hash, token_count)
 
-    return filtered_files
+def is_within_token_limit(record, max_tokens, max_chunked_tokens=None):
+    """Whether a file fits into one request, or into `max_chunked_tokens` if it can be annotated in chunks."""
+    if record.token_count <= max_tokens:
+        return True
+    return bool(max_chunked_tokens) and record.token_count <= max_chunked_tokens and \
+        can_chunk(os.path.splitext(record.path)[-1])
@@ -0,0 +1,51 @@
+import asyncio
+import logging
+import subprocess
+
+
+class GitHistory:
+    """
+    Keeps annotated versions of files in the git object database of BASE_DIR.
+
+    The blob id of an annotated file is recorded in its index fingerprint, together with the commit
+    checked out at that time. When the file changes later, the blob is the base to find the regions
+    that changed since it was annotated, whether or not the annotated version was ever committed.
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        try:
+            self.head_commit = subprocess.run(["git", "rev-parse", "--verify", "-q", "HEAD"], cwd=base_dir,
+                                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+                                              text=True).stdout.strip() or None
+            self.enabled = True
+        except (OSError, subprocess.CalledProcessError):
+            # No git repository (or one without commits yet)
+            self.head_commit = None
+            self.enabled = False
+
+    async def store(self, file_path):
+        """Write the current content of the file to the object database and return its blob id, `None` on errors."""
+        if not self.enabled:
+            return None
+        output = await self._git("hash-object", "-w", "--no-filters", "--", file_path)
+        return output.decode().strip() if output else None
+
+    async def read(self, blob_id):
+        """The content of a blob, `None` if it is not in the object database."""
+        if not self.enabled or not blob_id:
+            return None
+        return await self._git("cat-file", "blob", blob_id)
+
+    async def _git(self, *args):
+        try:
+            process = await asyncio.create_subprocess_exec("git", *args, cwd=self.base_dir, stdout=subprocess.PIPE,
+                                                           stderr=subprocess.PIPE)
+            stdout, stderr = await process.communicate()
+        except OSError as e:
+            logging.warning(f"git {args[0]} failed: {e}")
+            return None
+        if process.returncode != 0:
+            logging.warning(f"git {args[0]} failed: {stderr.decode(errors='replace').strip()}")
+            return None
+        return stdout
@@ -0,0 +1,111 @@
+import os
+import asyncio
+import logging
+from collections import deque
+
+# A request still running after this multiple of its expected latency gets a duplicate (0 disables hedging)
+HEDGE_LATENCY_MULTIPLE = float(os.getenv("HEDGE_LATENCY_MULTIPLE", "0"))
+# At most this share of all requests is hedged, so that a slow service does not double the load
+HEDGE_MAX_SHARE = 0.1
+MIN_LATENCY_SAMPLES = 20
+LATENCY_SAMPLE_WINDOW = 500
+
+
+class LatencyModel:
+    """
+    Linear model of the latency of a request by its input size: `latency = base + per_char * size`.
+
+    Fitted by least squares over the most recent `window` observations.
+    """
+
+    def __init__(self, window=LATENCY_SAMPLE_WINDOW):
+        self._samples = deque(maxlen=window)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def observe(self, size, latency):
+        self._samples.append((size, latency))
+
+    def coefficients(self):
+        """`(base, per_char)` of the fitted model, `None` without observations."""
+        if not self._samples:
+            return None
+        count = len(self._samples)
+        mean_size = sum(size for size, _ in self._samples) / count
+        mean_latency = sum(latency for _, latency in self._samples) / count
+        variance = sum((size - mean_size) ** 2 for size, _ in self._samples)
+        covariance = sum((size - mean_size) * (latency - mean_latency) for size, latency in self._samples)
+        per_char = max(0.0, covariance / variance) if variance else 0.0
+        base = max(0.0, mean_latency - per_char * mean_size)
+        return base, per_char
+
+    def expected(self, size):
+        """The expected latency in seconds of a request with the given input size, `None` without observations."""
+        coefficients = self.coefficients()
+        if coefficients is None:
+            return None
+        base, per_char = coefficients
+        return base + per_char * size
+
+
+class HedgePolicy:
+    """
+    Hedged requests against stragglers: a request that runs longer than `latency_multiple` times the
+    latency expected for its input size is sent a second time, the first response wins and the other
+    request is cancelled.
+    """
+
+    def __init__(self, latency_multiple=HEDGE_LATENCY_MULTIPLE, max_share=HEDGE_MAX_SHARE,
+                 min_samples=MIN_LATENCY_SAMPLES):
+        self.latency_multiple = latency_multiple
+        self.max_share = max_share
+        self.min_samples = min_samples
+        self.latency_model = LatencyModel()
+        self.requests = 0
+        self.hedged = 0
+
+    @property
+    def enabled(self):
+        return self.latency_multiple > 0
+
+    def hedge_delay(self, size):
+        """Seconds after which a request of this input size is hedged, `None` if it must not be hedged."""
+        if not self.enabled or len(self.latency_model) < self.min_samples:
+            return None
+        if self.hedged >= self.max_share * self.requests:
+            return None
+        return self.latency_multiple * self.latency_model.expected(size)
+
+    async def run(self, size, send):
+        """
+        Run `send(hedged)`, a coroutine function, and hedge it if it becomes a straggler.
+
+        Returns the result of the request that finished first and whether it was the hedge.
+        """
+        self.requests += 1
+        delay = self.hedge_delay(size)
+        if delay is None:
+            return await send(False), False
+
+        primary = asyncio.create_task(send(False))
+        pending = {primary}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return primary.result(), False
+
+            self.hedged += 1
+            logging.info(f"Request running for more than {delay:.1f}s ({self.latency_multiple}x the expected latency), hedging it")
+            hedge = asyncio.create_task(send(True))
+            pending = {primary, hedge}
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # A failed request leaves the race to the other one
+                succeeded = [task for task in done if task.exception() is None]
+                if succeeded or not pending:
+                    winner = succeeded[0] if succeeded else done.pop()
+                    return winner.result(), winner is hedge
+        finally:
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,136 @@
+import json
+import re
+import logging
+
+from code_tokens import has_same_code
+
+# An anchor that does not match its line is searched for this many lines above and below
+ANCHOR_SEARCH_LINES = 5
+
+INSERTION_INSTRUCTIONS = """
+
+### **Output Format: Comment Insertions**:
+Do NOT output the file. The user message contains the file with a line number in front of every line (`<number>| <line>`).
+Output only a JSON object of the form `{"insertions": [{"line": <number>, "position": "before", "anchor": "<code of that line>", "comment": "<comment>"}]}` for the comments to add:
+- `line` is the number of the line the comment belongs to, `anchor` the first 40 characters of that line without indentation.
+- `position` is `before` for comments above the line, or `after` for comments below it (e.g. Python docstrings after the last line of a signature).
+- `comment` is the complete comment including its comment syntax (e.g. `/** ... */`, `#`, `\"\"\"...\"\"\"`), with `\\n` between its lines and without indentation.
+- Never repeat or change existing code or comments. Output `{"insertions": []}` if nothing is to be added.
+"""
+
+
+class Insertion:
+    """A comment to insert before or after a line of the original file."""
+
+    def __init__(self, line, position, anchor, comment):
+        self.line = line
+        self.position = position
+        self.anchor = anchor
+        self.comment = comment
+
+
+def build_numbered_input(text):
+    """Prefix every line with its 1-based line number, so that the model can refer to it."""
+    return "".join(f"{number}| {line}" for number, line in enumerate(text.splitlines(keepends=True), start=1))
+
+
+def parse_insertions(response_text):
+    """Parse the JSON response of the model. Raises `ValueError` if it is not a list of insertions."""
+    response_text = re.sub(r"^```[a-zA-Z0-9]*\n(.*?)\n```$", r"\1", response_text.strip(), flags=re.DOTALL)
+    try:
+        data = json.loads(response_text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Response is not valid JSON: {e}")
+    items = data.get("insertions") if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        raise ValueError("Response does not contain a list of insertions")
+
+    insertions = []
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get("line"), int) or not isinstance(item.get("comment"), str):
+            raise ValueError(f"Malformed insertion: {item}")
+        position = "after" if item.get("position") == "after" else "before"
+        insertions.append(Insertion(item["line"], position, str(item.get("anchor") or ""), item["comment"]))
+    return insertions
+
+
+def apply_insertions(text, insertions, ext):
+    """
+    Insert the comments into the original text, indented like the code they belong to.
+
+    Only lines are added, existing lines are never changed. Insertions whose anchor cannot be
+    found near the given line are dropped. Raises `ValueError` if the result does not keep the
+    original code (e.g. a comment without comment syntax).
+    """
+    lines = text.splitlines(keepends=True)
+    inserted_lines = {}
+    for insertion in insertions:
+        index = _resolve_line(lines, insertion)
+        if index is None:
+            logging.debug(f"Dropping insertion, anchor '{insertion.anchor}' not found near line {insertion.line}")
+            continue
+        if insertion.position == "after":
+            slot, indentation = index + 1, _body_indentation(lines, index)
+        else:
+            slot, indentation = index, _indentation(lines[index])
+        comment_lines = insertion.comment.strip("\n").split("\n")
+        inserted_lines.setdefault(slot, []).extend(
+            (indentation + line if line.strip() else "") + "\n" for line in comment_lines
+        )
+
+    if lines and not lines[-1].endswith("\n") and len(lines) in inserted_lines:
+        lines[-1] += "\n"
+    new_text = "".join(
+        "".join(inserted_lines.get(index, [])) + (lines[index] if index < len(lines) else "")
+        for index in range(len(lines) + 1)
+    )
+    same_code = has_same_code(text, new_text, ext)
+    if same_code is None:
+        # The file cannot be compared as a whole (e.g. because of a regex literal), the comments alone must not be code
+        comments = "".join(line for slot_lines in inserted_lines.values() for line in slot_lines)
+        same_code = has_same_code("", comments, ext) is not False
+    if not same_code:
+        raise ValueError("Inserted comments change the code")
+    return new_text
+
+
+def _resolve_line(lines, insertion):
+    index = insertion.line - 1
+    anchor = insertion.anchor.strip()
+    if not anchor:
+        return index if 0 <= index < len(lines) else None
+    for offset in sorted(range(-ANCHOR_SEARCH_LINES, ANCHOR_SEARCH_LINES + 1), key=abs):
+        candidate = index + offset
+        if 0 <= candidate < len(lines) and lines[candidate].strip().startswith(anchor[:40]):
+            return candidate
+    return None
+
+
+def _indentation(line):
+    return line[:len(line) - len(line.lstrip())]
+
+
+def _body_indentation(lines, index):
+    """Indentation of the first non-blank line below `index`, one level deeper than the line itself at the end of the file."""
+    for line in lines[index + 1:]:
+        if line.strip():
+            return _indentation(line)
+    return _indentation(lines[index]) + "    "
+
+
+async def annotate_with_insertions(record, ext, client, system_prompt):
+    """
+    Ask the model for comment insertions only and apply them to the original file.
+
+    Returns the new content and the tokens of the request. The content is `None` if the
+    response cannot be parsed or applied.
+    """
+    insertion_prompt, numbered_input = system_prompt + INSERTION_INSTRUCTIONS, build_numbered_input(record.text)
+    response, total_tokens = await client.generate_code_response(insertion_prompt, numbered_input, cache=False)
+    try:
+        new_code = apply_insertions(record.text, parse_insertions(response), ext)
+    except ValueError as e:
+        logging.warning(f'"{record.path}": Invalid comment insertions: {e}')
+        return None, total_tokens
+    await client.cache_response(insertion_prompt, numbered_input, response, total_tokens)
+    return new_code, total_tokens
@@ -11,13 +11,20 @@
 
 import asyncio
 import logging
+import argparse
 from dotenv import load_dotenv
 
-from process_files import run_processing_pipeline
-
+# The modules read their settings from the environment on import
 load_dotenv()
 
+from process_files import run_processing_pipeline
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Annotate the source files in BASE_DIR with Azure OpenAI.")
+    parser.add_argument("--plan", action="store_true",
+                        help="only predict the wall time, token spend and best concurrency of the run, without API calls")
+    args = parser.parse_args()
+
     logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
     logging.info("Starting AI-Code-Annotator.")
-    asyncio.run(run_processing_pipeline())
+    asyncio.run(run_processing_pipeline(plan_only=args.plan))
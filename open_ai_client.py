@@ -1,61 +1,234 @@
 import os
 import re
+import time
+import asyncio
 import logging
 
-from openai import AsyncAzureOpenAI
+import openai
 
-class AzureOpenAIClient:
-    def __init__(self):
-        api_key = os.getenv("AZURE_OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("***ERROR*** Missing environment variable: AZURE_OPENAI_API_KEY. Check your .env file or environment settings.")
+from deployment_pool import create_deployment_pool, REQUEST_TIMEOUT_SECONDS
+from hedging import HedgePolicy
+from response_cache import build_cache_key
 
+# Status codes that are retried: timeout, conflict, rate limit and server errors
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+MAX_RETRY_DELAY_SECONDS = 60
+
+class AzureOpenAIClient:
+    def __init__(self, response_cache=None, telemetry=None):
         model_name = os.getenv("AZURE_OPENAI_MODEL_NAME")
-        azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-        azure_deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
-        api_version = os.getenv("AZURE_API_VERSION")
         max_retries = 5
+        deployment_pool = create_deployment_pool()
 
         logging.info("\n===============================")
         logging.info("     Azure AI Client Setup")
         logging.info("===============================")
         logging.info("Azure OpenAI API Key: xxxx")
-        logging.info(f"Azure Endpoint: {azure_endpoint}")
-        logging.info(f"Azure Deployment: {azure_deployment}")
+        for deployment in deployment_pool.deployments:
+            quota = f" ({deployment.tokens_per_minute} tokens/min)" if deployment.tokens_per_minute else ""
+            logging.info(f"Azure Endpoint: {deployment.endpoint} | Deployment: {deployment.deployment}{quota}")
         logging.info(f"Model Name: {model_name}")
-        logging.info(f"API Version: {api_version}")
+        logging.info(f"API Version: {deployment_pool.deployments[0].api_version}")
         logging.info(f"Max Retries: {max_retries}")
+        logging.info(f"Request Timeout: {REQUEST_TIMEOUT_SECONDS}s")
         logging.info("===============================\n")
 
-        self.client = AsyncAzureOpenAI(
-            azure_endpoint=azure_endpoint,
-            azure_deployment=azure_deployment,
-            api_key=api_key,
-            api_version=api_version,
-            max_retries=max_retries
-        )
+        self.deployment_pool = deployment_pool
+        self.max_retries = max_retries
         self.model_name = model_name
+        # Cached responses are shared by all deployments of the pool
+        self.deployment = ",".join(deployment.deployment for deployment in deployment_pool.deployments)
+        self.response_cache = response_cache
+        self.telemetry = telemetry
+        self.hedge_policy = HedgePolicy()
+        if self.hedge_policy.enabled:
+            logging.info(f"Hedging requests after {self.hedge_policy.latency_multiple}x their expected latency")
+
+    async def _create_completion(self, request, **kwargs):
+        """
+        Create a chat completion on the deployment with the most remaining capacity.
+
+        Throttled or failing deployments are taken out of rotation and the request is retried on
+        another one (or on the same one once it is available again). Returns the parsed response
+        (a stream for `stream=True`). Retries, 429 responses, the deployment and the rate-limit
+        headers of the last response are stored in the `request` telemetry fields.
+        """
+        request["started_at"] = time.time()
+        while True:
+            deployment, wait = self.deployment_pool.select()
+            if wait > 0:
+                await asyncio.sleep(min(wait, MAX_RETRY_DELAY_SECONDS))
+                continue
+            request["deployment"] = deployment.name
+            deployment.in_flight += 1
+            try:
+                raw_response = await deployment.client.chat.completions.with_raw_response.create(**kwargs)
+            except (openai.APIConnectionError, openai.APIStatusError) as e:
+                status_code = getattr(e, "status_code", None)
+                request["status_code"] = status_code
+                retryable = isinstance(e, openai.APIConnectionError) or status_code in RETRYABLE_STATUS_CODES
+                if status_code == 429:
+                    request["throttled"] += 1
+                    self.deployment_pool.report_throttled(deployment, self._retry_after(e))
+                elif retryable:
+                    self.deployment_pool.report_failure(deployment)
+                if not retryable or request["retries"] >= self.max_retries:
+                    raise
+                request["retries"] += 1
+                continue
+            finally:
+                deployment.in_flight -= 1
+            request["status_code"] = raw_response.status_code
+            request["ratelimit_remaining_tokens"] = _int_header(raw_response.headers, "x-ratelimit-remaining-tokens")
+            request["ratelimit_remaining_requests"] = _int_header(raw_response.headers, "x-ratelimit-remaining-requests")
+            self.deployment_pool.report_success(deployment, request["ratelimit_remaining_tokens"],
+                                                request["ratelimit_remaining_requests"])
+            return raw_response.parse()
+
+    @staticmethod
+    def _retry_after(error):
+        """The delay in seconds the server asks for, `None` if it does not say."""
+        response = getattr(error, "response", None)
+        if response is None:
+            return None
+        retry_after_ms = _int_header(response.headers, "retry-after-ms")
+        if retry_after_ms is not None:
+            return min(MAX_RETRY_DELAY_SECONDS, retry_after_ms / 1000)
+        retry_after = _int_header(response.headers, "retry-after")
+        if retry_after is not None:
+            return min(MAX_RETRY_DELAY_SECONDS, retry_after)
+        return None
+
+    def _new_request(self, user_input, streamed):
+        return {"model": self.model_name, "deployment": self.deployment, "streamed": streamed,
+                "input_size": len(user_input), "retries": 0, "throttled": 0}
+
+    def _record_request(self, request, status, usage=None, error=None):
+        if not self.telemetry:
+            return
+        request["status"] = status
+        request.setdefault("ended_at", time.time())
+        if usage:
+            request["prompt_tokens"] = usage.prompt_tokens
+            request["completion_tokens"] = usage.completion_tokens
+            request["total_tokens"] = usage.total_tokens
+            details = getattr(usage, "prompt_tokens_details", None)
+            request["cached_tokens"] = getattr(details, "cached_tokens", None) or 0
+        if error:
+            request["error"] = str(error)[:500]
+        self.telemetry.record_request(**request)
+
+    async def generate_code_response(self, system_prompt, user_input, cache=True):
+        """
+        Send prompt to OpenAI, get response, and clean the output. Cached responses cost no tokens.
+
+        With `cache=False`, a new response is not stored in the cache: the caller stores it with
+        `cache_response` once it has accepted the output.
+        """
+        cache_key = None
+        if self.response_cache:
+            cache_key = build_cache_key(system_prompt, user_input, self.model_name, self.deployment)
+            cached = await asyncio.to_thread(self.response_cache.get, cache_key)
+            if cached:
+                self._record_request(self._new_request(user_input, False), "cache")
+                return cached[0], 0
 
-    async def generate_code_response(self, system_prompt, user_input, tokenizer):
-        """Send prompt to OpenAI, get response, and clean the output."""
         messages = [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_input},
         ]
-        response = await self.client.chat.completions.create(
-            model=self.model_name, messages=messages
-        )
+
+        async def send(hedged):
+            request = self._new_request(user_input, False)
+            if hedged:
+                request["hedge"] = True
+            try:
+                response = await self._create_completion(request, model=self.model_name, messages=messages)
+            except asyncio.CancelledError:
+                # The other request of a hedged pair finished first
+                self._record_request(request, "cancelled")
+                raise
+            except Exception as e:
+                self._record_request(request, "error", error=e)
+                raise
+            request["first_byte_at"] = request["ended_at"] = time.time()
+            self._record_request(request, "ok", response.usage)
+            if not request["retries"]:
+                self.hedge_policy.latency_model.observe(len(user_input), request["ended_at"] - request["started_at"])
+            return response
+
+        # Streamed responses are written as they arrive and cannot be raced, only complete responses are hedged
+        response, _ = await self.hedge_policy.run(len(user_input), send)
         llm_response = response.choices[0].message.content.strip()
 
-        input_tokens = sum(
-            [len(tokenizer.encode(message["content"])) for message in messages]
-        )
-        output_tokens = len(tokenizer.encode(llm_response))
-        total_tokens = input_tokens + output_tokens
+        # Use the token accounting of the API instead of re-encoding prompt and response locally
+        total_tokens = response.usage.total_tokens if response.usage else 0
 
         cleaned_text = self._clean_response(llm_response)
+        if cache_key and cache:
+            await asyncio.to_thread(self.response_cache.put, cache_key, cleaned_text, total_tokens)
         return cleaned_text, total_tokens
 
+    async def cache_response(self, system_prompt, user_input, response, total_tokens):
+        """Store a response requested with `cache=False` after its output has been accepted."""
+        if not self.response_cache or not total_tokens:
+            # Without tokens, the response was answered from the cache
+            return
+        cache_key = build_cache_key(system_prompt, user_input, self.model_name, self.deployment)
+        await asyncio.to_thread(self.response_cache.put, cache_key, response, total_tokens)
+
+    async def stream_code_response(self, system_prompt, user_input, writer, max_output_size):
+        """
+        Stream the response into `writer` as it arrives, stripping Markdown code fences on the fly.
+
+        Raises `ValueError` and stops the generation once the output exceeds `max_output_size`
+        characters, which only happens for runaway generations.
+        """
+        cache_key = None
+        if self.response_cache:
+            cache_key = build_cache_key(system_prompt, user_input, self.model_name, self.deployment)
+            cached = await asyncio.to_thread(self.response_cache.get, cache_key)
+            if cached:
+                self._record_request(self._new_request(user_input, True), "cache")
+                await writer.write(cached[0])
+                return 0
+
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_input},
+        ]
+        request = self._new_request(user_input, True)
+        fence_filter = CodeFenceFilter()
+        output_size = 0
+        total_tokens = 0
+        usage = None
+        try:
+            stream = await self._create_completion(
+                request, model=self.model_name, messages=messages, stream=True, stream_options={"include_usage": True}
+            )
+            async with stream:
+                async for chunk in stream:
+                    request.setdefault("first_byte_at", time.time())
+                    if chunk.usage:
+                        usage = chunk.usage
+                        total_tokens = chunk.usage.total_tokens
+                    if not chunk.choices or not chunk.choices[0].delta.content:
+                        continue
+                    content = chunk.choices[0].delta.content
+                    output_size += len(content)
+                    if output_size > max_output_size:
+                        raise ValueError(f"Runaway generation: response exceeded {max_output_size} characters, aborted")
+                    await writer.write(fence_filter.feed(content))
+        except Exception as e:
+            self._record_request(request, "error", usage, error=e)
+            raise
+        self._record_request(request, "ok", usage)
+        await writer.write(fence_filter.finish())
+
+        if cache_key:
+            await asyncio.to_thread(self.response_cache.put, cache_key, await writer.read_written(), total_tokens)
+        return total_tokens
+
     @staticmethod
     def _clean_response(response_text):
         """Cleans response by removing Markdown code blocks and ensuring newline at the end."""
@@ -68,3 +241,44 @@ class AzureOpenAIClient:
             cleaned_text += "\n"
 
         return cleaned_text
+
+
+def _int_header(headers, name):
+    try:
+        return int(float(headers.get(name)))
+    except (TypeError, ValueError):
+        return None
+
+
+class CodeFenceFilter:
+    """
+    Incremental counterpart of `_clean_response` for streamed responses, with exactly the same result.
+
+    A response that does not start with a Markdown fence is passed through as it arrives, only
+    leading whitespace is dropped and trailing whitespace is held back. Whether a fenced response
+    (e.g. "```kotlin") is unwrapped depends on how it ends, so it is buffered and cleaned by
+    `_clean_response` at the end of the stream.
+    """
+
+    def __init__(self):
+        self._pending = ""
+        self._fenced = None
+
+    def feed(self, text):
+        self._pending += text
+        if self._fenced is None:
+            self._pending = self._pending.lstrip()
+            if len(self._pending) < 3 and "```".startswith(self._pending):
+                return ""
+            self._fenced = self._pending.startswith("```")
+        if self._fenced:
+            return ""
+        ready = self._pending.rstrip()
+        self._pending = self._pending[len(ready):]
+        return ready
+
+    def finish(self):
+        tail, self._pending = self._pending, ""
+        if self._fenced is False:
+            return "\n"
+        return AzureOpenAIClient._clean_response(tail.strip())
@@ -0,0 +1,128 @@
+import os
+import re
+import logging
+
+from chunking import restore_surrounding_whitespace
+from code_tokens import has_same_code
+
+# Files up to this size are packed together with other small files of the same task and extension
+PACK_FILE_MAX_TOKENS = int(os.getenv("PACK_FILE_MAX_TOKENS", "1000"))
+# Token budget of the file contents in one packed request
+PACK_MAX_TOKENS = int(os.getenv("PACK_MAX_TOKENS", "6000"))
+MAX_FILES_PER_PACK = 20
+
+PACK_INSTRUCTIONS = """
+
+### **Multiple Files Input**:
+The user message contains several independent files. Each file starts with a line `<<<FILE n START: name>>>` and ends with a line `<<<FILE n END>>>`.
+Apply the instructions above to every file on its own and output every file in the same order, enclosed in exactly the same marker lines.
+Do not output anything outside the markers.
+"""
+
+_FILE_SECTION = re.compile(r"^<<<FILE (\d+) START[^\n]*>>>[ \t]*\n(.*?)^<<<FILE \1 END>>>[ \t]*$", re.MULTILINE | re.DOTALL)
+
+
+class FilePack:
+    """Several small files of the same task and extension that are annotated in a single request."""
+
+    def __init__(self, records, ext):
+        self.records = records
+        self.ext = ext
+        self.token_count = sum(record.token_count for record in records)
+        self.size = sum(record.size for record in records)
+        self.path = f"{records[0].path} (+{len(records) - 1} packed files)"
+
+
+def build_packs(records, max_file_tokens=PACK_FILE_MAX_TOKENS, max_pack_tokens=PACK_MAX_TOKENS):
+    """
+    Group small files of the same extension into packs of at most `max_pack_tokens` tokens.
+
+    Returns the remaining work items in order: a `FilePack` for every group of two or more
+    small files, and the record itself for every other file.
+    """
+    items = []
+    open_packs = {}
+    for record in records:
+        ext = os.path.splitext(record.path)[-1]
+        if record.token_count > max_file_tokens:
+            items.append(record)
+            continue
+        pack = open_packs.get(ext)
+        if pack is None or len(pack) >= MAX_FILES_PER_PACK or \
+                sum(r.token_count for r in pack) + record.token_count > max_pack_tokens:
+            pack = open_packs[ext] = []
+            items.append((ext, pack))
+        pack.append(record)
+    return [_pack_or_record(item) for item in items]
+
+
+def _pack_or_record(item):
+    if not isinstance(item, tuple):
+        return item
+    ext, pack = item
+    return FilePack(pack, ext) if len(pack) > 1 else pack[0]
+
+
+async def annotate_packed(pack, client, system_prompt):
+    """
+    Annotate all files of a pack in one request and split the response into the files.
+
+    Returns the new content per file path and the tokens of the request. Files whose section is
+    missing, duplicated or does not keep the original code are left out of the result.
+    """
+    new_codes = {}
+    pack_prompt, pack_input = system_prompt + PACK_INSTRUCTIONS, _build_pack_input(pack)
+    output, total_tokens = await client.generate_code_response(pack_prompt, pack_input, cache=False)
+    sections = {}
+    for match in _FILE_SECTION.finditer(output):
+        sections.setdefault(int(match.group(1)), []).append(match.group(2))
+
+    for number, record in enumerate(pack.records, start=1):
+        section = sections.get(number)
+        if not section or len(section) > 1:
+            continue
+        new_code = restore_surrounding_whitespace(record.text, _strip_code_fence(section[0]))
+        if _keeps_original_code(record.text, new_code, pack.ext):
+            new_codes[record.path] = new_code
+    logging.info(f"Packed request: {len(new_codes)}/{len(pack.records)} files returned valid output")
+    if len(new_codes) == len(pack.records):
+        # A response with invalid files would be replayed from the cache and fail again
+        await client.cache_response(pack_prompt, pack_input, output, total_tokens)
+    return new_codes, total_tokens
+
+
+def _build_pack_input(pack):
+    return "".join(
+        f"<<<FILE {number} START: {os.path.basename(record.path)}>>>\n{record.text.rstrip()}\n<<<FILE {number} END>>>\n"
+        for number, record in enumerate(pack.records, start=1)
+    )
+
+
+def _strip_code_fence(section):
+    return re.sub(r"^\s*```[a-zA-Z0-9]*\n(.*?)\n```\s*$", r"\1", section, flags=re.DOTALL)
+
+
+def _keeps_original_code(original, new_code, ext):
+    """
+    Whether the output keeps the code. If the texts cannot be compared, all original lines must be kept
+    in order and the added lines must not contain code (or cannot be checked, without a lexer for the extension).
+    """
+    if not new_code.strip():
+        return False
+    same_code = has_same_code(original, new_code, ext)
+    if same_code is not None:
+        return same_code
+    new_lines = [line.strip() for line in new_code.splitlines()]
+    kept = set()
+    position = 0
+    for line in (line.strip() for line in original.splitlines()):
+        if not line:
+            continue
+        while position < len(new_lines) and new_lines[position] != line:
+            position += 1
+        if position == len(new_lines):
+            return False
+        kept.add(position)
+        position += 1
+    added = "".join(line + "\n" for index, line in enumerate(new_lines) if index not in kept)
+    return has_same_code("", added, ext) is not False
@@ -0,0 +1,224 @@
+import os
+import json
+import math
+import logging
+
+from hedging import MIN_LATENCY_SAMPLES
+
+# Latency models of the deployments in BASE_DIR, fitted from the requests of earlier runs (empty disables them)
+THROUGHPUT_MODEL_FILE = os.getenv("THROUGHPUT_MODEL_FILE", "throughput_model.json")
+# Weight of the earlier runs when the requests of a run are added, so that the model follows the service
+MODEL_DECAY = 0.7
+# Assumed without enough earlier requests: seconds per request, per input token and per output token
+DEFAULT_LATENCY_COEFFICIENTS = (1.0, 0.0002, 0.02)
+# Prices per million input and output tokens for the predicted cost (0 leaves the cost out)
+INPUT_TOKEN_PRICE = float(os.getenv("INPUT_TOKEN_PRICE", "0"))
+OUTPUT_TOKEN_PRICE = float(os.getenv("OUTPUT_TOKEN_PRICE", "0"))
+
+_SUMS = ("count", "input", "output", "latency", "input_input", "output_output", "input_output", "input_latency",
+         "output_latency")
+
+
+class LatencyFit:
+    """
+    Least-squares model of the latency of a request by its tokens:
+    `latency = base + per_input * input_tokens + per_output * output_tokens`.
+
+    Only the sums of the fit are kept, so that the requests of all runs can be persisted and merged.
+    """
+
+    def __init__(self, sums=None):
+        self.sums = dict.fromkeys(_SUMS, 0.0)
+        self.sums.update(sums or {})
+
+    def observe(self, input_tokens, output_tokens, latency):
+        for key, value in (("count", 1), ("input", input_tokens), ("output", output_tokens), ("latency", latency),
+                           ("input_input", input_tokens * input_tokens), ("output_output", output_tokens * output_tokens),
+                           ("input_output", input_tokens * output_tokens), ("input_latency", input_tokens * latency),
+                           ("output_latency", output_tokens * latency)):
+            self.sums[key] += value
+
+    def decay(self, factor):
+        self.sums = {key: value * factor for key, value in self.sums.items()}
+
+    def merge(self, other):
+        return LatencyFit({key: self.sums[key] + other.sums[key] for key in _SUMS})
+
+    def coefficients(self):
+        """`(base, per_input, per_output)` of the fit, the defaults with fewer than `MIN_LATENCY_SAMPLES` requests."""
+        sums = self.sums
+        count = sums["count"]
+        if count < MIN_LATENCY_SAMPLES:
+            return DEFAULT_LATENCY_COEFFICIENTS
+        mean_input, mean_output, mean_latency = sums["input"] / count, sums["output"] / count, sums["latency"] / count
+        var_input = sums["input_input"] / count - mean_input ** 2
+        var_output = sums["output_output"] / count - mean_output ** 2
+        cov_input_output = sums["input_output"] / count - mean_input * mean_output
+        cov_input = sums["input_latency"] / count - mean_input * mean_latency
+        cov_output = sums["output_latency"] / count - mean_output * mean_latency
+        determinant = var_input * var_output - cov_input_output ** 2
+        per_input, per_output = -1.0, -1.0
+        if determinant > 1e-9 * max(1.0, var_input * var_output):
+            per_input = (cov_input * var_output - cov_output * cov_input_output) / determinant
+            per_output = (cov_output * var_input - cov_input * cov_input_output) / determinant
+        if per_input < 0 or per_output < 0:
+            # Input and output grow together for annotated files, generating the output dominates the latency
+            per_input = 0.0
+            per_output = max(0.0, cov_output / var_output) if var_output > 0 else 0.0
+        base = max(0.0, mean_latency - per_input * mean_input - per_output * mean_output)
+        return base, per_input, per_output
+
+    def expected(self, input_tokens, output_tokens):
+        base, per_input, per_output = self.coefficients()
+        return base + per_input * input_tokens + per_output * output_tokens
+
+
+class ThroughputModels:
+    """The latency fits of the deployments, persisted as JSON in `model_file`."""
+
+    def __init__(self, model_file=None):
+        self.model_file = model_file
+        self.fits = {}
+
+    def observe_requests(self, records):
+        """Add the successful first attempts of the given telemetry records, after decaying the earlier runs."""
+        observed = {}
+        for record in records:
+            if record.get("status") != "ok" or record.get("retries") or record.get("hedge") or \
+                    record.get("latency") is None or record.get("completion_tokens") is None:
+                continue
+            fit = observed.setdefault(record.get("deployment"), LatencyFit())
+            fit.observe(record.get("prompt_tokens") or 0, record["completion_tokens"], record["latency"])
+        for deployment, fit in observed.items():
+            earlier = self.fits.get(deployment, LatencyFit())
+            earlier.decay(MODEL_DECAY)
+            self.fits[deployment] = earlier.merge(fit)
+        return sum(int(fit.sums["count"]) for fit in observed.values())
+
+    def for_deployments(self, deployments):
+        """The fit of all requests of the given deployments, as requests are spread across them."""
+        fit = LatencyFit()
+        for deployment in deployments:
+            if deployment in self.fits:
+                fit = fit.merge(self.fits[deployment])
+        return fit
+
+    def save(self):
+        if not self.model_file:
+            return
+        temp_file = f"{self.model_file}.tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump({deployment: fit.sums for deployment, fit in self.fits.items()}, f, indent=2)
+        os.replace(temp_file, self.model_file)
+
+
+def load_throughput_models(base_dir, trace_file=None):
+    """
+    The persisted latency models of BASE_DIR. Without persisted models, they are fitted from the
+    telemetry trace of earlier runs, if there is one.
+    """
+    models = ThroughputModels(os.path.join(base_dir, THROUGHPUT_MODEL_FILE) if THROUGHPUT_MODEL_FILE else None)
+    if models.model_file and os.path.exists(models.model_file):
+        try:
+            with open(models.model_file, "r", encoding="utf-8") as f:
+                models.fits = {deployment: LatencyFit(sums) for deployment, sums in json.load(f).items()}
+            return models
+        except (OSError, ValueError, AttributeError) as e:
+            logging.warning(f'Ignoring the unreadable throughput model "{models.model_file}": {e}')
+    if trace_file and os.path.exists(trace_file):
+        records = []
+        with open(trace_file, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        count = models.observe_requests(records)
+        logging.info(f'Fitted the throughput model from {count} requests in "{trace_file}".')
+    return models
+
+
+class RunPlan:
+    """
+    The predicted requests of a run: their tokens and the latency the fit expects for each, and the
+    wall time that results under the concurrency and the quota of the run.
+    """
+
+    def __init__(self, latency_fit, max_concurrency, tokens_per_minute, requests_per_minute):
+        self.latency_fit = latency_fit
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.requests = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def add(self, input_tokens, output_tokens, request_count=1):
+        """Add a job, whose tokens are split into `request_count` requests sent concurrently (the chunks of a file)."""
+        latency = self.latency_fit.expected(input_tokens / request_count, output_tokens / request_count)
+        self.requests += request_count
+        self.input_tokens += input_tokens
+        self.output_tokens += output_tokens
+        self.latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def combined(self, other):
+        plan = RunPlan(self.latency_fit, self.max_concurrency, self.tokens_per_minute, self.requests_per_minute)
+        plan.requests = self.requests + other.requests
+        plan.input_tokens = self.input_tokens + other.input_tokens
+        plan.output_tokens = self.output_tokens + other.output_tokens
+        plan.latency = self.latency + other.latency
+        plan.max_latency = max(self.max_latency, other.max_latency)
+        return plan
+
+    def limits(self):
+        """Seconds the requests take at the given concurrency, under the token and the request quota, and the longest one."""
+        return {
+            "concurrency": self.latency / max(1, self.max_concurrency),
+            "longest request": self.max_latency,
+            "token quota": (self.input_tokens + self.output_tokens) * 60 / self.tokens_per_minute,
+            "request quota": self.requests * 60 / self.requests_per_minute,
+        }
+
+    def wall_time(self):
+        return max(self.limits().values()) if self.requests else 0.0
+
+    def bottleneck(self):
+        limits = self.limits()
+        return max(limits, key=limits.get)
+
+    def recommended_concurrency(self):
+        """The lowest concurrency at which the quota, not the latency of the requests, limits the throughput."""
+        limits = self.limits()
+        quota_time = max(limits["token quota"], limits["request quota"], limits["longest request"])
+        return max(1, math.ceil(self.latency / quota_time)) if quota_time else 1
+
+    def cost(self):
+        return (self.input_tokens * INPUT_TOKEN_PRICE + self.output_tokens * OUTPUT_TOKEN_PRICE) / 1_000_000
+
+    def describe(self):
+        """One line with the predicted requests, tokens, cost and wall time."""
+        if not self.requests:
+            return "no requests"
+        cost = f", cost {self.cost():.2f}" if INPUT_TOKEN_PRICE or OUTPUT_TOKEN_PRICE else ""
+        return (f"{self.requests} requests, {self.input_tokens} input + {self.output_tokens} output tokens{cost}, "
+                f"predicted time {self.wall_time() / 60:.1f} minutes at a concurrency of {self.max_concurrency} "
+                f"(limited by the {self.bottleneck()})")
+
+    def log_recommendation(self):
+        """Log the settings that maximize the throughput under the configured quota."""
+        base, per_input, per_output = self.latency_fit.coefficients()
+        source = "defaults" if self.latency_fit.sums["count"] < MIN_LATENCY_SAMPLES else \
+            f"{int(self.latency_fit.sums['count'])} earlier requests"
+        logging.info(f"Latency model ({source}): {base:.2f}s + {per_input * 1000:.3f}s per 1000 input tokens "
+                     f"+ {per_output * 1000:.2f}s per 1000 output tokens, {self.latency / max(1, self.requests):.1f}s "
+                     f"per request on average")
+        concurrency = self.recommended_concurrency()
+        if concurrency > self.max_concurrency:
+            logging.info(f"MAX_CONCURRENT_REQUESTS={concurrency} would use the quota of "
+                         f"{self.tokens_per_minute} tokens/min, {self.requests_per_minute} requests/min fully.")
+        else:
+            logging.info(f"MAX_CONCURRENT_REQUESTS={concurrency} suffices for the predicted time, the "
+                         f"{self.bottleneck()} limits the run.")
@@ -1,132 +1,793 @@
-import asyncio
 import os
-import aiofiles
+import math
 import time
-import tiktoken
+import asyncio
+import threading
+import contextlib
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
-from file_utils import read_file_safely, get_file_list, filter_files_exceeding_token_limit
-from open_ai_client import AzureOpenAIClient
-from processing_index import filter_files_already_processed, ProcessingIndex
+from chunking import annotate_in_chunks, annotate_regions, can_chunk, split_changed_regions
+from deployment_pool import configured_tokens_per_minute, load_deployment_configs
+from file_discovery import iter_files, select_files
+from git_history import GitHistory
+from file_utils import AtomicFileWriter, decode_content, load_file_record, load_file_record_batch, is_within_token_limit
+from insertions import annotate_with_insertions
+from packing import FilePack, annotate_packed, build_packs
+from planner import RunPlan, load_throughput_models
+from processing_index import processing_state, file_fingerprint, ProcessingIndex, INDEX_BACKEND
+from response_cache import ResponseCache
+from scheduler import RateLimiter, Job, FairJobQueue, PromptWarmup, run_with_rate_limit, PROMPT_CACHE_MIN_TOKENS
+from telemetry import Telemetry, current_job
+from tokenizer import get_tokenizer
 from task_and_prompt_manager import TaskAndPromptManager, get_prompt, get_transformations
+from work_queue import WorkQueue, WORK_POLL_SECONDS, renew_leases_periodically
 
-TOKEN_RATE_LIMIT = 450000
+# Defaults to the sum of the quotas of all deployments in AZURE_OPENAI_DEPLOYMENTS, if they are configured
+TOKEN_RATE_LIMIT = int(os.getenv("TOKEN_RATE_LIMIT", str(configured_tokens_per_minute() or 450000)))
+# Azure grants 6 requests per minute for every 1000 tokens per minute of quota
+REQUEST_RATE_LIMIT = int(os.getenv("REQUEST_RATE_LIMIT", str(TOKEN_RATE_LIMIT * 6 // 1000)))
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "40"))
 MAX_FILE_TOKENS = 12000
+# Tasks with `chunk_oversized_files: true` process files up to this size in chunks of MAX_FILE_TOKENS
+MAX_CHUNKED_FILE_TOKENS = int(os.getenv("MAX_CHUNKED_FILE_TOKENS", "100000"))
+RESPONSE_CACHE_MAX_MB = int(os.getenv("RESPONSE_CACHE_MAX_MB", "512"))
+RESPECT_GITIGNORE = os.getenv("RESPECT_GITIGNORE", "false").lower() == "true"
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "false").lower() == "true"
+# A streamed response is aborted as a runaway generation once it exceeds this multiple of the input size
+MAX_OUTPUT_GROWTH = float(os.getenv("MAX_OUTPUT_GROWTH", "3"))
+MIN_OUTPUT_SIZE_LIMIT = 4000
+# Tasks with `incremental: true` re-annotate the whole file if more than this share of it changed
+INCREMENTAL_MAX_CHANGED_SHARE = float(os.getenv("INCREMENTAL_MAX_CHANGED_SHARE", "0.5"))
 
-async def run_processing_pipeline(batch_size=40):
-    """Run the entire processing pipeline asynchronously in batches."""
-    # Initialize Azure OpenAI Client, Task Manager and Tokenizer
-    client = AzureOpenAIClient()
-    task_and_prompt_manager = TaskAndPromptManager()
-    tokenizer = tiktoken.get_encoding("cl100k_base")
+# Files are discovered, filtered and loaded in batches of this size
+PIPELINE_BATCH_SIZE = 128
+# Batches buffered between two stages of the pipeline
+PIPELINE_QUEUE_BATCHES = 4
+# Jobs loaded ahead of the requests, which bounds the memory of a run and the window of the largest-first order
+PIPELINE_LOOKAHEAD_JOBS = int(os.getenv("PIPELINE_LOOKAHEAD_JOBS", "500"))
+LOADER_THREADS = os.cpu_count() or 1
+
+CONCURRENT_TASKS = os.getenv("CONCURRENT_TASKS", "false").lower() == "true"
+# Start without confirmation, e.g. for benchmarks and scheduled runs
+AUTO_CONFIRM = os.getenv("AUTO_CONFIRM", "false").lower() == "true"
+# The confirmation waits at most this long for the first files to be loaded, to show their plan
+CONFIRMATION_PLAN_SECONDS = 10
+
+_prompt_token_counts = {}
+
+
+class TaskRun:
+    """A task selected for the current run, with its index and the counts of the pipeline stages."""
+
+    def __init__(self, task_name, task, index_file, file_name_pattern, file_extensions, index_backend=INDEX_BACKEND,
+                 dry_run=False):
+        self.task_name = task_name
+        self.task = task
+        self.index_file = index_file
+        self.file_name_pattern = file_name_pattern
+        self.file_extensions = file_extensions
+        self.weight = task.get("weight", 1)
+        self.processing_index = ProcessingIndex(index_file, index_backend, dry_run)
+        self.max_chunked_tokens = MAX_CHUNKED_FILE_TOKENS if task.get("chunk_oversized_files") else None
+        self.planned_files = 0
+        self.remaining_files = 0
+        self.modified_files = 0
+        self.queued_files = 0
+        self.files_over_limit = 0
+        self.files_to_chunk = 0
+        self.files_rejected = 0
+        # The predicted requests of the queued files, see `planner.RunPlan`
+        self.plan = None
+
+
+class FileWriteCoordinator:
+    """
+    Serializes in-place rewrites of the same file by different tasks.
+
+    A task that gets its turn after another task rewrote the file reloads it first. Fingerprints
+    that other tasks recorded for the previous version are moved to the rewritten version, so a
+    file rewritten by a later task does not count as modified by the user in the next run.
+    Rewritten files of incremental tasks are stored in `git_history`.
+    """
+
+    def __init__(self, processing_indexes, git_history=None):
+        self._processing_indexes = processing_indexes
+        self.git_history = git_history
+        self._locks = {}
+
+    def lock(self, file_path):
+        return self._locks.setdefault(file_path, asyncio.Lock())
+
+    async def reload_if_changed(self, record):
+        stat = os.stat(record.path)
+        if (stat.st_size, stat.st_mtime_ns) == (record.size, record.mtime_ns):
+            return record
+        reloaded = await asyncio.to_thread(load_file_record, record.path, get_tokenizer(), record.encoding)
+        return reloaded or record
+
+    def file_rewritten(self, file_path, previous_hash, fingerprint):
+        for processing_index in self._processing_indexes:
+            previous_fingerprint = processing_index.processed_files.get(file_path)
+            if isinstance(previous_fingerprint, dict) and previous_fingerprint.get("hash") == previous_hash:
+                # Keeps the git blob of an incremental task if the rewriting task does not record one
+                processing_index.refresh(file_path, {**previous_fingerprint, **fingerprint})
+
+
+async def run_processing_pipeline(max_concurrency=MAX_CONCURRENT_REQUESTS, plan_only=False):
+    """
+    Run the entire processing pipeline asynchronously under the configured rate limits.
+
+    With `plan_only`, the files are only discovered and loaded to predict the run, no API calls are made.
+    """
+    # Initialize Task Manager, Tokenizer (loaded by the first loader thread) and the latency model of earlier runs
     base_dir, ignored_dirs, task_names = load_base_config()
+    task_and_prompt_manager = TaskAndPromptManager()
+    tokenizer = get_tokenizer()
+    throughput_models = load_throughput_models(base_dir, get_trace_file(base_dir))
+    latency_fit = throughput_models.for_deployments(get_deployment_names(throughput_models))
+    work_queue = None if plan_only else load_work_queue(base_dir)
 
+    task_runs = []
     for task_name, task in task_and_prompt_manager.tasks.items():
         if task_name not in task_names:
             continue
         index_file, file_name_pattern, file_extensions = await load_conf_for_task(base_dir, task_name, task)
-        processing_index = ProcessingIndex(index_file)
+        # Planning only reads the indexes, it must not change them
+        task_run = TaskRun(task_name, task, index_file, file_name_pattern, file_extensions, dry_run=plan_only)
+        task_run.plan = RunPlan(latency_fit, max_concurrency, TOKEN_RATE_LIMIT, REQUEST_RATE_LIMIT)
+        task_runs.append(task_run)
+        print_configuration(base_dir, file_extensions, file_name_pattern, ignored_dirs, index_file, task_name)
 
-        input_file_paths = get_file_list(base_dir, file_extensions, ignored_dirs, file_name_pattern)
-        input_file_paths = filter_files_already_processed(input_file_paths, processing_index)
-        input_file_paths = filter_files_exceeding_token_limit(input_file_paths, tokenizer, MAX_FILE_TOKENS, TOKEN_RATE_LIMIT)
+    if plan_only:
+        await plan_locally(task_runs, tokenizer, base_dir, ignored_dirs)
+        for task_run in task_runs:
+            await task_run.processing_index.close()
+        return
 
-        print_configuration(base_dir, file_extensions, file_name_pattern, ignored_dirs, index_file, task_name, input_file_paths)
+    # Initialize Azure OpenAI Client, openai takes long to import and is not needed for planning
+    from open_ai_client import AzureOpenAIClient
+    task_and_prompt_manager.log_prompts(task_names)
+    response_cache = load_response_cache(base_dir)
+    telemetry = load_telemetry(base_dir)
+    client = AzureOpenAIClient(response_cache, telemetry)
+    rate_limiter = RateLimiter(TOKEN_RATE_LIMIT, REQUEST_RATE_LIMIT)
+    # Tasks with `incremental: true` keep the annotated versions of files in git to re-annotate only what changed later
+    git_history = GitHistory(base_dir) if any(task_run.task.get("incremental") for task_run in task_runs) else None
+    coordinator = FileWriteCoordinator([task_run.processing_index for task_run in task_runs], git_history)
+    if work_queue:
+        await run_as_worker(max_concurrency, rate_limiter, client, task_runs, coordinator, tokenizer, work_queue,
+                            base_dir, ignored_dirs)
+    else:
+        await run_locally(max_concurrency, rate_limiter, client, task_runs, coordinator, tokenizer, base_dir, ignored_dirs)
 
-        if not input_file_paths:
-            logging.info(f"No files to process for task '{task_name}'.")
-            return
+    for task_run in task_runs:
+        await task_run.processing_index.close()
+    if response_cache:
+        response_cache.log_stats()
+        response_cache.close()
+    telemetry.log_report()
+    telemetry.write_prometheus()
+    telemetry.close()
+    if throughput_models.observe_requests(telemetry.records):
+        throughput_models.save()
+    logging.info("All Done!")
+    logging.info("Exiting...")
 
-        # Warn user and wait before starting
-        warn_user_and_wait_before_start(input_file_paths, task_name, base_dir)
+async def run_locally(max_concurrency, rate_limiter, client, task_runs, coordinator, tokenizer, base_dir, ignored_dirs):
+    """
+    Process the files of all tasks in this process, starting with the first files discovered.
 
-        logging.info("=" * 100)
-        logging.info(f"Start processing '{task_name}'...")
-        total_time = await run_in_batches(batch_size, client, input_file_paths, processing_index, task_name, task, tokenizer)
-        logging.info(f"Finished processing '{task_name}' in {total_time:.2f}s")
+    With CONCURRENT_TASKS, the tasks share one pass over the tree and every file is read and tokenized
+    once, even if several tasks process it. Otherwise, each task makes its own pass after the previous one.
+    """
+    async def produce(group, job_queue):
+        await produce_jobs(group, job_queue, discover_unprocessed(group, base_dir, ignored_dirs), tokenizer)
+        log_pipeline_summary(group)
 
-    logging.info("All Done!")
-    logging.info("Exiting...")
+    confirmed = False
+    prompt_warmup = PromptWarmup()
+    for group in ([task_runs] if CONCURRENT_TASKS else [[task_run] for task_run in task_runs]):
+        job_queue = FairJobQueue({task_run.task_name: task_run.weight for task_run in group}, PIPELINE_LOOKAHEAD_JOBS,
+                                 prompt_warmup)
+        producer = asyncio.create_task(produce(group, job_queue))
+        if not confirmed:
+            # The pipeline already discovers and loads the first files while waiting, their plan informs the confirmation
+            if not AUTO_CONFIRM:
+                await wait_for_first_jobs(job_queue, producer)
+            await warn_user_and_wait_before_start({task_run.task_name: None for task_run in task_runs}, base_dir,
+                                                  group, not producer.done())
+            confirmed = True
+        await run_rate_limited(max_concurrency, rate_limiter, client, group, coordinator, job_queue, producer,
+                               f"files in '{base_dir}' as they are discovered")
+
+async def plan_locally(task_runs, tokenizer, base_dir, ignored_dirs):
+    """
+    Predict the run without any API calls: discover and load the files like a run does and log the
+    plan of every task, of the whole run and the concurrency that uses the quota best.
+    """
+    job_queue = FairJobQueue(capacity=PIPELINE_LOOKAHEAD_JOBS)
+    producer = asyncio.create_task(
+        produce_jobs(task_runs, job_queue, discover_unprocessed(task_runs, base_dir, ignored_dirs), tokenizer)
+    )
+    # Nothing is sent, the jobs are already counted by the plans of their tasks
+    while job_queue or not job_queue.closed:
+        await job_queue.wait()
+        while job_queue.ready():
+            job_queue.pop()
+    await producer
+    log_pipeline_summary(task_runs)
+
+    plan = task_runs[0].plan
+    for task_run in task_runs[1:]:
+        plan = plan.combined(task_run.plan)
+    logging.info("=" * 100)
+    logging.info(f"Plan for {', '.join(task_run.task_name for task_run in task_runs)}: {plan.describe()}")
+    if len(task_runs) > 1 and not CONCURRENT_TASKS:
+        wall_time = sum(task_run.plan.wall_time() for task_run in task_runs)
+        logging.info(f"The tasks run one after another in {wall_time / 60:.1f} minutes, "
+                     f"CONCURRENT_TASKS=true runs them together.")
+    if not plan.requests:
+        return
+    plan.log_recommendation()
+    if plan.recommended_concurrency() > PIPELINE_LOOKAHEAD_JOBS:
+        logging.info(f"PIPELINE_LOOKAHEAD_JOBS={plan.recommended_concurrency()} keeps that many requests loaded ahead.")
+
+async def run_as_worker(max_concurrency, rate_limiter, client, task_runs, coordinator, tokenizer, work_queue,
+                        base_dir, ignored_dirs):
+    """
+    Process files claimed from the shared work queue until it is drained.
+
+    Every worker adds the files it discovers, files already in the queue are left as they are.
+    Files leased by other workers are waited for, so that the files of a crashed worker are
+    claimed again once their lease expires.
+    """
+    await asyncio.to_thread(enqueue_unprocessed, task_runs, work_queue, base_dir, ignored_dirs)
+    task_names = [task_run.task_name for task_run in task_runs]
+    file_counts = {task_name: work_queue.counts([task_name]).get("pending", 0) for task_name in task_names}
+    logging.info(f"Worker '{work_queue.worker_id}' joins the work queue '{work_queue.queue_file}'.")
+    await warn_user_and_wait_before_start(file_counts, base_dir)
 
-async def run_in_batches(batch_size, client, input_file_paths, processing_index, task_name, task, tokenizer):
-    # Split the list of files into batches
-    batches = [input_file_paths[i:i + batch_size] for i in range(0, len(input_file_paths), batch_size)]
-    start_total_time = time.time()
-    for batch_index, batch in enumerate(batches):
-        batch_number = batch_index + 1
-        logging.info(f"Batch {batch_number}: Start ({batch_number}/{len(batches)}) - {task_name}")
+    async def skip(items):
+        logging.info(f"Skipping {len(items)} claimed files that are gone, exceed the token limit or are not source code.")
+        await asyncio.to_thread(work_queue.complete, items, "skipped")
 
-        # Use asyncio.gather to run tasks concurrently for the current batch
-        results = await asyncio.gather(
-            *(process_file(filepath, client, task, tokenizer, processing_index) for filepath in batch))
+    # Claim only a few requests ahead, so that the other workers get their share until the end
+    batch_size = max(1, max_concurrency // 2)
+    prompt_warmup = PromptWarmup()
+    renewal = asyncio.create_task(renew_leases_periodically(work_queue))
+    try:
+        while True:
+            job_queue = FairJobQueue({task_run.task_name: task_run.weight for task_run in task_runs}, max_concurrency,
+                                     prompt_warmup)
+            producer = asyncio.create_task(
+                produce_jobs(task_runs, job_queue, claim_batches(task_runs, work_queue, batch_size), tokenizer, skip, loaders=1)
+            )
+            await run_rate_limited(max_concurrency, rate_limiter, client, task_runs, coordinator, job_queue, producer,
+                                   f"files from the work queue '{work_queue.queue_file}'", work_queue)
+            counts = await asyncio.to_thread(work_queue.counts, task_names)
+            # Expired leases count as "leased" and pending files of files leased by others as "pending"
+            if not (counts.get("pending") or counts.get("leased") or counts.get("active")):
+                break
+            logging.info(f"Waiting for {counts.get('active', 0)} files leased by other workers...")
+            await asyncio.sleep(WORK_POLL_SECONDS)
+    finally:
+        renewal.cancel()
+        work_queue.release()
+        work_queue.close()
+    logging.info(f"Work queue drained: {counts.get('done', 0)} files done, {counts.get('skipped', 0)} skipped, "
+                 f"{counts.get('failed', 0)} failed.")
+
+async def run_rate_limited(max_concurrency, rate_limiter, client, task_runs, coordinator, job_queue, producer,
+                           description, work_queue=None):
+    """
+    Process the jobs that the `producer` task puts into `job_queue` with a sliding window of requests
+    admitted by the rate limiter, while the producer is still running.
+
+    With a `work_queue`, the processed files are marked done (or failed) in the shared queue.
+    """
+    task_runs_by_name = {task_run.task_name: task_run for task_run in task_runs}
+    label = ", ".join(task_runs_by_name)
+    logging.info("=" * 100)
+    logging.info(
+        f"Start processing {description} - {label} | "
+        f"Max concurrency: {max_concurrency} | "
+        f"Quota: {rate_limiter.tokens_per_minute} tokens/min, {rate_limiter.requests_per_minute} requests/min"
+    )
 
-        update_times, token_counts = zip(*results)
+    async def worker(job):
+        task_run = task_runs_by_name[job.task_name]
+        current_job.set(job)
+        if isinstance(job.record, FilePack):
+            return await process_pack(job.record, client, task_run.task, task_run.processing_index, coordinator,
+                                      rate_limiter)
+        return await process_file(job.record, client, task_run.task, task_run.processing_index, coordinator)
 
-        update_times = [t for t in update_times if t is not None]
-        token_counts = [tokens for tokens in token_counts if tokens is not None]
+    async def leased_worker(job):
+        records = job.record.records if isinstance(job.record, FilePack) else [job.record]
+        items = [(job.task_name, record.path) for record in records]
+        try:
+            result = await worker(job)
+        except Exception:
+            await asyncio.to_thread(work_queue.fail, items)
+            raise
+        failed_paths = set(result[2]) if len(result) > 2 else set()
+        if failed_paths:
+            await asyncio.to_thread(work_queue.fail, [item for item in items if item[1] in failed_paths])
+        await asyncio.to_thread(work_queue.complete, [item for item in items if item[1] not in failed_paths])
+        return result
 
-        total_files = len(update_times)
-        average_time = sum(update_times) / total_files if total_files > 0 else 0
-        total_tokens_processed = sum(token_counts)
+    try:
+        total_time, stats = await run_with_rate_limit(job_queue, leased_worker if work_queue else worker, rate_limiter,
+                                                      max_concurrency, label)
+    finally:
+        producer.cancel()
+    # Raises the error that stopped the producer, if any
+    await producer
 
+    for task_name, task_stats in stats.items():
         logging.info(
-            f"Batch {batch_number}: Done | Avg Time: {average_time:.2f}s | "
-            f"Files: {total_files} | Tokens: {total_tokens_processed}"
+            f"Finished processing '{task_name}': {task_stats.completed} files ({task_stats.failed} failed) | "
+            f"Avg Time: {task_stats.average_time:.2f}s | Tokens: {task_stats.tokens}"
         )
-    end_total_time = time.time()
-    total_time = end_total_time - start_total_time
+    logging.info(f"Finished processing {label} in {total_time:.2f}s")
     return total_time
 
-def warn_user_and_wait_before_start(input_file_paths, task_name, base_dir):
+async def produce_jobs(task_runs, job_queue, batches, tokenizer, skip=None, loaders=LOADER_THREADS):
+    """
+    Load stage of the pipeline: read, decode and tokenize the batches of `(path, task_runs)` from the async
+    iterator `batches` in a pool of loader threads and put their jobs into `job_queue`.
+
+    Every stage waits while the next one is behind, so only a bounded number of files is held in memory.
+    Files rejected by sniffing are recorded in the indexes, so later runs skip them while they are unchanged.
+    Files that are gone, exceed the token limit or are rejected are passed to the coroutine function `skip`.
+    `job_queue` is closed once all batches are loaded.
+    """
+    loop = asyncio.get_running_loop()
+    selected = asyncio.Queue(PIPELINE_QUEUE_BATCHES)
+    executor = ThreadPoolExecutor(loaders, thread_name_prefix="loader")
+
+    async def select():
+        async for batch in batches:
+            await selected.put(batch)
+        for _ in range(loaders):
+            await selected.put(None)
+
+    async def load():
+        while True:
+            batch = await selected.get()
+            if batch is None:
+                return
+            records, rejected = await loop.run_in_executor(executor, load_file_record_batch, [path for path, _ in batch],
+                                                           tokenizer, known_encodings(batch))
+            await mark_rejected(batch, rejected)
+            jobs, skipped = build_batch_jobs(task_runs, batch, records, tokenizer)
+            if skipped and skip:
+                await skip(skipped)
+            for job in jobs:
+                await job_queue.put(job)
+
+    stages = [asyncio.create_task(select())] + [asyncio.create_task(load()) for _ in range(loaders)]
+    try:
+        await asyncio.gather(*stages)
+    finally:
+        for stage in stages:
+            stage.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+        job_queue.close()
+
+async def discover_unprocessed(task_runs, base_dir, ignored_dirs):
+    """
+    Discovery and filter stages of the pipeline: walk the tree in a thread and yield batches of
+    `(path, task_runs)` for the files that the given tasks still have to process.
+    """
+    loop = asyncio.get_running_loop()
+    discovered = asyncio.Queue(PIPELINE_QUEUE_BATCHES)
+    stopped = threading.Event()
+
+    def hand_over(entries):
+        """Wait while the filter stage is behind. Returns False once the pipeline has stopped."""
+        if stopped.is_set():
+            return False
+        try:
+            handed_over = asyncio.run_coroutine_threadsafe(discovered.put(entries), loop)
+        except RuntimeError:
+            # The event loop is already closed
+            return False
+        while not handed_over.done():
+            if stopped.wait(0.1):
+                handed_over.cancel()
+                return False
+        return True
+
+    def discover():
+        entries = []
+        try:
+            for entry in iter_files(base_dir, ignored_dirs, RESPECT_GITIGNORE):
+                if stopped.is_set():
+                    return
+                entries.append(entry)
+                if len(entries) >= PIPELINE_BATCH_SIZE:
+                    if not hand_over(entries):
+                        return
+                    entries = []
+            hand_over(entries)
+        except Exception as e:
+            logging.error(f'***ERROR*** Error discovering files in "{base_dir}": {e}')
+        finally:
+            hand_over(None)
+
+    threading.Thread(target=discover, name="discovery", daemon=True).start()
+    try:
+        while True:
+            entries = await discovered.get()
+            if entries is None:
+                return
+            # Files touched since they were processed are hashed, which must not block the event loop
+            batch = await asyncio.to_thread(select_unprocessed, task_runs, entries)
+            if batch:
+                yield batch
+    finally:
+        # Stops the discovery thread if the pipeline stops early
+        stopped.set()
+
+async def claim_batches(task_runs, work_queue, batch_size):
+    """Claim stage of a worker: yield batches of `(path, task_runs)` claimed from the shared work queue until none is left."""
+    task_runs_by_name = {task_run.task_name: task_run for task_run in task_runs}
+    while True:
+        items = await asyncio.to_thread(work_queue.claim, list(task_runs_by_name), batch_size)
+        if not items:
+            return
+        batch = {}
+        for task_name, path in items:
+            batch.setdefault(path, []).append(task_runs_by_name[task_name])
+        yield list(batch.items())
+
+def select_unprocessed(task_runs, entries):
+    """Filter stage: `(path, task_runs)` for the entries that at least one of the given tasks still has to process."""
+    selected = {}
+    for task_run in task_runs:
+        for entry in select_files(entries, task_run.file_extensions, task_run.file_name_pattern):
+            task_run.planned_files += 1
+            state = processing_state(entry.path, task_run.processing_index, entry)
+            if state == "processed":
+                continue
+            task_run.remaining_files += 1
+            if state == "modified":
+                task_run.modified_files += 1
+            selected.setdefault(entry.path, []).append(task_run)
+    return list(selected.items())
+
+def enqueue_unprocessed(task_runs, work_queue, base_dir, ignored_dirs):
+    """Add the files the given tasks still have to process to the shared work queue, in batches while walking the tree."""
+    def enqueue(entries):
+        entries_by_path = {entry.path: entry for entry in entries}
+        batch = select_unprocessed(task_runs, entries)
+        for task_run in task_runs:
+            task_entries = [entries_by_path[path] for path, path_task_runs in batch if task_run in path_task_runs]
+            if task_entries:
+                work_queue.enqueue(task_run.task_name, task_entries)
+
+    entries = []
+    for entry in iter_files(base_dir, ignored_dirs, RESPECT_GITIGNORE):
+        entries.append(entry)
+        if len(entries) >= PIPELINE_BATCH_SIZE:
+            enqueue(entries)
+            entries = []
+    enqueue(entries)
+    for task_run in task_runs:
+        logging.info(f"Task '{task_run.task_name}': {task_run.planned_files} files planned, "
+                     f"{task_run.remaining_files} not processed yet ({task_run.modified_files} modified since processing).")
+
+def known_encodings(batch):
+    """The encodings of the files of a batch of `(path, task_runs)` that were processed before, from their index entries."""
+    encodings = {}
+    for path, path_task_runs in batch:
+        for task_run in path_task_runs:
+            fingerprint = task_run.processing_index.processed_files.get(path)
+            if isinstance(fingerprint, dict) and fingerprint.get("encoding") and not fingerprint.get("skipped"):
+                encodings[path] = fingerprint["encoding"]
+    return encodings
+
+async def mark_rejected(batch, rejected):
+    """Record the files of a batch that sniffing rejected as binary, minified or generated in the indexes of their tasks."""
+    task_runs_by_path = dict(batch)
+    for sniffed in rejected:
+        logging.info(f'"{sniffed.path}": Skipping {sniffed.rejection} content')
+        fingerprint = file_fingerprint(sniffed.size, sniffed.mtime_ns, None, encoding=sniffed.encoding,
+                                       skipped=sniffed.rejection)
+        for task_run in task_runs_by_path[sniffed.path]:
+            task_run.files_rejected += 1
+            await task_run.processing_index.mark_file_processed(sniffed.path, fingerprint)
+
+def build_batch_jobs(task_runs, batch, records, tokenizer):
+    """
+    The jobs of the given tasks for a loaded batch of `(path, task_runs)`. Also returns the `(task, path)`
+    items that are skipped because the file is gone, exceeds the token limit or was rejected by sniffing.
+    """
+    records_by_path = {record.path: record for record in records}
+    jobs = []
+    skipped = []
+    for task_run in task_runs:
+        file_records = []
+        for path, path_task_runs in batch:
+            if task_run not in path_task_runs:
+                continue
+            record = records_by_path.get(path)
+            if record is None or not is_within_token_limit(record, MAX_FILE_TOKENS, task_run.max_chunked_tokens):
+                if record is not None:
+                    task_run.files_over_limit += 1
+                skipped.append((task_run.task_name, path))
+                continue
+            if record.token_count > MAX_FILE_TOKENS:
+                task_run.files_to_chunk += 1
+            task_run.queued_files += 1
+            file_records.append(record)
+        task_jobs = build_jobs(task_run, file_records, tokenizer)
+        for job in task_jobs:
+            task_run.plan.add(*split_request_tokens(task_run.task, job.record, tokenizer))
+        jobs.extend(task_jobs)
+    return jobs, skipped
+
+def log_pipeline_summary(task_runs):
+    """Log the counts of the pipeline stages once all files are loaded, with the plan of the queued files."""
+    for task_run in task_runs:
+        if not task_run.queued_files:
+            logging.info(f"No files to process for task '{task_run.task_name}'.")
+            continue
+        logging.info(
+            f"All files of task '{task_run.task_name}' loaded: {task_run.planned_files} files planned, "
+            f"{task_run.planned_files - task_run.remaining_files} already processed, "
+            f"{task_run.modified_files} modified since processing | "
+            f"Queued {task_run.queued_files} files ({task_run.files_to_chunk} processed in chunks), "
+            f"{task_run.files_over_limit} exceeding the token limit, "
+            f"{task_run.files_rejected} binary, minified or generated | {task_run.plan.describe()}"
+        )
+
+def build_jobs(task_run, file_records, tokenizer):
+    """One job per file, or per pack of small files of the same extension for tasks with `pack_small_files: true`."""
+    items = build_packs(file_records) if task_run.task.get("pack_small_files") else file_records
+    jobs = []
+    for item in items:
+        input_tokens, output_tokens, request_count = split_request_tokens(task_run.task, item, tokenizer)
+        file_count = len(item.records) if isinstance(item, FilePack) else 1
+        jobs.append(Job(task_run.task_name, item, input_tokens + output_tokens,
+                        prompt_cache_key(task_run.task, item, tokenizer), request_count, file_count))
+    return jobs
+
+def split_request_tokens(task, record, tokenizer):
+    """
+    Estimate the quota a file (or pack) consumes as `(input_tokens, output_tokens, request_count)`:
+    the system prompt per request plus the file in and (roughly) out again.
+    """
+    prompt_tokens = count_prompt_tokens(get_prompt(task, get_extension(record)), tokenizer)
+    request_count = math.ceil(record.token_count / MAX_FILE_TOKENS)
+    # Comment insertions are a fraction of the file, other responses repeat the whole file
+    output_tokens = record.token_count // 4 if task.get("response_mode") == "insertions" else record.token_count
+    return prompt_tokens * request_count + record.token_count, output_tokens, request_count
+
+def prompt_cache_key(task, record, tokenizer):
+    """The system prompt of a file (or pack), if it is long enough for the prompt cache of the service, `None` otherwise."""
+    system_prompt = get_prompt(task, get_extension(record))
+    return system_prompt if count_prompt_tokens(system_prompt, tokenizer) >= PROMPT_CACHE_MIN_TOKENS else None
+
+def count_prompt_tokens(system_prompt, tokenizer):
+    if system_prompt not in _prompt_token_counts:
+        _prompt_token_counts[system_prompt] = len(tokenizer.encode(system_prompt))
+    return _prompt_token_counts[system_prompt]
+
+def get_extension(record):
+    return record.ext if isinstance(record, FilePack) else os.path.splitext(record.path)[-1]
+
+async def wait_for_first_jobs(job_queue, producer, timeout=CONFIRMATION_PLAN_SECONDS):
+    """Wait until the producer has loaded all files or filled the queue, or for `timeout` seconds."""
+    deadline = time.time() + timeout
+    while not producer.done() and len(job_queue) < job_queue.capacity and time.time() < deadline:
+        await asyncio.sleep(0.1)
+
+async def warn_user_and_wait_before_start(file_counts, base_dir, task_runs=(), loading=False):
+    """
+    Warn before the start with the plans of the given task runs. Counts of `None` are not known yet, as the
+    files are still being discovered, and with `loading` the plans only cover the files loaded so far.
+    """
     # -----------------------------
     # Warnung vor dem Start
     # -----------------------------
     logging.info("*" * 70)
     logging.info("!!!!!!!!!!!!!!!!   W A R N I N G   !!!!!!!!!!!!!!!!")
-    logging.info(f"Task '{task_name}' will process {len(input_file_paths)} files in that directory.\n")
+    for task_name, file_count in file_counts.items():
+        if file_count is None:
+            logging.info(f"Task '{task_name}' will process all files in that directory it has not processed yet.")
+        else:
+            logging.info(f"Task '{task_name}' will process {file_count} files in that directory.")
+    for task_run in task_runs:
+        if task_run.plan.requests:
+            scope = "the files loaded so far" if loading else "all files"
+            logging.info(f"Task '{task_run.task_name}', plan of {scope}: {task_run.plan.describe()}")
+    logging.info("")
 
-    if base_dir.lower().startswith("/app/project"):
+    if AUTO_CONFIRM:
+        logging.info("AUTO_CONFIRM is set, starting without confirmation.")
+    elif base_dir.lower().startswith("/app/project"):
         logging.info("Running in Docker container, waiting for 20 seconds...")
         logging.info("Kill the container, if you want to abort!!!")
-        time.sleep(20)
+        await asyncio.sleep(20)
     else:
-        input("Press Enter to continue or CMD + C to abort...")
+        await wait_for_enter("Press Enter to continue or CMD + C to abort...")
 
-async def process_file(filepath, client, task, tokenizer, processing_index):
-    """Process a file asynchronously, send it to OpenAI, and save output."""
-    filename = os.path.basename(filepath)
-    ext = os.path.splitext(filename)[-1]
-    system_prompt = get_prompt(task, ext)
+async def wait_for_enter(prompt):
+    """`input(prompt)` in a daemon thread, so that the event loop keeps running and CMD + C does not wait for the thread."""
+    loop = asyncio.get_running_loop()
+    entered = loop.create_future()
+
+    def read_input():
+        try:
+            input(prompt)
+            loop.call_soon_threadsafe(entered.set_result, None)
+        except Exception as e:
+            loop.call_soon_threadsafe(entered.set_exception, e)
 
-    # Read file content
-    file_content = await read_file_safely(filepath)
+    threading.Thread(target=read_input, name="confirmation", daemon=True).start()
+    await entered
+
+async def process_file(record, client, task, processing_index, coordinator):
+    """Process a loaded file asynchronously, send it to OpenAI, and save output."""
+    filepath = record.path
+    output_path = get_output_path(task, filepath)
+
+    if output_path != filepath:
+        update_time, total_tokens, content_hash = await process_and_save(record, output_path, client, task)
+        await mark_processed(record, output_path, content_hash, task, processing_index, coordinator)
+    else:
+        # Other tasks may rewrite the same file, so only one task at a time works on the latest content
+        async with coordinator.lock(filepath):
+            record = await coordinator.reload_if_changed(record)
+            base_text = await load_incremental_base(record, task, processing_index, coordinator.git_history)
+            update_time, total_tokens, content_hash = await process_and_save(record, output_path, client, task, base_text)
+            await mark_processed(record, output_path, content_hash, task, processing_index, coordinator)
+
+    logging.info(f'"{os.path.basename(filepath)}": Update time {update_time:.2f} seconds for {total_tokens} tokens')
+    return update_time, total_tokens
 
-    # Send request to OpenAI
+async def process_pack(pack, client, task, processing_index, coordinator, rate_limiter):
+    """
+    Process several small files in one request. Files missing from the response are sent on their own,
+    concurrently and charged to the rate limiter. Returns the time, the tokens and the paths of the
+    files that failed.
+    """
     start_time = time.time()
-    new_code, total_tokens = await client.generate_code_response(system_prompt, file_content, tokenizer)
+    system_prompt = get_prompt(task, pack.ext)
+    in_place_paths = sorted(record.path for record in pack.records if get_output_path(task, record.path) == record.path)
+
+    async def save(record, new_code):
+        """Write one file of the pack, or send it on its own. Returns the tokens of the extra request."""
+        output_path = get_output_path(task, record.path)
+        tokens = 0
+        if new_code is not None:
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            async with AtomicFileWriter(output_path) as writer:
+                await writer.write(new_code)
+            content_hash = writer.content_hash
+        else:
+            logging.warning(f'"{record.path}": Missing or invalid in the packed response, sending it on its own')
+            estimated_tokens = sum(split_request_tokens(task, record, get_tokenizer())[:2])
+            await rate_limiter.acquire(estimated_tokens)
+            _, tokens, content_hash = await process_and_save(record, output_path, client, task)
+            # The tokens of the request are part of the pack's tokens, which are settled once the job finishes
+            rate_limiter.settle(estimated_tokens, 0)
+        await mark_processed(record, output_path, content_hash, task, processing_index, coordinator)
+        return tokens
+
+    async with contextlib.AsyncExitStack() as stack:
+        # Lock in a fixed order, so that packs of different tasks cannot deadlock
+        for filepath in in_place_paths:
+            await stack.enter_async_context(coordinator.lock(filepath))
+        pack = FilePack([await coordinator.reload_if_changed(record) if record.path in in_place_paths else record
+                         for record in pack.records], pack.ext)
+        new_codes, total_tokens = await annotate_packed(pack, client, system_prompt)
+
+        results = await asyncio.gather(*(save(record, new_codes.get(record.path)) for record in pack.records),
+                                       return_exceptions=True)
+
+    failed_paths = []
+    for record, result in zip(pack.records, results):
+        if isinstance(result, BaseException):
+            logging.error(f'***ERROR*** Error processing file "{record.path}": {result}')
+            failed_paths.append(record.path)
+        else:
+            total_tokens += result
     update_time = time.time() - start_time
+    logging.info(f'"{pack.path}": Update time {update_time:.2f} seconds for {total_tokens} tokens'
+                 + (f", {len(failed_paths)} files failed" if failed_paths else ""))
+    return update_time, total_tokens, failed_paths
+
+async def mark_processed(record, output_path, content_hash, task, processing_index, coordinator):
+    """Record the processed file in the index, with the state of the file after processing if it was rewritten."""
+    if output_path != record.path:
+        # Update processing index with the state of the source file
+        await processing_index.mark_file_processed(record.path, file_fingerprint(record.size, record.mtime_ns, record.content_hash,
+                                                                                 encoding=record.encoding))
+    else:
+        # Update processing index with the state of the source file after processing
+        stat = os.stat(record.path)
+        blob, commit = None, None
+        if task.get("incremental") and coordinator.git_history:
+            # The annotated version is the base for re-annotating only what changes later
+            blob = await coordinator.git_history.store(record.path)
+            commit = coordinator.git_history.head_commit
+        # Rewritten files are written as UTF-8
+        fingerprint = file_fingerprint(stat.st_size, stat.st_mtime_ns, content_hash, blob, commit, encoding="utf-8")
+        coordinator.file_rewritten(record.path, record.content_hash, fingerprint)
+        await processing_index.mark_file_processed(record.path, fingerprint)
 
-    # Modify file paths based on transformation rules
+def get_output_path(task, filepath):
+    """Modify file paths based on transformation rules."""
     output_path = filepath
     for rule in get_transformations(task):
         output_path = output_path.replace(rule["match"], rule["replace"])
+    return output_path
 
-    try:
-        # If output path is different, create the directory if it doesn't exist
-        output_directory = os.path.dirname(output_path)
-        if not os.path.exists(output_directory):
-            os.makedirs(output_directory)
-
-        # Save output in a new file or overwrite existing file
-        async with aiofiles.open(output_path, "w", encoding="utf-8") as file:
-            await file.write(new_code)
-        # Update processing index
-        await processing_index.mark_file_processed(filepath)
-    except Exception as e:
-        logging.error(f'***ERROR*** Error saving file "{output_path}": {e}')
-
-    logging.info(f'"{filename}": Update time {update_time:.2f} seconds for {total_tokens} tokens')
-    return update_time, total_tokens
+async def load_incremental_base(record, task, processing_index, git_history):
+    """The annotated version of a file modified since it was processed by a task with `incremental: true`, or `None`."""
+    if not task.get("incremental") or not git_history or not can_chunk(os.path.splitext(record.path)[-1]):
+        return None
+    fingerprint = processing_index.processed_files.get(record.path)
+    if not isinstance(fingerprint, dict) or not fingerprint.get("blob"):
+        return None
+    data = await git_history.read(fingerprint["blob"])
+    return decode_content(data)[0] if data is not None else None
+
+def find_changed_regions(record, ext, base_text):
+    """The changed declarations of a file to re-annotate, `None` to re-annotate the whole file instead."""
+    regions = split_changed_regions(base_text, record.text, ext, MAX_FILE_TOKENS, record.token_count)
+    if regions is None:
+        return None
+    changed_share = sum(len(region.text) for region in regions) / max(1, len(record.text))
+    if changed_share > INCREMENTAL_MAX_CHANGED_SHARE:
+        return None
+    logging.info(f'"{record.path}": Re-annotating {len(regions)} changed regions ({changed_share:.0%} of the file)')
+    return regions
+
+async def process_and_save(record, output_path, client, task, base_text=None):
+    """
+    Send a file to OpenAI and save the output atomically. Returns the time, the tokens and the output hash.
+
+    With the `base_text` of an earlier annotation, only the declarations changed since then are sent.
+    """
+    ext = os.path.splitext(record.path)[-1]
+    system_prompt = get_prompt(task, ext)
+    regions = find_changed_regions(record, ext, base_text) if base_text is not None else None
+
+    # If output path is different, create the directory if it doesn't exist
+    output_directory = os.path.dirname(output_path)
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+
+    # Send request to OpenAI and save output in a new file or overwrite existing file (atomically)
+    start_time = time.time()
+    async with AtomicFileWriter(output_path) as writer:
+        if regions is not None:
+            new_code, total_tokens = await annotate_regions(record, ext, client, system_prompt, regions) if regions \
+                else (record.text, 0)
+            await writer.write(new_code)
+        elif record.token_count > MAX_FILE_TOKENS:
+            new_code, total_tokens = await annotate_in_chunks(record, ext, client, system_prompt, MAX_FILE_TOKENS)
+            await writer.write(new_code)
+        elif task.get("response_mode") == "insertions":
+            new_code, total_tokens = await annotate_with_insertions(record, ext, client, system_prompt)
+            if new_code is None:
+                # Fall back to the whole file, so that an unusable response does not block the file
+                new_code, file_tokens = await client.generate_code_response(system_prompt, record.text)
+                total_tokens += file_tokens
+            await writer.write(new_code)
+        elif STREAM_RESPONSES:
+            max_output_size = int(len(record.text) * MAX_OUTPUT_GROWTH) + MIN_OUTPUT_SIZE_LIMIT
+            total_tokens = await client.stream_code_response(system_prompt, record.text, writer, max_output_size)
+        else:
+            new_code, total_tokens = await client.generate_code_response(system_prompt, record.text)
+            await writer.write(new_code)
+    update_time = time.time() - start_time
+    return update_time, total_tokens, writer.content_hash
 
 def load_base_config():
     # Load configuration from environment variables
@@ -140,6 +801,29 @@ def load_base_config():
 
     return base_dir, ignored_dirs, task_names
 
+def load_response_cache(base_dir):
+    """Open the on-disk response cache, unless it is disabled with RESPONSE_CACHE_MAX_MB=0."""
+    if RESPONSE_CACHE_MAX_MB <= 0:
+        return None
+    cache_file = os.path.join(base_dir, os.getenv("RESPONSE_CACHE_FILE", "response_cache.sqlite"))
+    return ResponseCache(cache_file, RESPONSE_CACHE_MAX_MB * 1024 * 1024)
+
+def load_telemetry(base_dir):
+    """Create the request telemetry with the trace and Prometheus files from the environment (empty disables them)."""
+    prometheus_file = os.getenv("TELEMETRY_PROMETHEUS_FILE", "")
+    return Telemetry(get_trace_file(base_dir), os.path.join(base_dir, prometheus_file) if prometheus_file else None)
+
+def get_trace_file(base_dir):
+    trace_file = os.getenv("TELEMETRY_TRACE_FILE", "telemetry_trace.jsonl")
+    return os.path.join(base_dir, trace_file) if trace_file else None
+
+def get_deployment_names(throughput_models):
+    """The configured deployments, or all deployments with a model if none is configured (e.g. for planning)."""
+    try:
+        return [config["name"] for config in load_deployment_configs()]
+    except ValueError:
+        return list(throughput_models.fits)
+
 async def load_conf_for_task(base_dir, task_name, task):
     index_file = base_dir + task_name + "_" + os.getenv("INDEX_FILE", "project_index.json")
     file_name_pattern = task.get("file_name_pattern", ".*")
@@ -148,7 +832,19 @@ async def load_conf_for_task(base_dir, task_name, task):
             raise ValueError(f"***ERROR*** Missing file_extensions for task '{task_name}. Check your yaml file.")
     return index_file, file_name_pattern, file_extensions
 
-def print_configuration(base_dir, file_extensions, file_name_pattern, ignored_dirs, index_file, task_name, input_file_paths):
+def load_work_queue(base_dir):
+    """Open the shared work queue if WORK_QUEUE_FILE is set, which makes this process one of several workers."""
+    queue_file = os.getenv("WORK_QUEUE_FILE")
+    if not queue_file:
+        return None
+    if INDEX_BACKEND != "sqlite":
+        # Workers write the same indexes, which only the SQLite backend supports. Switching the backend
+        # silently would hide the entries of the workers from later runs with the journal backend.
+        raise ValueError("***ERROR*** WORK_QUEUE_FILE requires INDEX_BACKEND=sqlite. Set it for the workers "
+                         "and for all later runs on the same project.")
+    return WorkQueue(os.path.join(base_dir, queue_file), os.getenv("WORKER_ID"))
+
+def print_configuration(base_dir, file_extensions, file_name_pattern, ignored_dirs, index_file, task_name):
     # Konfigurationsübersicht ausgeben
     logging.info("\n===============================")
     logging.info(f"   {task_name} CONFIGURATION")
@@ -157,8 +853,5 @@ def print_configuration(base_dir, file_extensions, file_name_pattern, ignored_di
     logging.info(f"INDEX_FILE: {index_file}")
     logging.info(f"FILE_EXTENSIONS: {file_extensions}")
     logging.info(f"FILE_NAME_PATTERN: {file_name_pattern}")
-    logging.info(f"IGNORED_DIRS: {ignored_dirs}\n")
-    logging.info(f"In total {len(input_file_paths)} files found for task '{task_name}'.")
-    logging.info(f"The first 10 paths:\n{chr(10).join(input_file_paths[:10])}\n...")
+    logging.info(f"IGNORED_DIRS: {ignored_dirs}")
     logging.info("===============================\n")
-
@@ -1,42 +1,285 @@
 import os
 import json
-import aiofiles
+import time
+import hashlib
+import asyncio
+import sqlite3
 import logging
+import threading
+
+INDEX_BACKEND = os.getenv("INDEX_BACKEND", "journal")
+INDEX_COMMIT_BATCH_SIZE = int(os.getenv("INDEX_COMMIT_BATCH_SIZE", "20"))
+INDEX_COMMIT_INTERVAL_SECONDS = float(os.getenv("INDEX_COMMIT_INTERVAL_SECONDS", "1"))
+INDEX_COMPACTION_THRESHOLD = 1000
+
+
+class JournalIndexBackend:
+    """
+    Stores the index as a JSON snapshot plus an append-only journal of newer entries.
+
+    Every commit only appends (and fsyncs) the new entries to `<index_file>.journal`. A torn last
+    line left behind by a crash is discarded on load. Compaction writes a new snapshot next to the old one
+    and atomically replaces it, so the snapshot itself is never observed half-written.
+    """
+
+    def __init__(self, index_file, read_only=False):
+        self.index_file = index_file
+        self.journal_file = index_file + ".journal"
+        self.journal_entries = 0
+        self.read_only = read_only
+
+    def load(self):
+        processed_files = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file, "r") as f:
+                try:
+                    processed_files = json.load(f)
+                except json.JSONDecodeError as e:
+                    logging.error(f"***ERROR*** Error loading index file '{self.index_file}': {e}. Starting fresh.")
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file, "rb") as f:
+                journal = f.read()
+            complete_length = journal.rfind(b"\n") + 1
+            if complete_length < len(journal) and not self.read_only:
+                # Cut off the torn last line so that new entries start on a fresh line
+                logging.warning(f"Discarding incomplete entry at the end of index journal '{self.journal_file}'.")
+                with open(self.journal_file, "r+b") as f:
+                    f.truncate(complete_length)
+            for line in journal[:complete_length].splitlines():
+                try:
+                    file_path, value = json.loads(line)
+                except (json.JSONDecodeError, ValueError):
+                    logging.warning(f"Skipping corrupt entry in index journal '{self.journal_file}'.")
+                    continue
+                processed_files[file_path] = value
+                self.journal_entries += 1
+        return processed_files
+
+    def append(self, entries):
+        with open(self.journal_file, "a") as f:
+            f.write("".join(json.dumps([file_path, value]) + "\n" for file_path, value in entries))
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_entries += len(entries)
+
+    def needs_compaction(self, processed_files):
+        return self.journal_entries > max(INDEX_COMPACTION_THRESHOLD, len(processed_files))
+
+    def compact(self, processed_files):
+        temp_file = self.index_file + ".tmp"
+        with open(temp_file, "w") as f:
+            json.dump(processed_files, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, self.index_file)
+        # Replaying the journal on top of the new snapshot is idempotent, so a crash before the
+        # journal is truncated does not lose or corrupt anything.
+        open(self.journal_file, "w").close()
+        self.journal_entries = 0
+
+    def close(self):
+        pass
+
+
+class SqliteIndexBackend:
+    """Stores the index in an SQLite database in WAL mode, one row per processed file."""
+
+    def __init__(self, index_file, read_only=False):
+        self.legacy_index_file = index_file if index_file.endswith(".json") else None
+        self.index_file = os.path.splitext(index_file)[0] + ".sqlite"
+        self.read_only = read_only
+        self.connection = None
+        if read_only:
+            if os.path.exists(self.index_file):
+                self.connection = sqlite3.connect(f"file:{self.index_file}?mode=ro", uri=True, check_same_thread=False)
+            return
+        self.connection = sqlite3.connect(self.index_file, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS processed_files (path TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.connection.commit()
+
+    def load(self):
+        rows = self.connection.execute("SELECT path, value FROM processed_files").fetchall() if self.connection else []
+        if not rows and self.legacy_index_file and os.path.exists(self.legacy_index_file):
+            legacy_backend = JournalIndexBackend(self.legacy_index_file, self.read_only)
+            processed_files = legacy_backend.load()
+            if not self.read_only:
+                logging.info(f"Importing legacy index file '{self.legacy_index_file}' into '{self.index_file}'.")
+                self.append(processed_files.items())
+            return processed_files
+        return {file_path: json.loads(value) for file_path, value in rows}
+
+    def append(self, entries):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO processed_files (path, value) VALUES (?, ?)",
+                [(file_path, json.dumps(value)) for file_path, value in entries]
+            )
+
+    def needs_compaction(self, processed_files):
+        return False
+
+    def compact(self, processed_files):
+        self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+
+
+INDEX_BACKENDS = {
+    "journal": JournalIndexBackend,
+    "sqlite": SqliteIndexBackend,
+}
 
 
 class ProcessingIndex:
-    processed_files = {}
+    """
+    Keeps track of processed files in memory and persists them through a pluggable backend.
+
+    Lookups are served from the in-memory `processed_files` dict. New entries are committed to
+    the backend in batches (every `INDEX_COMMIT_BATCH_SIZE` entries or `INDEX_COMMIT_INTERVAL_SECONDS`),
+    call `close()` at the end of a run to commit the rest. `refresh()` is also called from the
+    threads that select unprocessed files, so the entries are only changed under `_entries_lock`.
+    """
 
-    def __init__(self, index_file):
-        """Load the index file and return a dictionary of processed files."""
+    def __init__(self, index_file, backend=INDEX_BACKEND, dry_run=False):
+        """
+        Load the index file and return a dictionary of processed files. With `dry_run`, the index is
+        only read: entries are neither changed nor written.
+        """
+        if backend not in INDEX_BACKENDS:
+            raise ValueError(f"***ERROR*** Unknown INDEX_BACKEND '{backend}'. Use one of: {', '.join(INDEX_BACKENDS)}.")
         index_directory = os.path.dirname(index_file)
-        if index_directory and not os.path.exists(index_directory):
+        if index_directory and not os.path.exists(index_directory) and not dry_run:
             os.makedirs(index_directory)
 
-        if os.path.exists(index_file):
-            with open(index_file, "r") as f:
-                try:
-                    self.processed_files = json.load(f)
-                except json.JSONDecodeError as e:
-                    logging.error("***ERROR*** Error loading index file. Starting fresh.", e)
-                    self.processed_files = {}
         self.index_file = index_file
+        self.dry_run = dry_run
+        self._backend = INDEX_BACKENDS[backend](index_file, dry_run)
+        self.processed_files = self._backend.load()
+        self._pending_entries = []
+        self._last_commit = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._entries_lock = threading.Lock()
 
-    async def mark_file_processed(self, file_path):
+    async def mark_file_processed(self, file_path, value=True):
         """Mark a file as processed in the index."""
-        self.processed_files[file_path] = True
-        async with aiofiles.open(self.index_file, "w") as f:
-            await f.write(json.dumps(self.processed_files))
+        self.refresh(file_path, value)
+        if len(self._pending_entries) >= INDEX_COMMIT_BATCH_SIZE or \
+                time.monotonic() - self._last_commit >= INDEX_COMMIT_INTERVAL_SECONDS:
+            await self.commit()
+
+    def refresh(self, file_path, value):
+        """Update the entry of a file without forcing a commit, e.g. after it was touched but not changed."""
+        if self.dry_run:
+            return
+        with self._entries_lock:
+            self.processed_files[file_path] = value
+            self._pending_entries.append((file_path, value))
+
+    def snapshot(self):
+        """A copy of all entries, safe to iterate while other threads refresh entries."""
+        with self._entries_lock:
+            return dict(self.processed_files)
+
+    async def commit(self):
+        """Persist all pending entries and compact the backend if it has grown too large."""
+        async with self._lock:
+            with self._entries_lock:
+                entries, self._pending_entries = self._pending_entries, []
+            self._last_commit = time.monotonic()
+            if entries:
+                await asyncio.to_thread(self._backend.append, entries)
+            if self._backend.needs_compaction(self.processed_files):
+                await asyncio.to_thread(self._backend.compact, self.snapshot())
 
+    async def close(self):
+        """Commit pending entries, compact the backend and release it."""
+        if self.dry_run:
+            self._backend.close()
+            return
+        await self.commit()
+        async with self._lock:
+            await asyncio.to_thread(self._backend.compact, self.snapshot())
+            self._backend.close()
 
-def filter_files_already_processed(file_paths, processing_index):
-    """Filter out already processed files from the file list."""
+
+def file_fingerprint(size, mtime_ns, content_hash, blob=None, commit=None, encoding=None, skipped=None):
+    """
+    The index entry of a processed file: the state it had after processing, its encoding and, for
+    incremental tasks, the git blob of that state and the commit checked out at that time. Files
+    skipped for their content (`skipped`, e.g. 'binary') are recorded without hashing them.
+    """
+    fingerprint = {"size": size, "mtime_ns": mtime_ns, "hash": content_hash}
+    if encoding:
+        fingerprint["encoding"] = encoding
+    if skipped:
+        fingerprint["skipped"] = skipped
+    if blob:
+        fingerprint["blob"] = blob
+        fingerprint["commit"] = commit
+    return fingerprint
+
+
+def filter_files_already_processed(file_paths, processing_index, file_entries=None):
+    """
+    Filter out already processed files from the file list.
+
+    Entries with a fingerprint are only skipped while the file is unchanged: size and mtime are
+    compared first (from `file_entries` if given, a dict of path to `FileEntry`), and the content
+    hash only if they differ. Files modified after processing are queued again.
+    """
     initial_file_count = len(file_paths)
-    file_paths = [fp for fp in file_paths if not processing_index.processed_files.get(fp, False)]
-    remaining_file_count = len(file_paths)
+    remaining_file_paths = []
+    modified_file_count = 0
+    for file_path in file_paths:
+        state = processing_state(file_path, processing_index, file_entries.get(file_path) if file_entries else None)
+        if state != "processed":
+            remaining_file_paths.append(file_path)
+        if state == "modified":
+            modified_file_count += 1
+    remaining_file_count = len(remaining_file_paths)
 
     logging.info(f"Planned {initial_file_count} files")
     logging.info(f"Total remaining files: {remaining_file_count}")
     logging.info(f"Already processed: {initial_file_count - remaining_file_count} files")
+    if modified_file_count:
+        logging.info(f"Modified since processing (queued again): {modified_file_count} files")
+
+    return remaining_file_paths
+
+
+def processing_state(file_path, processing_index, entry=None):
+    """'new', 'modified' (since it was processed) or 'processed' for a single file, see `filter_files_already_processed`."""
+    fingerprint = processing_index.processed_files.get(file_path, False)
+    if not fingerprint:
+        return "new"
+    if isinstance(fingerprint, dict) and _is_modified(file_path, fingerprint, processing_index, entry):
+        return "modified"
+    return "processed"
+
+
+def _is_modified(file_path, fingerprint, processing_index, entry):
+    try:
+        size, mtime_ns = (entry.size, entry.mtime_ns) if entry else _stat(file_path)
+        if size == fingerprint.get("size") and mtime_ns == fingerprint.get("mtime_ns"):
+            return False
+        if fingerprint.get("skipped"):
+            # Sniffed again instead of hashed, it was never read as a whole
+            return True
+        with open(file_path, "rb") as f:
+            content_hash = hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return False
+    if content_hash != fingerprint.get("hash"):
+        return True
+    # Touched but unchanged: remember the new mtime so the file is not hashed again next time
+    processing_index.refresh(file_path, dict(fingerprint, size=size, mtime_ns=mtime_ns))
+    return False
+
 
-    return file_paths
+def _stat(file_path):
+    stat = os.stat(file_path)
+    return stat.st_size, stat.st_mtime_ns
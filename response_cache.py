@@ -0,0 +1,98 @@
+import os
+import time
+import hashlib
+import sqlite3
+import logging
+import threading
+
+
+def build_cache_key(system_prompt, user_input, model_name, deployment):
+    """Build a content-addressed key from the system prompt, the file content and the model/deployment."""
+    prompt_hash = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()
+    content_hash = hashlib.sha256(user_input.encode("utf-8")).hexdigest()
+    return hashlib.sha256(f"{prompt_hash}:{content_hash}:{model_name}:{deployment}".encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    On-disk cache of LLM responses backed by SQLite, bounded in size with LRU eviction.
+
+    Identical (prompt, content, model) combinations, e.g. vendored copies of a file or a re-run
+    after an aborted job, are answered from the cache without an API call.
+    """
+
+    def __init__(self, cache_file, max_size_bytes):
+        cache_directory = os.path.dirname(cache_file)
+        if cache_directory and not os.path.exists(cache_directory):
+            os.makedirs(cache_directory)
+
+        self.cache_file = cache_file
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(cache_file, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, total_tokens INTEGER NOT NULL, "
+            "size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._connection.commit()
+        self._total_size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key):
+        """Return `(response, total_tokens)` for a cached key or `None`, and record the hit or miss."""
+        with self._lock:
+            row = self._connection.execute("SELECT response, total_tokens FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            with self._connection:
+                self._connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+            self.saved_tokens += row[1]
+            return row[0], row[1]
+
+    def put(self, key, response, total_tokens):
+        """Store a response and evict the least recently used entries if the cache grew too large."""
+        size = len(response.encode("utf-8"))
+        if size > self.max_size_bytes:
+            return
+        with self._lock, self._connection:
+            previous = self._connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response, total_tokens, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, response, total_tokens, size, time.time())
+            )
+            self._total_size += size - (previous[0] if previous else 0)
+            if self._total_size > self.max_size_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Evict down to 90% of the limit so that eviction does not run on every single insert
+        target_size = self.max_size_bytes * 0.9
+        evicted_keys = []
+        for key, size in self._connection.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            if self._total_size <= target_size:
+                break
+            evicted_keys.append((key,))
+            self._total_size -= size
+        self._connection.executemany("DELETE FROM responses WHERE key = ?", evicted_keys)
+        logging.info(f"Response cache: evicted {len(evicted_keys)} least recently used entries.")
+
+    def log_stats(self):
+        """Log hit/miss statistics of the current run."""
+        lookups = self.hits + self.misses
+        hit_ratio = self.hits / lookups * 100 if lookups else 0
+        logging.info(
+            f"Response cache: {self.hits} hits, {self.misses} misses ({hit_ratio:.1f}% hit ratio) | "
+            f"Saved tokens: {self.saved_tokens} | Size: {self._total_size / (1024 * 1024):.1f} MB"
+        )
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
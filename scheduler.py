@@ -0,0 +1,294 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+import contextlib
+
+# Azure caches the prefix of prompts with at least this many tokens
+PROMPT_CACHE_MIN_TOKENS = 1024
+# After the first request with a cold system prompt, the others with that prompt wait this long (0 disables the warmup)
+PROMPT_CACHE_WARMUP_SECONDS = float(os.getenv("PROMPT_CACHE_WARMUP_SECONDS", "2"))
+# A system prompt not sent for this long has left the prompt cache (Azure keeps it for 5-10 minutes)
+PROMPT_CACHE_TTL_SECONDS = 300
+
+
+class RateLimiter:
+    """Token bucket that enforces a tokens-per-minute and a requests-per-minute budget."""
+
+    def __init__(self, tokens_per_minute, requests_per_minute, burst_seconds=10):
+        """
+        Create a limiter for the given quota.
+
+        Azure evaluates its quota over short windows (1-10 seconds), so the buckets only hold
+        `burst_seconds` worth of budget instead of a full minute. This avoids the initial burst
+        that would otherwise be answered with a storm of 429 responses.
+        """
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self._token_capacity = max(1.0, tokens_per_minute * burst_seconds / 60)
+        self._request_capacity = max(1.0, requests_per_minute * burst_seconds / 60)
+        self._tokens = self._token_capacity
+        self._requests = self._request_capacity
+        self._last_refill = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._tokens = min(self._token_capacity, self._tokens + elapsed * self.tokens_per_minute / 60)
+        self._requests = min(self._request_capacity, self._requests + elapsed * self.requests_per_minute / 60)
+
+    async def acquire(self, tokens, requests=1):
+        """Wait until the budget admits the given number of requests of the given (estimated) total token cost."""
+        async with self._lock:
+            # A job larger than the bucket is admitted once the bucket is full and leaves a debt
+            # behind that is paid off before the next job is admitted.
+            required_tokens = min(tokens, self._token_capacity)
+            required_requests = min(requests, self._request_capacity)
+            while True:
+                self._refill()
+                if self._tokens >= required_tokens and self._requests >= required_requests:
+                    self._tokens -= tokens
+                    self._requests -= requests
+                    return
+                token_wait = (required_tokens - self._tokens) * 60 / self.tokens_per_minute
+                request_wait = (required_requests - self._requests) * 60 / self.requests_per_minute
+                await asyncio.sleep(max(token_wait, request_wait, 0.01))
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """Correct the bucket once the real token usage of an admitted request is known."""
+        if actual_tokens is None:
+            return
+        self._refill()
+        self._tokens = min(self._token_capacity, self._tokens + estimated_tokens - actual_tokens)
+
+
+class Job:
+    """A single unit of work for the scheduler: one loaded file of one task and its estimated token cost."""
+
+    def __init__(self, task_name, record, estimated_tokens, prompt_key=None, request_count=1, file_count=1):
+        self.task_name = task_name
+        self.record = record
+        self.estimated_tokens = estimated_tokens
+        # Requests the job sends, more than one for a file annotated in chunks
+        self.request_count = request_count
+        # Files the job processes, more than one for a pack of small files
+        self.file_count = file_count
+        # The system prompt, if it is long enough to be cached by the service
+        self.prompt_key = prompt_key
+        self.enqueued_at = time.time()
+        self.admitted_at = None
+
+
+class PromptWarmup:
+    """
+    Tracks which system prompts are in the prompt cache of the service.
+
+    The first request with a cold prompt warms the cache, the other requests with that prompt wait
+    `warmup_seconds` instead of all missing the cache at once. A prompt that was not sent for
+    `ttl_seconds` is cold again.
+    """
+
+    def __init__(self, warmup_seconds=PROMPT_CACHE_WARMUP_SECONDS, ttl_seconds=PROMPT_CACHE_TTL_SECONDS):
+        self.warmup_seconds = warmup_seconds
+        self.ttl_seconds = ttl_seconds
+        self._warm_at = {}
+        self._last_sent = {}
+
+    def state(self, prompt_key, now):
+        """'ready' to be sent, 'cold' (the next request warms the cache) or 'warming'."""
+        if prompt_key is None or self.warmup_seconds <= 0:
+            return "ready"
+        last_sent = self._last_sent.get(prompt_key)
+        if last_sent is None or now - last_sent > self.ttl_seconds:
+            return "cold"
+        return "ready" if now >= self._warm_at[prompt_key] else "warming"
+
+    def sent(self, prompt_key, now):
+        if prompt_key is None:
+            return
+        if self.state(prompt_key, now) == "cold":
+            self._warm_at[prompt_key] = now + self.warmup_seconds
+        self._last_sent[prompt_key] = now
+
+    def time_until_warm(self, prompt_keys, now):
+        """Seconds until the first of the given warming prompts is warm, `None` if none is warming."""
+        waits = [self._warm_at[key] - now for key in prompt_keys if self.state(key, now) == "warming"]
+        return max(0.0, min(waits)) if waits else None
+
+
+class FairJobQueue:
+    """
+    Bounded weighted fair queue over the jobs of one or more tasks, filled by producers while the scheduler runs.
+
+    Every task receives a share of the admitted tokens proportional to its weight: the next job is
+    always taken from the task that has consumed the least tokens relative to its weight so far.
+    Within a task, the largest ready job goes first, so that no large file is left to run alone
+    at the end. Jobs are grouped by their system prompt: a cold prompt is warmed by a single job
+    first and the rest of its group waits for the `prompt_warmup` window, while the other groups
+    go on. `put` waits while `capacity` jobs are buffered, which bounds the memory of a run.
+    """
+
+    def __init__(self, weights=None, capacity=None, prompt_warmup=None):
+        # Heaps of jobs per task and system prompt
+        self._groups = {}
+        self._weights = weights or {}
+        self._virtual_time = {}
+        self._sequence = itertools.count()
+        self._count = 0
+        self.capacity = capacity
+        self.prompt_warmup = prompt_warmup or PromptWarmup(0)
+        self.closed = False
+        # The jobs put so far, more may follow until the queue is closed
+        self.total = 0
+        self._changed = asyncio.Event()
+        self._space = asyncio.Event()
+
+    def __len__(self):
+        return self._count
+
+    async def put(self, job):
+        """Add a job, waiting while the queue is full."""
+        while self.capacity and self._count >= self.capacity:
+            self._space.clear()
+            await self._space.wait()
+        groups = self._groups.setdefault(job.task_name, {})
+        if not any(groups.values()):
+            # A task that joins late or was starved by its producer does not get to catch up in a burst
+            active_times = [self._virtual_time[name] for name, other in self._groups.items() if any(other.values())]
+            self._virtual_time[job.task_name] = max(self._virtual_time.get(job.task_name, 0.0),
+                                                    min(active_times, default=0.0))
+        heapq.heappush(groups.setdefault(job.prompt_key, []), (-job.estimated_tokens, next(self._sequence), job))
+        self._count += 1
+        self.total += 1
+        self._changed.set()
+
+    def close(self):
+        """No more jobs will be put."""
+        self.closed = True
+        self._changed.set()
+
+    def ready(self):
+        """Whether a job can be taken now, buffered jobs may still wait for the warmup of their prompt."""
+        return self._next_group(time.time()) is not None
+
+    async def wait(self):
+        """Wait until a job may be ready: one is put, a prompt warmup ends or the queue is closed."""
+        now = time.time()
+        if self._next_group(now) is not None:
+            return
+        self._changed.clear()
+        prompt_keys = [key for groups in self._groups.values() for key, heap in groups.items() if heap]
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._changed.wait(), self.prompt_warmup.time_until_warm(prompt_keys, now))
+
+    def pop(self):
+        now = time.time()
+        task_name, prompt_key = self._next_group(now)
+        _, _, job = heapq.heappop(self._groups[task_name][prompt_key])
+        self.prompt_warmup.sent(prompt_key, now)
+        self._virtual_time[task_name] += max(1, job.estimated_tokens) / self._weights.get(task_name, 1)
+        self._count -= 1
+        self._space.set()
+        return job
+
+    def _next_group(self, now):
+        """`(task, prompt)` of the next job: the task behind its share, and its cold prompts before the largest ready job."""
+        best = None
+        for task_name, groups in self._groups.items():
+            ready = []
+            for prompt_key, heap in groups.items():
+                if heap:
+                    state = self.prompt_warmup.state(prompt_key, now)
+                    if state != "warming":
+                        ready.append((state != "cold", heap[0][:2], prompt_key))
+            if ready and (best is None or self._virtual_time[task_name] < self._virtual_time[best[0]]):
+                best = (task_name, min(ready)[2])
+        return best
+
+
+class TaskStats:
+    """Counters of the processed files of one task."""
+
+    def __init__(self):
+        self.completed = 0
+        self.failed = 0
+        self.update_times = []
+        self.tokens = 0
+
+    @property
+    def average_time(self):
+        return sum(self.update_times) / len(self.update_times) if self.update_times else 0
+
+
+async def run_with_rate_limit(job_queue, worker, rate_limiter, max_concurrency, label, progress_interval=40):
+    """
+    Run `worker(job)` for every job of the queue, keeping up to `max_concurrency` requests in flight.
+
+    New jobs are admitted as soon as a slot is free and the rate limiter grants the job's
+    estimated token cost, so a slow file never holds back the rest of the run. Jobs are taken
+    while the producers are still filling the queue, the run ends once it is closed and drained.
+    The worker returns a tuple `(update_time, total_tokens)`, `None` values mark failures. A job of several
+    files may return `(update_time, total_tokens, failed_paths)` with the files that failed on their own.
+    Returns the total time and the `TaskStats` per task.
+    """
+    in_flight = {}
+    stats = {}
+    overall_completed = 0
+    start_total_time = time.time()
+    # Waits for the producers (or a prompt warmup) while no job is ready
+    arrival = None
+
+    try:
+        while job_queue or in_flight or not job_queue.closed:
+            while len(in_flight) < max_concurrency and job_queue.ready():
+                job = job_queue.pop()
+                await rate_limiter.acquire(job.estimated_tokens, job.request_count)
+                job.admitted_at = time.time()
+                in_flight[asyncio.create_task(worker(job))] = job
+
+            waiting_for = set(in_flight)
+            if len(in_flight) < max_concurrency and (job_queue or not job_queue.closed):
+                arrival = arrival or asyncio.create_task(job_queue.wait())
+                waiting_for.add(arrival)
+            done, _ = await asyncio.wait(waiting_for, return_when=asyncio.FIRST_COMPLETED)
+            if arrival in done:
+                done.discard(arrival)
+                arrival = None
+            for finished in done:
+                job = in_flight.pop(finished)
+                task_stats = stats.setdefault(job.task_name, TaskStats())
+                task_stats.completed += job.file_count
+                overall_completed += 1
+                try:
+                    result = finished.result()
+                except Exception as e:
+                    logging.error(f'***ERROR*** Error processing file "{job.record.path}" ({job.task_name}): {e}')
+                    result = (None, None)
+                update_time, total_tokens = result[:2]
+
+                rate_limiter.settle(job.estimated_tokens, total_tokens)
+                if update_time is None:
+                    task_stats.failed += job.file_count
+                else:
+                    task_stats.failed += len(result[2]) if len(result) > 2 else 0
+                    task_stats.update_times.append(update_time)
+                if total_tokens is not None:
+                    task_stats.tokens += total_tokens
+
+                if overall_completed % progress_interval == 0 or not (job_queue or in_flight or not job_queue.closed):
+                    update_times = [t for task_stats in stats.values() for t in task_stats.update_times]
+                    average_time = sum(update_times) / len(update_times) if update_times else 0
+                    logging.info(
+                        f"Progress: {overall_completed}/{job_queue.total} - {label} | Avg Time: {average_time:.2f}s | "
+                        f"Tokens: {sum(s.tokens for s in stats.values())} | In flight: {len(in_flight)} | "
+                        f"Failed: {sum(s.failed for s in stats.values())}"
+                    )
+    finally:
+        if arrival:
+            arrival.cancel()
+
+    return time.time() - start_total_time, stats
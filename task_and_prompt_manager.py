@@ -21,10 +21,14 @@ class TaskAndPromptManager:
             logging.error(f"Error loading task file '{self._task_file}': {e}")
             raise ValueError(f"Error loading task file '{self._task_file}': {e}")
 
+    def log_prompts(self, task_names):
+        """Log the beginning of the system prompts of the given tasks."""
         logging.info("\n===============================")
         logging.info("     SYSTEM-PROMPTS LOADED")
         logging.info("===============================")
         for task_name, task in self.tasks.items():
+            if task_name not in task_names:
+                continue
             logging.info(f"*** Task '{task_name}' ***")
             for ext, prompt in task.get("prompts", {}).items():
                 logging.info(f"Extension '{ext}': {prompt[:120].replace(chr(10), ' ')}...")
@@ -0,0 +1,160 @@
+import os
+import json
+import math
+import logging
+import contextvars
+
+# The scheduler job a request belongs to, set by the worker that processes the job
+current_job = contextvars.ContextVar("current_job", default=None)
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of the given values, 0 for no values."""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+class Telemetry:
+    """
+    Collects one record per API request: timestamps, token usage, retries and rate-limit headers.
+
+    Records are appended to a JSONL trace file as they come in. At the end of a run, a percentile
+    report is logged and, if configured, the metrics are written in the Prometheus textfile format.
+    """
+
+    def __init__(self, trace_file=None, prometheus_file=None):
+        self.trace_file = trace_file
+        self.prometheus_file = prometheus_file
+        self.records = []
+        self._trace = None
+        if trace_file:
+            trace_directory = os.path.dirname(trace_file)
+            if trace_directory and not os.path.exists(trace_directory):
+                os.makedirs(trace_directory)
+            self._trace = open(trace_file, "a", encoding="utf-8", buffering=1)
+
+    def record_request(self, **fields):
+        """Add a request record, completed with the job (task, file, queue timestamps) it belongs to."""
+        job = current_job.get()
+        if job is not None:
+            fields.setdefault("task", job.task_name)
+            fields.setdefault("path", job.record.path)
+            fields.setdefault("file_size", job.record.size)
+            fields.setdefault("file_tokens", job.record.token_count)
+            fields["enqueued_at"] = job.enqueued_at
+            fields["admitted_at"] = job.admitted_at
+            fields["queue_wait"] = job.admitted_at - job.enqueued_at if job.admitted_at else None
+        if fields.get("started_at") and fields.get("ended_at"):
+            fields["latency"] = fields["ended_at"] - fields["started_at"]
+        if fields.get("started_at") and fields.get("first_byte_at"):
+            fields["time_to_first_byte"] = fields["first_byte_at"] - fields["started_at"]
+        self.records.append(fields)
+        if self._trace:
+            self._trace.write(json.dumps(fields) + "\n")
+
+    def _elapsed_minutes(self):
+        """Minutes from the start of the first to the end of the last request."""
+        started = self._values("started_at")
+        ended = self._values("ended_at")
+        return max(1e-9, (max(ended) - min(started)) / 60) if started and ended else 1e-9
+
+    def _values(self, key, records=None):
+        return [record[key] for record in (records if records is not None else self.records) if record.get(key) is not None]
+
+    def _prompt_cache_ratios(self, api_records):
+        """Share of the prompt tokens served from the prompt cache of the service, per task."""
+        ratios = {}
+        for task in sorted({record.get("task") for record in api_records if record.get("task")}):
+            task_records = [record for record in api_records if record.get("task") == task]
+            prompt_tokens = sum(self._values("prompt_tokens", task_records))
+            if prompt_tokens:
+                ratios[task] = (sum(self._values("cached_tokens", task_records)) / prompt_tokens, prompt_tokens)
+        return ratios
+
+    def log_report(self):
+        """Log latency percentiles, throttling and the effective throughput of the run."""
+        elapsed_minutes = self._elapsed_minutes()
+        api_records = [record for record in self.records if record.get("status") != "cache"]
+        tokens = sum(self._values("total_tokens", api_records))
+        prompt_tokens = sum(self._values("prompt_tokens", api_records))
+        cached_tokens = sum(self._values("cached_tokens", api_records))
+
+        def describe(key):
+            values = self._values(key, api_records)
+            return " / ".join(f"{percentile(values, p):.2f}s" for p in PERCENTILES)
+
+        logging.info("\n===============================")
+        logging.info("     REQUEST TELEMETRY")
+        logging.info("===============================")
+        logging.info(f"Requests: {len(api_records)} ({sum(1 for r in api_records if r.get('status') == 'error')} failed) | "
+                     f"Cache hits: {len(self.records) - len(api_records)}")
+        hedges = [record for record in api_records if record.get("hedge")]
+        logging.info(f"Retries: {sum(self._values('retries', api_records))} | "
+                     f"Throttled (429): {sum(self._values('throttled', api_records))} | "
+                     f"Hedged: {len(hedges)} ({sum(1 for r in hedges if r.get('status') == 'ok')} finished first)")
+        logging.info(f"Latency p50/p95/p99: {describe('latency')}")
+        logging.info(f"Time to first byte p50/p95/p99: {describe('time_to_first_byte')}")
+        logging.info(f"Queue wait p50/p95/p99: {describe('queue_wait')}")
+        logging.info(f"Tokens: {tokens} (prompt {prompt_tokens}, cached {cached_tokens}) | "
+                     f"Effective TPM: {tokens / elapsed_minutes:.0f} | Effective RPM: {len(api_records) / elapsed_minutes:.1f}")
+        for task, (ratio, task_prompt_tokens) in self._prompt_cache_ratios(api_records).items():
+            logging.info(f"Prompt cache '{task}': {ratio:.0%} of {task_prompt_tokens} prompt tokens cached")
+        logging.info("===============================\n")
+
+    def write_prometheus(self):
+        """Write the metrics of the run atomically in the Prometheus textfile collector format."""
+        if not self.prometheus_file:
+            return
+        elapsed_minutes = self._elapsed_minutes()
+        api_records = [record for record in self.records if record.get("status") != "cache"]
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP ai_annotator_{name} {help_text}")
+            lines.append(f"# TYPE ai_annotator_{name} {metric_type}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+                lines.append(f"ai_annotator_{name}{{{label_text}}} {value}" if label_text else f"ai_annotator_{name} {value}")
+
+        counts = {}
+        for record in self.records:
+            key = (record.get("task", ""), record.get("status", ""))
+            counts[key] = counts.get(key, 0) + 1
+        metric("requests_total", "counter", "Requests by task and status.",
+               [({"task": task, "status": status}, count) for (task, status), count in sorted(counts.items())])
+        metric("retries_total", "counter", "Retried requests.", [({}, sum(self._values("retries", api_records)))])
+        metric("throttled_total", "counter", "Requests answered with 429.", [({}, sum(self._values("throttled", api_records)))])
+        metric("hedged_total", "counter", "Duplicates sent for straggling requests.",
+               [({}, sum(1 for record in api_records if record.get("hedge")))])
+        metric("tokens_total", "counter", "Tokens by type.",
+               [({"type": token_type}, sum(self._values(f"{token_type}_tokens", api_records)))
+                for token_type in ("prompt", "completion", "cached")])
+        metric("prompt_cache_ratio", "gauge", "Share of the prompt tokens served from the prompt cache, by task.",
+               [({"task": task}, round(ratio, 4)) for task, (ratio, _) in self._prompt_cache_ratios(api_records).items()])
+        for key, name in (("latency", "request_latency_seconds"), ("queue_wait", "queue_wait_seconds"),
+                          ("time_to_first_byte", "time_to_first_byte_seconds")):
+            values = self._values(key, api_records)
+            metric(name, "summary", f"Distribution of the request {key.replace('_', ' ')}.",
+                   [({"quantile": p / 100}, percentile(values, p)) for p in PERCENTILES])
+            lines.append(f"ai_annotator_{name}_sum {sum(values)}")
+            lines.append(f"ai_annotator_{name}_count {len(values)}")
+        metric("effective_tokens_per_minute", "gauge", "Tokens per minute over the run.",
+               [({}, round(sum(self._values("total_tokens", api_records)) / elapsed_minutes, 1))])
+        for header in ("remaining_tokens", "remaining_requests"):
+            values = self._values(f"ratelimit_{header}", api_records)
+            if values:
+                metric(f"ratelimit_{header}", "gauge", f"Last x-ratelimit-{header.replace('_', '-')} header.", [({}, values[-1])])
+
+        temp_file = self.prometheus_file + ".tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_file, self.prometheus_file)
+
+    def close(self):
+        if self._trace:
+            self._trace.close()
+            self._trace = None
@@ -0,0 +1,171 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import chunking
+from chunking import annotate_in_chunks, split_changed_regions, split_into_chunks
+
+PYTHON_FILE = """import os
+
+
+def first():
+    return os.sep
+
+
+# Second
+def second():
+    return 2
+
+
+class Third:
+    def a(self):
+        return 'a' * 40
+
+    def b(self):
+        return 'b' * 40
+"""
+
+KOTLIN_FILE = """package demo
+
+import kotlin.math.max
+
+fun first() = max(1, 2)
+
+/** Second */
+fun second(): Int {
+    return 2
+}
+
+class Third {
+    fun a() = "a".repeat(40)
+
+    fun b() = "b".repeat(40)
+}
+"""
+
+
+def split(text, ext, max_chunk_tokens):
+    # One token per character
+    return split_into_chunks(text, ext, max_chunk_tokens, len(text))
+
+
+def test_chunks_are_split_at_declarations_and_keep_the_text():
+    chunks = split(PYTHON_FILE, ".py", 60)
+    assert "".join(chunk.text for chunk in chunks) == PYTHON_FILE
+    assert [chunk.text.lstrip().splitlines()[0] for chunk in chunks] == \
+           ["import os", "# Second", "def a(self):", "def b(self):"]
+    assert chunks[0].context is None
+    assert chunks[1].context == "import os\n\n\n"
+
+
+def test_oversized_classes_are_split_between_members_with_the_class_as_context():
+    chunks = split(PYTHON_FILE, ".py", 60)
+    assert chunks[1].text.endswith("class Third:\n")
+    assert chunks[2].context == chunks[3].context == "import os\n\n\n...\nclass Third:\n...\n"
+
+
+def test_small_declarations_are_merged_into_one_chunk():
+    chunks = split(PYTHON_FILE, ".py", 2 * len(PYTHON_FILE))
+    assert [chunk.text for chunk in chunks] == [PYTHON_FILE]
+
+
+def test_c_like_files_are_split_with_their_header_as_context():
+    chunks = split(KOTLIN_FILE, ".kt", 70)
+    assert "".join(chunk.text for chunk in chunks) == KOTLIN_FILE
+    assert chunks[1].text.startswith("/** Second */\n")
+    assert all(chunk.context.startswith("package demo\n\nimport kotlin.math.max\n") for chunk in chunks[1:])
+
+
+def test_files_that_cannot_be_split_small_enough_are_not_chunked():
+    assert split(PYTHON_FILE, ".py", 20) is None
+    assert split("def broken(:\n", ".py", 20) is None
+    assert split("x = 1\ny = 2\n", ".py", 5) is None
+
+
+def test_only_changed_declarations_are_split_out():
+    base = PYTHON_FILE.replace("return 2", "return 1").replace("'b' * 40", "'c' * 40")
+    regions = split_changed_regions(base, PYTHON_FILE, ".py", 1000, len(PYTHON_FILE))
+    lines = PYTHON_FILE.splitlines(keepends=True)
+    assert [(region.start, region.end) for region in regions] == [(7, 12), (16, 18)]
+    assert [region.text for region in regions] == ["".join(lines[7:12]), "".join(lines[16:18])]
+    assert regions[1].context.endswith("...\nclass Third:\n...\n")
+
+
+def test_unchanged_files_have_no_regions():
+    assert split_changed_regions(PYTHON_FILE, PYTHON_FILE, ".py", 1000, len(PYTHON_FILE)) == []
+
+
+class EchoClient:
+    """
+    Returns every chunk unchanged (or with changed code if it contains `changed_code`, or fails if it
+    contains `failing_code`) and records how many requests run at the same time and which responses are cached.
+    """
+
+    def __init__(self, changed_code=None, failing_code=None):
+        self.changed_code = changed_code
+        self.failing_code = failing_code
+        self.running = 0
+        self.max_running = 0
+        self.started = 0
+        self.finished = 0
+        self.cached = []
+
+    async def generate_code_response(self, system_prompt, user_prompt, cache=True):
+        self.started += 1
+        if self.failing_code and self.failing_code in user_prompt:
+            raise ValueError("Server error")
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        self.finished += 1
+        if self.changed_code and self.changed_code in user_prompt:
+            return user_prompt.replace(self.changed_code, "return None"), 10
+        return user_prompt, 10
+
+    async def cache_response(self, system_prompt, user_input, response, total_tokens):
+        self.cached.append(response)
+
+
+def test_chunks_are_stitched_in_order_with_bounded_concurrency(monkeypatch):
+    monkeypatch.setattr(chunking, "MAX_CONCURRENT_CHUNKS", 2)
+    text = "".join(f"def f{index}():\n    return {index}\n\n\n" for index in range(8))
+    record = SimpleNamespace(path="many.py", text=text, token_count=len(text))
+    client = EchoClient()
+
+    new_code, total_tokens = asyncio.run(annotate_in_chunks(record, ".py", client, "Prompt", 30))
+
+    assert new_code == text
+    assert total_tokens == 80
+    assert client.max_running == 2
+
+
+def test_only_accepted_chunks_are_cached():
+    text = "".join(f"def f{index}():\n    return {index}\n\n\n" for index in range(4))
+    record = SimpleNamespace(path="four.py", text=text, token_count=len(text))
+    client = EchoClient(changed_code="return 2")
+
+    new_code, _ = asyncio.run(annotate_in_chunks(record, ".py", client, "Prompt", 30))
+
+    assert new_code == text
+    assert len(client.cached) == 3
+    assert not any("f2" in response for response in client.cached)
+
+
+def test_the_other_chunks_are_cancelled_when_one_fails(monkeypatch):
+    monkeypatch.setattr(chunking, "MAX_CONCURRENT_CHUNKS", 2)
+    text = "".join(f"def f{index}():\n    return {index}\n\n\n" for index in range(8))
+    record = SimpleNamespace(path="many.py", text=text, token_count=len(text))
+    client = EchoClient(failing_code="return 0")
+
+    async def annotate_and_wait():
+        with pytest.raises(ValueError):
+            await annotate_in_chunks(record, ".py", client, "Prompt", 30)
+        await asyncio.sleep(0.05)
+
+    asyncio.run(annotate_and_wait())
+
+    # No request runs to the end and the requests of the later chunks are never sent
+    assert client.finished == 0
+    assert client.started < 8
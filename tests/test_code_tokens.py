@@ -0,0 +1,48 @@
+import pytest
+
+from code_tokens import has_same_code
+
+
+@pytest.mark.parametrize("old, new, ext", [
+    ("def f(x):\n    return x\n", "def f(x):\n    \"\"\"Return x.\"\"\"\n    # identity\n    return x\n", ".py"),
+    ("fun f() = 1\n", "/** Doc /* nested */ comment */\nfun f() = 1 // one\n", ".kt"),
+    ("int f() { return 1; }\n", "/** Returns one. */\nint f() {\n    return 1; // one\n}\n", ".java"),
+    ("const a = b / c;\n", "// Divide\nconst a = b / c; // by c\n", ".ts"),
+    ("const a = 1\nconst b = 2\n", "/** A */\nconst a = 1\n// B\nconst b = 2\n", ".js"),
+    ("const e = <div>a</div>\n", "// Element\nconst e = <div>a</div>\n", ".tsx"),
+])
+def test_comment_only_changes_have_same_code(old, new, ext):
+    assert has_same_code(old, new, ext) is True
+
+
+@pytest.mark.parametrize("old, new, ext", [
+    ("def f(x):\n    return x\n", "def f(x):\n    return x + 1\n", ".py"),
+    ("val s = \"// a\"\n", "val s = \"// b\"\n", ".kt"),
+    # `return` followed by a line break returns nothing
+    ("function f() {\n  return x\n}\n", "function f() {\n  return\n  x\n}\n", ".ts"),
+    ("const a = b\n(c)\n", "const a = b(c)\n", ".js"),
+    ("foo()\n{ x }\n", "foo() { x }\n", ".kt"),
+])
+def test_code_changes_are_detected(old, new, ext):
+    assert has_same_code(old, new, ext) is False
+
+
+@pytest.mark.parametrize("old, new, ext", [
+    # `//` within a regex literal is no comment
+    ("const r = /\\/\\//g; const a = 1;\n", "const r = /\\/\\//g; const a = 2;\n", ".js"),
+    ("if (ok) return /x/.test(s)\n", "if (ok) return /y/.test(s)\n", ".ts"),
+    ("x = 1\n", "x = (\n", ".py"),
+    ("/* open\n", "/* open\n", ".java"),
+    ("a = 1\n", "a = 1\n", ".rb"),
+])
+def test_undecidable_texts_are_not_compared(old, new, ext):
+    assert has_same_code(old, new, ext) is None
+
+
+def test_docstrings_that_break_python_files_are_code_changes():
+    old = "if x:\n    a = 1\nelse:\n    a = 2\n"
+    new = 'if x:\n    a = 1\n"""Doc."""\nelse:\n    a = 2\n'
+
+    assert has_same_code(old, new, ".py") is False
+    # The original already does not parse, the texts cannot be judged
+    assert has_same_code("else:\n    a = 2\n", '"""Doc."""\nelse:\n    a = 2\n', ".py") is None
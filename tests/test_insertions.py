@@ -0,0 +1,83 @@
+import pytest
+
+from insertions import Insertion, apply_insertions, build_numbered_input, parse_insertions
+
+PYTHON_FILE = """class Greeter:
+    def greet(self, name):
+        return f"Hello {name}"
+"""
+
+KOTLIN_FILE = """class Greeter {
+    fun greet(name: String) = "Hello $name"
+}"""
+
+
+def test_comments_are_indented_like_their_line():
+    new_text = apply_insertions(KOTLIN_FILE, [
+        Insertion(1, "before", "class Greeter", "/** Greets people. */"),
+        Insertion(2, "before", "fun greet", "/**\n * Greets [name].\n */"),
+    ], ".kt")
+
+    assert new_text == """/** Greets people. */
+class Greeter {
+    /**
+     * Greets [name].
+     */
+    fun greet(name: String) = "Hello $name"
+}"""
+
+
+def test_docstrings_after_a_signature_get_the_indentation_of_the_body():
+    new_text = apply_insertions(PYTHON_FILE, [Insertion(2, "after", "def greet", '"""Greet someone."""')], ".py")
+
+    assert new_text == PYTHON_FILE.replace("name):\n", 'name):\n        """Greet someone."""\n')
+
+
+def test_anchors_are_searched_near_the_given_line():
+    new_text = apply_insertions(PYTHON_FILE, [Insertion(3, "before", "def greet(self", "# Greets")], ".py")
+
+    assert new_text == PYTHON_FILE.replace("    def", "    # Greets\n    def")
+
+
+def test_insertions_with_an_unknown_anchor_are_dropped():
+    assert apply_insertions(PYTHON_FILE, [Insertion(1, "before", "def farewell", "# Never")], ".py") == PYTHON_FILE
+    assert apply_insertions(PYTHON_FILE, [Insertion(99, "before", "", "# Never")], ".py") == PYTHON_FILE
+
+
+def test_comments_at_the_end_of_a_file_without_final_newline():
+    new_text = apply_insertions(KOTLIN_FILE, [Insertion(3, "after", "}", "// End")], ".kt")
+
+    assert new_text == KOTLIN_FILE + "\n    // End\n"
+
+
+@pytest.mark.parametrize("text, comment, ext", [
+    (PYTHON_FILE, "greet = None", ".py"),
+    (KOTLIN_FILE, "val x = 1", ".kt"),
+    # The file cannot be lexed because of the regex literal, the comment alone is checked
+    ("const r = /a/g;\n", "console.log(r)", ".js"),
+])
+def test_insertions_that_add_code_are_rejected(text, comment, ext):
+    with pytest.raises(ValueError):
+        apply_insertions(text, [Insertion(1, "before", "", comment)], ext)
+
+
+def test_numbered_input_and_response_round_trip():
+    assert build_numbered_input("a\nb\n") == "1| a\n2| b\n"
+    insertions = parse_insertions('```json\n{"insertions": [{"line": 2, "position": "after", "anchor": "b", '
+                                  '"comment": "# B"}, {"line": 1, "comment": "# A"}]}\n```')
+
+    assert [(i.line, i.position, i.anchor, i.comment) for i in insertions] == \
+           [(2, "after", "b", "# B"), (1, "before", "", "# A")]
+
+
+@pytest.mark.parametrize("response", ["not json", '{"insertions": {}}', '[{"line": "1", "comment": "# A"}]'])
+def test_malformed_responses_are_rejected(response):
+    with pytest.raises(ValueError):
+        parse_insertions(response)
+
+
+def test_docstrings_that_break_the_syntax_are_rejected():
+    text = "if x:\n    a = 1\nelse:\n    a = 2\n"
+
+    with pytest.raises(ValueError):
+        apply_insertions(text, [Insertion(3, "before", "else", '"""Doc."""')], ".py")
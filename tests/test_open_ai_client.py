@@ -0,0 +1,42 @@
+import pytest
+
+from open_ai_client import AzureOpenAIClient, CodeFenceFilter
+
+RESPONSES = [
+    "fun a() = 1\n",
+    "  \n\nfun a() = 1\n\n  \n",
+    "```kotlin\nfun a() = 1\n```",
+    "```kotlin\nfun a() = 1\n```\n",
+    "\n```ts\n\nconst a = 1;\n\n```\n\n",
+    "```ts\nconst a = 1;\n```\n\nSome trailing explanation\n",
+    "Here is the code:\n```ts\nconst a = 1;\n```\n",
+    "```ts \nconst a = 1;\n```\n",
+    "```\n```",
+    "```\n\n```",
+    "``not a fence``\n",
+    "`x`\n",
+    "```",
+    "",
+    "   ",
+    "const s = `a\n```\nb`\n",
+]
+
+
+def stream(response, piece_size):
+    fence_filter = CodeFenceFilter()
+    pieces = [response[start:start + piece_size] for start in range(0, len(response), piece_size)]
+    return "".join(fence_filter.feed(piece) for piece in pieces) + fence_filter.finish()
+
+
+@pytest.mark.parametrize("response", RESPONSES)
+@pytest.mark.parametrize("piece_size", [1, 2, 5, 1000])
+def test_streamed_responses_are_cleaned_like_complete_ones(response, piece_size):
+    assert stream(response, piece_size) == AzureOpenAIClient._clean_response(response.strip())
+
+
+def test_unfenced_responses_are_passed_through_as_they_arrive():
+    fence_filter = CodeFenceFilter()
+
+    assert fence_filter.feed("  fun a() = 1\n") == "fun a() = 1"
+    assert fence_filter.feed("fun b() = 2\n  ") == "\nfun b() = 2"
+    assert fence_filter.finish() == "\n"
@@ -0,0 +1,68 @@
+import asyncio
+import hashlib
+
+import process_files
+from file_utils import FileRecord
+from packing import FilePack
+from process_files import FileWriteCoordinator, process_pack
+from processing_index import ProcessingIndex
+from scheduler import RateLimiter
+
+TASK = {"prompts": {"*": "Add comments."}}
+
+
+class FallbackClient:
+    """Answers packed requests without any file section, so that every file is sent on its own."""
+
+    def __init__(self):
+        self.running = 0
+        self.max_running = 0
+
+    async def generate_code_response(self, system_prompt, user_input, cache=True):
+        if "<<<FILE " in user_input:
+            return "Sorry, too many files.", 10
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        if user_input.startswith("bad"):
+            raise ValueError("Server error")
+        return "# Commented\n" + user_input, 5
+
+    async def cache_response(self, system_prompt, user_input, response, total_tokens):
+        pass
+
+
+def write_record(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text)
+    stat = path.stat()
+    return FileRecord(str(path), text, "utf-8", stat.st_size, stat.st_mtime_ns,
+                      hashlib.sha256(text.encode()).hexdigest(), len(text))
+
+
+def test_failed_files_of_a_pack_are_reported_and_not_indexed(tmp_path, monkeypatch):
+    monkeypatch.setattr(process_files, "split_request_tokens",
+                        lambda task, record, tokenizer: (record.token_count, record.token_count, 1))
+    records = [write_record(tmp_path, name, text) for name, text in
+               (("a.py", "a = 1\n"), ("bad.py", "bad = 1\n"), ("c.py", "c = 1\n"))]
+    processing_index = ProcessingIndex(str(tmp_path / "index.json"), "journal")
+    # Buckets of 10 requests, refilled by one request per second
+    rate_limiter = RateLimiter(600000, 60)
+    client = FallbackClient()
+
+    async def run():
+        result = await process_pack(FilePack(records, ".py"), client, TASK, processing_index,
+                                    FileWriteCoordinator([processing_index]), rate_limiter)
+        await processing_index.close()
+        return result
+
+    _, total_tokens, failed_paths = asyncio.run(run())
+
+    assert failed_paths == [records[1].path]
+    assert total_tokens == 20
+    assert sorted(processing_index.processed_files) == [records[0].path, records[2].path]
+    assert (tmp_path / "a.py").read_text() == "# Commented\na = 1\n"
+    # The fallback requests run concurrently and each takes a request from the rate limiter
+    assert client.max_running == 3
+    assert rate_limiter._requests < rate_limiter._request_capacity - 2.5
@@ -0,0 +1,140 @@
+import os
+import json
+import hashlib
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from processing_index import ProcessingIndex, file_fingerprint, processing_state
+
+
+def build_index(index_file, backend, entries):
+    async def mark_and_close():
+        processing_index = ProcessingIndex(index_file, backend)
+        for file_path, value in entries.items():
+            await processing_index.mark_file_processed(file_path, value)
+        await processing_index.close()
+
+    asyncio.run(mark_and_close())
+
+
+def load_index(index_file, backend):
+    processing_index = ProcessingIndex(index_file, backend)
+    asyncio.run(processing_index.close())
+    return processing_index.processed_files
+
+
+ENTRIES = {f"src/file_{number}.py": file_fingerprint(number, number * 1000, f"hash{number}") for number in range(50)}
+ENTRIES["src/Überblick.kt"] = True
+
+
+@pytest.mark.parametrize("backend", ["journal", "sqlite"])
+def test_entries_survive_a_round_trip(tmp_path, backend):
+    index_file = str(tmp_path / "index.json")
+    build_index(index_file, backend, ENTRIES)
+
+    assert load_index(index_file, backend) == ENTRIES
+
+
+@pytest.mark.parametrize("backend", ["journal", "sqlite"])
+def test_later_entries_replace_earlier_ones(tmp_path, backend):
+    index_file = str(tmp_path / "index.json")
+    build_index(index_file, backend, ENTRIES)
+    build_index(index_file, backend, {"src/file_1.py": file_fingerprint(2, 2, "new")})
+
+    assert load_index(index_file, backend)["src/file_1.py"] == file_fingerprint(2, 2, "new")
+
+
+def test_journal_entries_are_replayed_without_compaction(tmp_path):
+    index_file = str(tmp_path / "index.json")
+
+    async def mark_without_close():
+        processing_index = ProcessingIndex(index_file, "journal")
+        for file_path, value in ENTRIES.items():
+            await processing_index.mark_file_processed(file_path, value)
+        await processing_index.commit()
+
+    asyncio.run(mark_without_close())
+
+    assert not os.path.exists(index_file)
+    assert load_index(index_file, "journal") == ENTRIES
+
+
+def test_torn_journal_line_is_discarded(tmp_path):
+    index_file = str(tmp_path / "index.json")
+    with open(index_file + ".journal", "w") as f:
+        f.write(json.dumps(["a.py", True]) + "\n" + '["b.py", tr')
+
+    assert load_index(index_file, "journal") == {"a.py": True}
+
+
+def test_sqlite_backend_imports_a_legacy_json_index(tmp_path):
+    index_file = str(tmp_path / "index.json")
+    build_index(index_file, "journal", ENTRIES)
+
+    assert load_index(index_file, "sqlite") == ENTRIES
+    os.remove(index_file)
+    assert load_index(index_file, "sqlite") == ENTRIES
+
+
+def test_unknown_backends_are_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        ProcessingIndex(str(tmp_path / "index.json"), "csv")
+
+
+def test_entries_refreshed_from_threads_are_all_committed(tmp_path):
+    index_file = str(tmp_path / "index.json")
+
+    async def refresh_while_committing():
+        processing_index = ProcessingIndex(index_file, "journal")
+
+        def refresh(number):
+            for entry in range(100):
+                processing_index.refresh(f"thread_{number}/file_{entry}.py", True)
+
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(4) as executor:
+            refreshing = [loop.run_in_executor(executor, refresh, number) for number in range(4)]
+            while not all(future.done() for future in refreshing):
+                await processing_index.commit()
+            await asyncio.gather(*refreshing)
+        await processing_index.close()
+
+    asyncio.run(refresh_while_committing())
+
+    assert len(load_index(index_file, "journal")) == 400
+
+
+def test_touched_but_unchanged_files_are_refreshed(tmp_path):
+    source_file = tmp_path / "a.py"
+    source_file.write_text("x = 1\n")
+    stat = os.stat(source_file)
+    processing_index = ProcessingIndex(str(tmp_path / "index.json"), "journal")
+    content_hash = hashlib.sha256(b"x = 1\n").hexdigest()
+    processing_index.processed_files[str(source_file)] = file_fingerprint(stat.st_size, stat.st_mtime_ns - 1, content_hash)
+
+    assert processing_state(str(source_file), processing_index) == "processed"
+    assert processing_index.processed_files[str(source_file)]["mtime_ns"] == stat.st_mtime_ns
+
+    source_file.write_text("x = 2\n")
+    assert processing_state(str(source_file), processing_index) == "modified"
+    asyncio.run(processing_index.close())
+
+
+@pytest.mark.parametrize("backend", ["journal", "sqlite"])
+def test_dry_runs_do_not_change_the_index(tmp_path, backend):
+    index_file = str(tmp_path / "index.json")
+    build_index(index_file, "journal", ENTRIES)
+    files_before = sorted(os.listdir(tmp_path))
+
+    async def mark_and_close():
+        processing_index = ProcessingIndex(index_file, backend, dry_run=True)
+        await processing_index.mark_file_processed("src/new.py", True)
+        processing_index.refresh("src/file_1.py", True)
+        await processing_index.close()
+        return processing_index.processed_files
+
+    assert asyncio.run(mark_and_close()) == ENTRIES
+    assert sorted(os.listdir(tmp_path)) == files_before
+    assert load_index(index_file, "journal") == ENTRIES
@@ -0,0 +1,94 @@
+import asyncio
+from types import SimpleNamespace
+
+from scheduler import FairJobQueue, Job, RateLimiter, run_with_rate_limit
+
+
+def test_rate_limiter_charges_every_request_of_a_job():
+    # Buckets of 10 seconds: 1000 tokens and 10 requests
+    rate_limiter = RateLimiter(tokens_per_minute=6000, requests_per_minute=60)
+
+    asyncio.run(rate_limiter.acquire(100, 4))
+
+    assert round(rate_limiter._tokens) == 900
+    assert round(rate_limiter._requests) == 6
+
+
+def test_rate_limiter_admits_jobs_with_more_requests_than_the_bucket_holds():
+    rate_limiter = RateLimiter(tokens_per_minute=6000, requests_per_minute=60)
+
+    asyncio.run(asyncio.wait_for(rate_limiter.acquire(100, 25), timeout=1))
+
+    assert round(rate_limiter._requests) == -15
+
+
+def test_stats_count_the_files_of_every_job():
+    async def run():
+        job_queue = FairJobQueue()
+        await job_queue.put(Job("docs", SimpleNamespace(path="pack"), 10, file_count=3))
+        await job_queue.put(Job("docs", SimpleNamespace(path="single"), 10))
+        await job_queue.put(Job("docs", SimpleNamespace(path="failed pack"), 10, file_count=2))
+        job_queue.close()
+
+        async def worker(job):
+            if job.record.path == "failed pack":
+                raise ValueError("No response")
+            if job.record.path == "pack":
+                return 0.1, 5, ["pack/b.py"]
+            return 0.1, 5
+
+        return await run_with_rate_limit(job_queue, worker, RateLimiter(600000, 6000), 2, "test")
+
+    _, stats = asyncio.run(run())
+
+    assert (stats["docs"].completed, stats["docs"].failed, stats["docs"].tokens) == (6, 3, 10)
+
+
+def pop_all(job_queue):
+    order = []
+    while job_queue.ready():
+        job = job_queue.pop()
+        order.append((job.task_name, job.record.path))
+    return order
+
+
+def build_queue(jobs, weights=None):
+    async def put_all():
+        job_queue = FairJobQueue(weights)
+        for task_name, path, tokens in jobs:
+            await job_queue.put(Job(task_name, SimpleNamespace(path=path), tokens))
+        job_queue.close()
+        return job_queue
+
+    return asyncio.run(put_all())
+
+
+def test_jobs_of_a_task_are_taken_largest_first_in_order_of_arrival():
+    job_queue = build_queue([("docs", "small", 10), ("docs", "large", 1000), ("docs", "medium", 100),
+                             ("docs", "medium too", 100)])
+
+    assert pop_all(job_queue) == [("docs", "large"), ("docs", "medium"), ("docs", "medium too"), ("docs", "small")]
+
+
+def test_tasks_share_the_admitted_tokens_by_their_weight():
+    jobs = [(task_name, f"{task_name} {number}", 100) for number in range(6) for task_name in ("docs", "tests")]
+    job_queue = build_queue(jobs, weights={"docs": 2, "tests": 1})
+
+    order = [task_name for task_name, _ in pop_all(job_queue)]
+
+    assert order[:6].count("docs") == 4
+    assert order[:9] == ["docs", "tests", "docs", "docs", "tests", "docs", "docs", "tests", "docs"]
+
+
+def test_put_waits_while_the_queue_is_full():
+    async def fill():
+        job_queue = FairJobQueue(capacity=1)
+        await job_queue.put(Job("docs", SimpleNamespace(path="first"), 10))
+        blocked = asyncio.create_task(job_queue.put(Job("docs", SimpleNamespace(path="second"), 10)))
+        await asyncio.sleep(0.01)
+        was_blocked = not blocked.done()
+        job_queue.pop()
+        await asyncio.wait_for(blocked, timeout=1)
+        return was_blocked, len(job_queue)
+
+    assert asyncio.run(fill()) == (True, 1)
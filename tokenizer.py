@@ -0,0 +1,69 @@
+import os
+import logging
+import threading
+
+import tiktoken
+import tiktoken.model
+
+# Encoding of the token counts, by default the one of AZURE_OPENAI_MODEL_NAME (o200k_base for gpt-4o, cl100k_base for gpt-4)
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "")
+# Used for models that tiktoken does not know
+DEFAULT_ENCODING = "cl100k_base"
+
+_tokenizers = {}
+
+
+class LazyTokenizer:
+    """
+    A tiktoken encoding that is only loaded when the first text is encoded, by whichever thread
+    (e.g. a loader thread of the pipeline) encodes it, instead of at startup.
+    """
+
+    def __init__(self, encoding_name):
+        self.encoding_name = encoding_name
+        self._encoding = None
+        self._lock = threading.Lock()
+
+    @property
+    def encoding(self):
+        if self._encoding is None:
+            with self._lock:
+                if self._encoding is None:
+                    self._encoding = load_encoding(self.encoding_name)
+        return self._encoding
+
+    def encode(self, text, **kwargs):
+        return self.encoding.encode(text, **kwargs)
+
+
+def get_tokenizer(encoding_name=None):
+    """The shared lazy tokenizer of the given encoding, by default the one of the configured model."""
+    encoding_name = encoding_name or get_encoding_name()
+    if encoding_name not in _tokenizers:
+        _tokenizers[encoding_name] = LazyTokenizer(encoding_name)
+    return _tokenizers[encoding_name]
+
+
+def get_encoding_name(model_name=None):
+    """TOKENIZER_ENCODING if it is set, otherwise the encoding of the model."""
+    if TOKENIZER_ENCODING:
+        return TOKENIZER_ENCODING
+    model_name = model_name or os.getenv("AZURE_OPENAI_MODEL_NAME") or ""
+    try:
+        return tiktoken.model.encoding_name_for_model(model_name)
+    except KeyError:
+        logging.warning(f"No tokenizer known for the model '{model_name}', counting tokens with {DEFAULT_ENCODING}. "
+                        f"Set TOKENIZER_ENCODING to choose another one.")
+        return DEFAULT_ENCODING
+
+
+def load_encoding(encoding_name):
+    """
+    Load an encoding from the tiktoken cache (TIKTOKEN_CACHE_DIR, bundled with the Docker image), or
+    download it if it is not cached yet.
+    """
+    try:
+        return tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        raise ValueError(f"***ERROR*** The tokenizer '{encoding_name}' is neither in the tiktoken cache "
+                         f"(TIKTOKEN_CACHE_DIR={os.getenv('TIKTOKEN_CACHE_DIR', '')}) nor downloadable: {e}")
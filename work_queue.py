@@ -0,0 +1,163 @@
+import os
+import time
+import socket
+import sqlite3
+import asyncio
+import logging
+import threading
+
+WORK_LEASE_SECONDS = float(os.getenv("WORK_LEASE_SECONDS", "300"))
+MAX_ATTEMPTS = 3
+# How often a worker without claimable files checks whether the files leased by other workers are done
+WORK_POLL_SECONDS = 10
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    Lease-based work queue in an SQLite database that several worker processes share.
+
+    Every (task, file) is a work item. A worker claims items with a lease, renews the lease while it
+    works on them and marks them done. Items of a crashed worker become claimable again once their
+    lease expires. Items of a file leased by another worker are not claimed, so two tasks never
+    rewrite the same file at the same time.
+    """
+
+    def __init__(self, queue_file, worker_id=None, lease_seconds=WORK_LEASE_SECONDS):
+        queue_directory = os.path.dirname(queue_file)
+        if queue_directory and not os.path.exists(queue_directory):
+            os.makedirs(queue_directory)
+
+        self.queue_file = queue_file
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(queue_file, timeout=60, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS work_items ("
+            " task TEXT NOT NULL, path TEXT NOT NULL, version TEXT NOT NULL, size INTEGER NOT NULL DEFAULT 0,"
+            " status TEXT NOT NULL DEFAULT 'pending', worker TEXT, lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (task, path))"
+        )
+        if "size" not in {column[1] for column in self._connection.execute("PRAGMA table_info(work_items)")}:
+            # Queues created before the files were claimed by size
+            self._connection.execute("ALTER TABLE work_items ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS work_items_status ON work_items (status, lease_until)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS work_items_path ON work_items (path, status)")
+
+    def enqueue(self, task_name, entries):
+        """
+        Add the given `FileEntry`s of a task. Items already in the queue are kept as they are, unless they
+        are finished and the file has changed since, e.g. in a later run.
+
+        Entries may be added in several batches while the tree is walked, as items are claimed by size anyway.
+        """
+        with self._lock:
+            self._execute_in_transaction(lambda: self._connection.executemany(
+                "INSERT INTO work_items (task, path, version, size) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (task, path) DO UPDATE SET version = excluded.version, size = excluded.size,"
+                " status = 'pending', worker = NULL, lease_until = NULL, attempts = 0 WHERE status IN ('done', 'failed', 'skipped') AND version != excluded.version",
+                [(task_name, entry.path, f"{entry.size}:{entry.mtime_ns}", entry.size) for entry in entries]
+            ))
+
+    def claim(self, task_names, limit):
+        """
+        Lease up to `limit` pending or expired items of the given tasks, the largest files first,
+        so that no large file is left to run alone at the end. Returns `(task, path)` tuples.
+        """
+        placeholders = ",".join("?" for _ in task_names)
+
+        def claim_items():
+            now = time.time()
+            items = self._connection.execute(
+                f"SELECT task, path FROM work_items AS item"
+                f" WHERE task IN ({placeholders})"
+                f" AND (status = 'pending' OR (status = 'leased' AND lease_until < ?))"
+                f" AND NOT EXISTS (SELECT 1 FROM work_items AS other WHERE other.path = item.path"
+                f"  AND other.status = 'leased' AND other.lease_until >= ? AND other.worker != ?)"
+                f" ORDER BY size DESC, rowid LIMIT ?",
+                (*task_names, now, now, self.worker_id, limit)
+            ).fetchall()
+            self._connection.executemany(
+                "UPDATE work_items SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1"
+                " WHERE task = ? AND path = ?",
+                [(self.worker_id, now + self.lease_seconds, *item) for item in items]
+            )
+            return items
+
+        with self._lock:
+            return self._execute_in_transaction(claim_items)
+
+    def renew(self):
+        """Extend the leases of all items this worker holds."""
+        with self._lock:
+            self._connection.execute(
+                "UPDATE work_items SET lease_until = ? WHERE worker = ? AND status = 'leased'",
+                (time.time() + self.lease_seconds, self.worker_id)
+            )
+
+    def complete(self, items, status="done"):
+        """Mark leased items as done (or e.g. skipped)."""
+        with self._lock:
+            self._execute_in_transaction(lambda: self._connection.executemany(
+                "UPDATE work_items SET status = ?, lease_until = NULL WHERE task = ? AND path = ? AND worker = ?",
+                [(status, *item, self.worker_id) for item in items]
+            ))
+
+    def fail(self, items):
+        """Return failed items to the queue, or mark them failed after `MAX_ATTEMPTS` attempts."""
+        with self._lock:
+            self._execute_in_transaction(lambda: self._connection.executemany(
+                "UPDATE work_items SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,"
+                " worker = NULL, lease_until = NULL WHERE task = ? AND path = ? AND worker = ?",
+                [(MAX_ATTEMPTS, *item, self.worker_id) for item in items]
+            ))
+
+    def release(self):
+        """Return the items this worker still holds to the queue, e.g. on shutdown."""
+        with self._lock:
+            self._connection.execute(
+                "UPDATE work_items SET status = 'pending', worker = NULL, lease_until = NULL, attempts = attempts - 1"
+                " WHERE worker = ? AND status = 'leased'", (self.worker_id,)
+            )
+
+    def counts(self, task_names):
+        """Number of items per status of the given tasks, with 'active' for unexpired leases of other workers."""
+        placeholders = ",".join("?" for _ in task_names)
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT CASE WHEN status = 'leased' AND lease_until >= ? AND worker != ? THEN 'active' ELSE status END, COUNT(*)"
+                f" FROM work_items WHERE task IN ({placeholders}) GROUP BY 1",
+                (time.time(), self.worker_id, *task_names)
+            ).fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _execute_in_transaction(self, operation):
+        # BEGIN IMMEDIATE takes the write lock up front, so concurrent claims of other workers wait instead of failing
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = operation()
+            self._connection.execute("COMMIT")
+            return result
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+
+
+async def renew_leases_periodically(work_queue):
+    """Renew the leases of this worker until cancelled."""
+    while True:
+        await asyncio.sleep(work_queue.lease_seconds / 3)
+        try:
+            await asyncio.to_thread(work_queue.renew)
+        except sqlite3.Error as e:
+            logging.error(f"***ERROR*** Error renewing work leases: {e}")